@@ -8,6 +8,8 @@ from .. import dag
 from ..runner import RUNNER_MAP
 from ..provenance import find_versions
 from ..loader import find_anadama_pipelines
+from ..util import max_cpus
+from ..dependency import FULL_HASH_POLICIES
 
 
 opt_runner = dict(
@@ -35,6 +37,34 @@ opt_pipeline_name = dict(
     type    = str
 )
 
+opt_compact_dag = dict(
+    name    = "compact_dag",
+    long    = "compact_dag",
+    default = False,
+    help    = ("Use a compact, integer-indexed graph when building the DAG."
+               " Saves memory on very large pipelines"),
+    type    = bool
+)
+
+opt_status_workers = dict(
+    name    = "status_workers",
+    long    = "status_workers",
+    default = max_cpus,
+    help    = ("Number of threads to use when checking which tasks are"
+               " up to date"),
+    type    = int
+)
+
+opt_full_hash = dict(
+    name    = "full_hash",
+    long    = "full_hash",
+    default = "always",
+    help    = ("Whether to md5 an entire dependency file whose mtime"
+               " moved, or trust a digest of sampled blocks. Choices: "
+               +",".join(FULL_HASH_POLICIES)),
+    type    = str
+)
+
 opt_reporter['help'] = \
 """Choose output reporter. Available:
 'default': report output on console
@@ -62,7 +92,9 @@ class AnadamaCmdBase(DoitCmdBase):
 
 from .run import Run
 class ListDag(Run):
-    my_opts = (opt_runner, opt_tmpfiles, opt_pipeline_name)
+    my_opts = (opt_runner, opt_tmpfiles, opt_pipeline_name,
+               opt_compact_dag, opt_status_workers,
+               opt_full_hash)
     name = "dag"
     doc_purpose = "print execution tree"
     doc_usage = "[TASK ...]"
@@ -10,12 +10,16 @@ from doit.control import TaskControl
 from doit.runner import Runner, MRunner, MThreadRunner
 from doit.cmd_run import Run as DoitRun
 
-from .. import performance
+from .. import performance, scheduler, dependency
 from ..reporter import REPORTERS
 from ..runner import RUNNER_MAP, GRID_RUNNER_MAP
+from ..runner.grid import SUBMIT_MODES
+from ..runner.probes import DEFAULT_PATH as DEFAULT_PROBE_PATH
+from ..runner.probes import DEFAULT_TTL as DEFAULT_PROBE_TTL
+from ..runner.visibility import DEFAULT_DEADLINE as DEFAULT_TARGET_WAIT
 
 from . import AnadamaCmdBase
-from . import opt_runner, opt_pipeline_name, opt_tmpfiles
+from . import opt_runner, opt_pipeline_name, opt_tmpfiles, opt_full_hash
 
 opt_grid_part = {
     "name": "partition",
@@ -33,6 +37,16 @@ opt_perf_url = {
     "default": performance.DEFAULT_URL
 }
 
+opt_perf_spool = {
+    "name": "perf_spool",
+    "long": "perf-spool",
+    "help": ("Where to keep grid job performance that couldn't be sent to"
+             " --perf-url yet. Defaults to a directory for that URL"
+             " under "+performance.SPOOL_PATH),
+    "type": str,
+    "default": ""
+}
+
 opt_auth_info = {
     "name": "auth_info",
     "long": "auth-info",
@@ -59,11 +73,151 @@ opt_grid_args = {
     "default": ""
 }
 
+opt_grid_submit = {
+    "name": "grid_submit",
+    "long": "grid_submit",
+    "help": ("How grid runners submit jobs. `sync' blocks one thread per"
+             " job; `async' submits without waiting and polls the"
+             " scheduler for all jobs at once. Choices: "
+             +", ".join(SUBMIT_MODES)),
+    "type": str,
+    "default": "sync"
+}
+
+opt_grid_poll = {
+    "name": "grid_poll",
+    "long": "grid_poll",
+    "help": "Seconds between scheduler polls in async grid submit mode",
+    "type": float,
+    "default": 10
+}
+
+opt_grid_array_min = {
+    "name": "grid_array_min",
+    "long": "grid_array_min",
+    "help": ("In async grid submit mode, submit at least this many ready"
+             " jobs with identical resource requests as one job array."
+             " Use 0 to never submit job arrays"),
+    "type": int,
+    "default": 2
+}
+
+opt_grid_bundle_under = {
+    "name": "grid_bundle_under",
+    "long": "grid_bundle_under",
+    "help": ("In async grid submit mode, run ready jobs predicted to take"
+             " less than this many minutes one after the other in a"
+             " shared grid job. Use 0 to never bundle jobs"),
+    "type": float,
+    "default": 0
+}
+
+opt_grid_bundle_budget = {
+    "name": "grid_bundle_budget",
+    "long": "grid_bundle_budget",
+    "help": "Most minutes of predicted run time to put in one bundle",
+    "type": float,
+    "default": 60
+}
+
+opt_grid_journal = {
+    "name": "grid_journal",
+    "long": "grid_journal",
+    "help": ("Keep a journal of submitted grid jobs in this file. If the"
+             " run dies, the next run with the same journal waits on the"
+             " jobs still on the grid in async submit mode instead of"
+             " submitting them again"),
+    "type": str,
+    "default": None
+}
+
+opt_grid_target_wait = {
+    "name": "grid_target_wait",
+    "long": "grid_target_wait",
+    "help": ("Most seconds to wait for a finished grid job's targets to"
+             " become visible on this node. Raise it for shared"
+             " filesystems that are slow to show new files"),
+    "type": float,
+    "default": DEFAULT_TARGET_WAIT
+}
+
+opt_grid_max_retries = {
+    "name": "grid_max_retries",
+    "long": "grid_max_retries",
+    "help": ("Most times to try a grid job again after the scheduler kills"
+             " it for running out of memory or time. Each try asks for"
+             " more of what ran out"),
+    "type": int,
+    "default": 3
+}
+
+opt_grid_max_queued = {
+    "name": "grid_max_queued",
+    "long": "grid_max_queued",
+    "help": ("Most jobs to have on the grid at once, waiting or running."
+             " Set this to the scheduler's limit on jobs per user. Use 0"
+             " for no limit"),
+    "type": int,
+    "default": 0
+}
+
+opt_grid_max_pending = {
+    "name": "grid_max_pending",
+    "long": "grid_max_pending",
+    "help": ("Most jobs to keep waiting in the queue, besides the ones"
+             " running. Use 0 for no limit"),
+    "type": int,
+    "default": 0
+}
+
+opt_grid_submit_rate = {
+    "name": "grid_submit_rate",
+    "long": "grid_submit_rate",
+    "help": "Most grid submissions per second. Use 0 for no limit",
+    "type": float,
+    "default": 0
+}
+
+opt_grid_mem_budget = {
+    "name": "grid_mem_budget",
+    "long": "grid_mem_budget",
+    "help": ("Most MB of memory for the jobs on the grid to ask for all"
+             " told. Use 0 for no limit"),
+    "type": int,
+    "default": 0
+}
+
+opt_grid_probe_cache = {
+    "name": "grid_probe_cache",
+    "long": "grid_probe_cache",
+    "help": ("Keep what the grid scheduler says about its partitions,"
+             " queues and parallel environments in this file between"
+             " runs"),
+    "type": str,
+    "default": DEFAULT_PROBE_PATH
+}
+
+opt_grid_probe_ttl = {
+    "name": "grid_probe_ttl",
+    "long": "grid_probe_ttl",
+    "help": ("Hours before asking the grid scheduler about itself again."
+             " Use 0 to ask again now"),
+    "type": float,
+    "default": DEFAULT_PROBE_TTL
+}
+
 
 class Run(AnadamaCmdBase, DoitRun):
     my_opts = (opt_runner, opt_pipeline_name,
-               opt_grid_part, opt_perf_url, opt_tmpfiles, 
-               opt_grid_args, opt_reporter_url, opt_auth_info)
+               opt_grid_part, opt_perf_url, opt_perf_spool, opt_tmpfiles, 
+               opt_grid_args, opt_reporter_url, opt_auth_info,
+               opt_full_hash, opt_grid_submit, opt_grid_poll,
+               opt_grid_array_min, opt_grid_bundle_under,
+               opt_grid_bundle_budget, opt_grid_journal,
+               opt_grid_target_wait, opt_grid_max_retries,
+               opt_grid_max_queued, opt_grid_max_pending,
+               opt_grid_submit_rate, opt_grid_mem_budget,
+               opt_grid_probe_cache, opt_grid_probe_ttl)
 
     def _execute(self, outfile=sys.stdout,
                  verbosity=None, always=False, continue_=False,
@@ -129,7 +283,12 @@ class Run(AnadamaCmdBase, DoitRun):
                 reporter_obj = reporter_cls
 
 
-            run_args = [self.dep_class, self.dep_file, reporter_obj,
+            full_hash = self.opt_values.get('full_hash', 'always')
+            if full_hash not in dependency.FULL_HASH_POLICIES:
+                raise InvalidCommand("--full_hash must be one of "
+                                     +", ".join(dependency.FULL_HASH_POLICIES))
+            dep_class = dependency.tiered(self.dep_class, full_hash)
+            run_args = [dep_class, self.dep_file, reporter_obj,
                         continue_, always, verbosity]
             run_kwargs = {}
             RunnerClass = RUNNER_MAP.get(self.opt_values["runner"])
@@ -145,14 +304,58 @@ class Run(AnadamaCmdBase, DoitRun):
                             self.opt_values['tmpfiledir'],
                             self.opt_values['grid_args']]+run_args
                 run_kwargs['num_process'] = num_process if num_process else 1
+                submit_mode = self.opt_values.get('grid_submit', 'sync')
+                if submit_mode not in SUBMIT_MODES:
+                    raise InvalidCommand("--grid_submit must be one of "
+                                         +", ".join(SUBMIT_MODES))
+                run_kwargs['submit_mode'] = submit_mode
+                run_kwargs['poll_interval'] = self.opt_values.get(
+                    'grid_poll', 10)
+                run_kwargs['min_array_size'] = self.opt_values.get(
+                    'grid_array_min', 2)
+                run_kwargs['bundle_under'] = self.opt_values.get(
+                    'grid_bundle_under', 0)
+                run_kwargs['bundle_budget'] = self.opt_values.get(
+                    'grid_bundle_budget', 60)
+                run_kwargs['journal_path'] = self.opt_values.get(
+                    'grid_journal', None)
+                run_kwargs['target_wait'] = self.opt_values.get(
+                    'grid_target_wait', DEFAULT_TARGET_WAIT)
+                run_kwargs['max_retries'] = self.opt_values.get(
+                    'grid_max_retries', 3)
+                run_kwargs['perf_spool'] = self.opt_values.get(
+                    'perf_spool') or None
+                for opt, kwarg in (('grid_max_queued', 'max_queued'),
+                                   ('grid_max_pending', 'max_pending'),
+                                   ('grid_submit_rate', 'submit_rate'),
+                                   ('grid_mem_budget', 'mem_budget')):
+                    run_kwargs[kwarg] = self.opt_values.get(opt) or None
+                run_kwargs['probe_cache'] = self.opt_values.get(
+                    'grid_probe_cache', DEFAULT_PROBE_PATH)
+                run_kwargs['probe_ttl'] = self.opt_values.get(
+                    'grid_probe_ttl', DEFAULT_PROBE_TTL)
 
             runner = RunnerClass(*run_args, **run_kwargs)
             runner.pipeline_name = pipeline_name
-            return runner.run_all(self.control.task_dispatcher())
+            runner.compact_dag = self.opt_values.get('compact_dag', False)
+            runner.status_workers = self.opt_values.get('status_workers', 1)
+            return runner.run_all(self._task_dispatcher(runner))
         finally:
             if isinstance(outfile, str):
                 outstream.close()
 
+    def _task_dispatcher(self, runner):
+        """Parallel runners get their tasks along the critical path
+        first; see :mod:`anadama.scheduler`. Local runners only read
+        the performance history to rank tasks."""
+        if not isinstance(runner, MRunner):
+            return self.control.task_dispatcher()
+        predictor = getattr(runner, "performance_predictor", None)
+        if not predictor:
+            predictor = performance.reader(
+                self.opt_values.get('perf_url', performance.DEFAULT_URL))
+        return scheduler.priority_dispatcher(self.control, predictor)
+
     def _discover_runner_class(self, num_process, par_type):
         if num_process == 0:
             return Runner
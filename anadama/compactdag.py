@@ -0,0 +1,162 @@
+"""A DAG backend for pipelines too large to fit comfortably in a
+networkx.DiGraph. Nodes get integer ids and edges are kept in
+CSR-style parent and child arrays, so the graph costs a few machine
+words per edge instead of a dict per edge.
+
+Only the parts of the networkx.DiGraph interface that anadama uses are
+implemented.
+"""
+
+from array import array
+from itertools import izip
+from collections import deque
+
+
+def intern_paths(nodes):
+    """Make every node's targets and deps share one string object per
+    distinct file path. The sets are swapped for tuples, which are a
+    fraction of the size."""
+    pool = dict()
+    for node in nodes:
+        node.targets = tuple([ pool.setdefault(p, p) for p in node.targets ])
+        node.deps = tuple([ pool.setdefault(p, p) for p in node.deps ])
+    return nodes
+
+
+def _csr(n_nodes, srcs, dsts):
+    """Pack the edges ``srcs[i] -> dsts[i]`` into offset and index
+    arrays such that the neighbors of node ``n`` are
+    ``idx[ptr[n]:ptr[n+1]]``"""
+    ptr = array('l', [0])*(n_nodes+1)
+    for src in srcs:
+        ptr[src+1] += 1
+    for i in xrange(n_nodes):
+        ptr[i+1] += ptr[i]
+    fill = ptr[:-1]
+    idx = array('l', [0])*len(srcs)
+    for src, dst in izip(srcs, dsts):
+        idx[fill[src]] = dst
+        fill[src] += 1
+    return ptr, idx
+
+
+class CompactDag(object):
+    """Immutable-shape DAG with integer node ids. Removing nodes only
+    marks them dead; edges to dead nodes are skipped on lookup."""
+
+    def __init__(self, nodes, edges):
+        self._nodes = list()
+        self._ids = dict()
+        parent_ids, child_ids = array('l'), array('l')
+        for parent, child in edges:
+            parent_ids.append(self._id_for(parent))
+            child_ids.append(self._id_for(child))
+        for node in nodes:
+            self._id_for(node)
+
+        n = len(self._nodes)
+        self._child_ptr, self._children = _csr(n, parent_ids, child_ids)
+        self._parent_ptr, self._parents = _csr(n, child_ids, parent_ids)
+
+        self._alive = bytearray([1])*n
+        self._n_alive = n
+
+
+    def _id_for(self, node):
+        node_id = self._ids.get(node)
+        if node_id is None:
+            node_id = self._ids[node] = len(self._nodes)
+            self._nodes.append(node)
+        return node_id
+
+
+    def _live(self, ids):
+        return [ self._nodes[i] for i in ids if self._alive[i] ]
+
+
+    def _node_id(self, node):
+        node_id = self._ids.get(node)
+        if node_id is None or not self._alive[node_id]:
+            raise KeyError("Node %s is not in the graph"%(node,))
+        return node_id
+
+
+    def __contains__(self, node):
+        node_id = self._ids.get(node)
+        return node_id is not None and bool(self._alive[node_id])
+
+
+    def __iter__(self):
+        return iter(self._live(xrange(len(self._nodes))))
+
+
+    def __len__(self):
+        return self._n_alive
+
+
+    def nodes(self):
+        return list(self)
+
+
+    def number_of_nodes(self):
+        return self._n_alive
+
+
+    def number_of_edges(self):
+        return sum(1 for i in xrange(len(self._nodes)) if self._alive[i]
+                   for j in self._child_ids(i) if self._alive[j])
+
+
+    def _child_ids(self, node_id):
+        return self._children[self._child_ptr[node_id]:
+                              self._child_ptr[node_id+1]]
+
+
+    def _parent_ids(self, node_id):
+        return self._parents[self._parent_ptr[node_id]:
+                             self._parent_ptr[node_id+1]]
+
+
+    def predecessors(self, node):
+        return self._live(self._parent_ids(self._node_id(node)))
+
+
+    def successors(self, node):
+        return self._live(self._child_ids(self._node_id(node)))
+
+
+    def remove_nodes_from(self, nodes):
+        for node in nodes:
+            node_id = self._ids.get(node)
+            if node_id is not None and self._alive[node_id]:
+                self._alive[node_id] = 0
+                self._n_alive -= 1
+
+
+    def iter_topological(self):
+        """Kahn's algorithm over the live nodes, yielding each node as
+        soon as all of its parents have been"""
+        alive = self._alive
+        indegree = array('l', [0])*len(self._nodes)
+        for i in xrange(len(self._nodes)):
+            if alive[i]:
+                indegree[i] = sum(1 for p in self._parent_ids(i) if alive[p])
+        ready = deque(i for i in xrange(len(self._nodes))
+                      if alive[i] and not indegree[i])
+        n_sorted = 0
+        while ready:
+            node_id = ready.popleft()
+            n_sorted += 1
+            yield self._nodes[node_id]
+            for child in self._child_ids(node_id):
+                if not alive[child]:
+                    continue
+                indegree[child] -= 1
+                if not indegree[child]:
+                    ready.append(child)
+        if n_sorted != self._n_alive:
+            raise ValueError("Graph contains a cycle.")
+
+    def topological_sort(self):
+        """Returns a list, like networkx.topological_sort does."""
+        return list(self.iter_topological())
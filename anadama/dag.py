@@ -1,11 +1,12 @@
 import os.path
-from operator import add, attrgetter, itemgetter
-from collections import defaultdict
+from operator import attrgetter
+from collections import defaultdict, deque
 
 import networkx
 
 from .util import SerializableMixin
 from . import picklerunner
+from .compactdag import CompactDag, intern_paths
 
 
 TMP_FILE_DIR = "/tmp"
@@ -29,7 +30,7 @@ class DagNode(SerializableMixin):
     @property
     def _command(self):
         if self._orig_task and not self._cmd:
-            self._cmd = picklerunner.tmp(
+            self._cmd = picklerunner.cached(
                 self._orig_task, 
                 dir=TMP_FILE_DIR
             ).path
@@ -71,25 +72,11 @@ class DagNode(SerializableMixin):
 
 
 
-def item_or_list(key):
-    def getter(container_dict):
-        return container_dict.get(key, [])
-        
-    return getter
-
-
 def _search(node, idx, using):
-    set_of_hits = map(lambda x: idx.get(x, []), using(node))
-    flattened = reduce(add, set_of_hits, [])
-    return list(set(flattened)) # deduped
-
-
-targets = attrgetter("targets")
-def _map_targets_to_children(node, idx):
-    """searches for targets; all children of the current node shouldn't at
-    the same time be children of other nodes.
-    """
-    return _search(node, idx, using=targets)
+    hits = set()
+    for key in using(node):
+        hits.update(idx.get(key, ()))
+    return list(hits)
 
 
 deps = attrgetter("deps")
@@ -100,10 +87,12 @@ def _map_deps_to_parent(node, idx):
     return _search(node, idx, using=deps)
 
 
-def taskiter(nodes, idx_by_dep, idx_by_tgt, root_node):
+def taskiter(nodes, idx_by_tgt, root_node):
+    """Yield ``(parent, child)`` edges in one pass over `nodes`. Every
+    edge is found from the child's side by looking up its deps in
+    `idx_by_tgt`; nodes without parents hang off of `root_node`.
+    """
     for node in nodes:
-        for child in _map_targets_to_children(node, idx_by_dep):
-            yield node, child
         parents = _map_deps_to_parent(node, idx_by_tgt)
         if parents:
             for parent in parents:
@@ -134,9 +123,17 @@ def indexby(task_list, attr, using=attrgetter):
     return idx
 
 
-def assemble(tasks, root_attrs=dict()):
+def assemble(tasks, root_attrs=dict(), compact=False):
+    """Build a DAG of :class:`DagNode` from doit tasks. Returns the
+    graph and the list of nodes (without the root node).
+
+    :keyword compact: Boolean; use a
+      :class:`anadama.compactdag.CompactDag` instead of a
+      networkx.DiGraph. Much lighter on memory for large pipelines.
+    """
     nodes = [ DagNode.from_doit_task(t) for t in tasks ]
-    nodes_by_dep = indexby(nodes, attr="deps")
+    if compact:
+        intern_paths(nodes)
     nodes_by_target = indexby(nodes, attr="targets")
 
     root_node = DagNode(name="root",
@@ -145,53 +142,115 @@ def assemble(tasks, root_attrs=dict()):
                         deps=list(),
                         **root_attrs)
 
-    dag = networkx.DiGraph()
-    dag.add_edges_from(
-        taskiter(nodes, nodes_by_dep, nodes_by_target, root_node))
+    edges = taskiter(nodes, nodes_by_target, root_node)
+    if compact:
+        dag = CompactDag([root_node], edges)
+    else:
+        dag = networkx.DiGraph()
+        dag.add_edges_from(edges)
     return dag, nodes
 
 
+def topological_sort(dag):
+    """Topologically sort either a networkx.DiGraph or a CompactDag"""
+    if hasattr(dag, "topological_sort"):
+        return dag.topological_sort()
+    return networkx.algorithms.dag.topological_sort(dag)
+
+
+def iter_topological_sort(dag):
+    """Like :func:`topological_sort`, but yields nodes as they're
+    sorted instead of building the whole list first. Holds one
+    in-degree count per node."""
+    if hasattr(dag, "iter_topological"):
+        for node in dag.iter_topological():
+            yield node
+        return
+    indegree = dag.in_degree()
+    ready = deque( node for node, n in indegree.iteritems() if not n )
+    n_sorted = 0
+    while ready:
+        node = ready.popleft()
+        n_sorted += 1
+        yield node
+        for child in dag.successors(node):
+            indegree[child] -= 1
+            if not indegree[child]:
+                ready.append(child)
+    if n_sorted != len(indegree):
+        raise networkx.NetworkXUnfeasible("Graph contains a cycle.")
+
+
 def prune(dag, nodes_to_prune):
     """Remove `nodes_to_prune` from `dag`, making sure that children of
-    the pruned node are not removed"""
-
-    prune_set = set(nodes_to_prune)
-    while True:
-        try:
-            node = prune_set.pop()
-        except KeyError:
-            break
+    the pruned node are not removed.
 
+    Nodes are decided in a single sweep in topological order: a node
+    is removed if it's in `nodes_to_prune` and every one of its parents
+    was removed or is the root. Anything downstream of a task that has
+    to run stays in the graph.
+    """
+    order = topological_sort(dag)
+    position = dict( (node, i) for i, node in enumerate(order) )
+    uptodate = bytearray(len(order))
+    for node in nodes_to_prune:
+        i = position.get(node)
+        if i is not None:
+            uptodate[i] = 1
+
+    # clear[i] means node i doesn't hold back its children: it was
+    # removed, or it's a root
+    clear = bytearray(len(order))
+    to_remove = list()
+    for i, node in enumerate(order):
         parents = dag.predecessors(node)
-        if all( bool(n in prune_set) for n in parents ):
-            to_remove = [node] + parents
-            map(prune_set.discard, to_remove)
-            dag.remove_nodes_from(to_remove)
+        if uptodate[i] and all( clear[position[p]] for p in parents ):
+            clear[i] = 1
+            to_remove.append(node)
+        elif not parents:
+            clear[i] = 1
 
+    dag.remove_nodes_from(to_remove)
     return dag
 
 
 def filter_tree(task_dicts, filters, hash_key="name"):
-    """Drop some tasks according to the filter functions in `filters`."""
-
-    class HashDict(dict):
-        def __hash__(self):
-            return hash(self[hash_key])
-        def __eq__(self, other):
-            return self[hash_key] == other[hash_key]
-
-    task_dicts = [ HashDict(_normalize(task_dict)) for task_dict in task_dicts ]
-    dag = _assemble_task_dicts(task_dicts)
-    task_dicts = set(task_dicts)
-    while task_dicts:
-        task_dict = task_dicts.pop() 
-        if any( filter_(task_dict) for filter_ in filters ):
-            if task_dict in dag:
-                successors = dag.successors(task_dict)
-                dag.remove_nodes_from([task_dict]+successors)
-                map(task_dicts.remove, successors)
-        else:
-            yield task_dict
+    """Drop some tasks according to the filter functions in `filters`,
+    along with every task downstream of a dropped task.
+
+    Producers can come after their consumers in `task_dicts`, so the
+    task dicts are read once to index them by file_dep. The descendant
+    closure of every filtered task is then marked in one traversal, and
+    the surviving task dicts are yielded lazily in their original order.
+    Task dicts with a repeated `hash_key` are yielded only once.
+    """
+
+    task_dicts = [ _normalize(task_dict) for task_dict in task_dicts ]
+    by_dep = defaultdict(list)
+    for i, task_dict in enumerate(task_dicts):
+        for dep in task_dict['file_dep']:
+            by_dep[dep].append(i)
+
+    skip = bytearray(len(task_dicts))
+    to_visit = [ i for i, task_dict in enumerate(task_dicts)
+                 if any( filter_(task_dict) for filter_ in filters ) ]
+    for i in to_visit:
+        skip[i] = 1
+    while to_visit:
+        i = to_visit.pop()
+        for target in task_dicts[i]['targets']:
+            for child in by_dep.get(target, ()):
+                if not skip[child]:
+                    skip[child] = 1
+                    to_visit.append(child)
+    del by_dep
+
+    seen = set()
+    for i, task_dict in enumerate(task_dicts):
+        if skip[i] or task_dict[hash_key] in seen:
+            continue
+        seen.add(task_dict[hash_key])
+        yield task_dict
 
 
 def _normalize(task_dict):
@@ -204,12 +263,3 @@ def _normalize(task_dict):
 
     return task_dict
 
-
-def _assemble_task_dicts(task_dicts):
-    by_dep = indexby(task_dicts, attr="file_dep", using=item_or_list)
-    dag = networkx.DiGraph()
-    targets = itemgetter("targets")
-    for task_dict in task_dicts:
-        for child in _search(task_dict, by_dep, using=targets):
-            dag.add_edge(task_dict, child)
-    return dag
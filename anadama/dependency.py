@@ -0,0 +1,190 @@
+"""Cheaper file change detection for doit dependency managers.
+
+doit decides a dependency changed when its mtime moved, and then reads
+the whole file to compare md5s, on every run until the task runs again:
+a file restored from an archive or touched by a careless script is
+hashed over and over. Dependency managers made by :func:`tiered` check
+in tiers instead:
+
+1. If the mtime is unchanged, the file is unchanged. Nothing is read.
+2. If the size changed, the file changed. Nothing is read.
+3. If a digest of a few sampled blocks changed, the file changed.
+4. If the sampled blocks are the same, depending on the ``full_hash``
+   policy:
+
+   - ``never``: the file is unchanged
+   - ``always``: compare the md5 of the whole file (the default)
+
+5. If the file turned out unchanged, its new mtime is saved, so the
+   next run is back to tier 1 and reads nothing.
+
+File states are saved in doit's own ``(mtime, size, md5)`` format, so
+doit's commands can still read them. The sampled digest is saved
+alongside, under the dependency's name prefixed with SAMPLE_KEY.
+"""
+
+import os
+import hashlib
+import threading
+
+FULL_HASH_POLICIES = ("never", "always")
+SAMPLE_SIZE = 64*1024
+BLOCK_SIZE = 1024*1024
+SAMPLE_KEY = "sample:"
+
+_counter_lock = threading.Lock()
+bytes_read = 0
+
+
+def _count(n):
+    global bytes_read
+    with _counter_lock:
+        bytes_read += n
+
+
+def _sample_offsets(size, sample_size=SAMPLE_SIZE):
+    if size <= 3*sample_size:
+        return [(0, size)]
+    return [ (offset, sample_size)
+             for offset in (0, size//2, size-sample_size) ]
+
+
+def sample_digest(path, size):
+    """md5 of the first, middle and last SAMPLE_SIZE bytes of a file"""
+    md5 = hashlib.md5(str(size))
+    with open(path, 'rb') as f:
+        for offset, length in _sample_offsets(size):
+            f.seek(offset)
+            data = f.read(length)
+            _count(len(data))
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def digests(path, size):
+    """md5 of the whole file and its sampled digest, from reading it
+    once"""
+    md5, sample = hashlib.md5(), hashlib.md5(str(size))
+    samples = _sample_offsets(size)
+    pos = 0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(BLOCK_SIZE)
+            if not data:
+                break
+            _count(len(data))
+            md5.update(data)
+            end = pos + len(data)
+            for offset, length in samples:
+                lo, hi = max(offset, pos), min(offset+length, end)
+                if lo < hi:
+                    sample.update(data[lo-pos:hi-pos])
+            pos = end
+    return md5.hexdigest(), sample.hexdigest()
+
+
+def new_state(path, current=None, full_hash="always"):
+    """Return the doit state and sampled digest to save for `path`, or
+    None if `current` is still good."""
+    stat = os.stat(path)
+    if current and current[0] == stat.st_mtime:
+        return None
+    if full_hash == "never":
+        md5, sample = None, sample_digest(path, stat.st_size)
+    else:
+        md5, sample = digests(path, stat.st_size)
+    return (stat.st_mtime, stat.st_size, md5), sample
+
+
+def tiered(dep_class, full_hash="always"):
+    """Subclass doit dependency manager `dep_class` to use tiered
+    change detection with the given `full_hash` policy"""
+    if full_hash not in FULL_HASH_POLICIES:
+        raise ValueError("full_hash must be one of "
+                         +", ".join(FULL_HASH_POLICIES))
+
+    class TieredDependency(dep_class):
+        def __init__(self, *args, **kwargs):
+            dep_class.__init__(self, *args, **kwargs)
+            # doit reads straight from the backend; our _get answers
+            # for the file_dep get_status has already checked
+            self._stored = self._get
+            del self._get
+            # file_dep states each thread's get_status has checked
+            self._local = threading.local()
+
+        def new_state(self, path, current=None):
+            return new_state(path, current, self.full_hash)
+
+        def state_updates(self, task_name, path, current=None):
+            """(task_name, key, value) DB writes that save the state of
+            `path` for `task_name`, if it moved"""
+            state = self.new_state(path, current)
+            if state is None:
+                return []
+            return [ (task_name, path, state[0]),
+                     (task_name, SAMPLE_KEY+path, state[1]) ]
+
+        def save_success(self, task):
+            """Same as doit's, but saves sampled digests too"""
+            for dep in task.file_dep:
+                for update in self.state_updates(
+                        task.name, dep, self._stored(task.name, dep)):
+                    self._set(*update)
+            deps, task.file_dep = task.file_dep, set()
+            try:
+                # doit's saves the rest and skips the file_dep
+                dep_class.save_success(self, task)
+            finally:
+                task.file_dep = deps
+            self._set(task.name, 'deps:', tuple(task.file_dep))
+
+        def _check(self, task_name, path):
+            """The state of `path` for doit's get_status to compare: as
+            saved, or None if the file's known to have changed"""
+            state = self._stored(task_name, path)
+            if not state:
+                return state
+            try:
+                stat = os.stat(path)
+            except os.error:
+                return state
+            if stat.st_mtime == state[0] or stat.st_size != state[1]:
+                return state
+            recorded = self._stored(task_name, SAMPLE_KEY+path)
+            if recorded:
+                sample = sample_digest(path, stat.st_size)
+                if sample != recorded:
+                    return None
+            elif self.full_hash == "never":
+                return state
+            if self.full_hash == "never":
+                md5 = state[2]
+            else:
+                md5, sample = digests(path, stat.st_size)
+                if md5 != state[2]:
+                    return None
+            # back to nothing read next time
+            state = (stat.st_mtime, stat.st_size, md5)
+            self._set(task_name, path, state)
+            self._set(task_name, SAMPLE_KEY+path, sample)
+            return state
+
+        def _get(self, task_id, dependency):
+            checked = getattr(self._local, "checked", {})
+            if dependency in checked:
+                return checked[dependency]
+            return self._stored(task_id, dependency)
+
+        def get_status(self, task, tasks_dict):
+            """Same as doit's, but with tiered change detection"""
+            self._local.checked = dict(
+                (dep, self._check(task.name, dep)) for dep in task.file_dep)
+            try:
+                return dep_class.get_status(self, task, tasks_dict)
+            finally:
+                self._local.checked = {}
+
+    TieredDependency.full_hash = full_hash
+    TieredDependency.__name__ = "Tiered"+dep_class.__name__
+    return TieredDependency
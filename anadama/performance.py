@@ -2,16 +2,47 @@ import re
 import os
 import sys
 import json
+import time
+import Queue
+import hashlib
+import sqlite3
+import itertools
+import threading
+from math import ceil
 from collections import namedtuple
 from os.path import basename
 
 import requests
 
+from .perfstore import PerformanceStore, is_sqlite
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 DEFAULT_URL = "http://huttenhower.sph.harvard.edu/apl"
 DEFAULT_MEM = 1024 # 1GB in MB
 DEFAULT_TIME = 2*60# 2 hrs in mins
 DEFAULT_THREADS = 1
 MESSAGE_BUNDLE_SIZE = 20
+SEND_INTERVAL = 30 # most seconds to hold performance records before sending
+SEND_TIMEOUT = 5
+SEND_TRIES = 4
+DOWN_FOR = 300 # seconds to stop trying after a batch couldn't be sent
+FINAL_TIMEOUT = 1 # seconds save() gives the last batch to be sent
+UNSPOOL_AFTER = 120 # seconds before another run sends a spooled batch
+SPOOL_PATH = os.path.join(os.path.expanduser("~"), ".anadama_perf_spool")
+UPPER_QUANTILE = 0.95
+HISTORY_SIZE = 500 # most observations to keep per kind of task
+MIN_OBSERVATIONS = 5 # fewer than this and a kind of task isn't modeled
+# columns of an observation: MB of file_dep, then what was measured.
+# Observations also note how many threads the task was given.
+OBSERVED = ("size", "mem", "cpu", "time")
+MIN_EFFICIENCY = 0.75 # least share of its CPUs a task should keep busy
+FLOOR_TTL = 7*24*3600 # seconds an escalation floor is applied at most
+INTERPRETERS = ("python", "python2", "python3", "perl", "Rscript", "R",
+                "ruby", "bash", "sh", "java", "env", "time", "nice")
 
 Prediction = namedtuple("Prediction", "mem time threads")
 
@@ -19,23 +50,117 @@ default_prediction = Prediction(DEFAULT_MEM, DEFAULT_TIME, DEFAULT_THREADS)
 
 field_set = tuple(default_prediction._fields)
 
-# TODO: perform regression with variable selection to get accurate
-#       performance predictions
+def title_hints(task):
+    """The fields of a Prediction that `task`'s title sets"""
+    if not task.title:
+        return dict()
+    return dict( (k, int(v)) for k, v in
+                 re.findall(r'([a-z]+)\s*=\s*(\d+)', task.title())
+                 if k in field_set )
+
 
 def parse_title_hints(task):
-    kwargs = dict()
-    if task.title:
-        kwargs.update([ (k, v) for k, v in
-                        re.findall(r'([a-z]+)\s*=\s*(\d+)', task.title())
-                        if k in field_set ])
-    return default_prediction._replace(**kwargs)
+    return default_prediction._replace(**title_hints(task))
+
+
+def task_kind(task):
+    """What tasks count as similar to `task`: the program its first
+    command runs, or the function its first python action calls. Tasks
+    without either are known by their name with numbers taken out."""
+    for action in task.actions:
+        cmd = getattr(action, "_action", None)
+        if isinstance(cmd, (basestring, list)):
+            words = cmd.split() if isinstance(cmd, basestring) else cmd
+            for word in map(str, words):
+                if "=" in word or word.startswith("-"):
+                    continue
+                word = basename(word)
+                if word not in INTERPRETERS:
+                    return word
+        func = getattr(action, "py_callable", None)
+        if func is not None:
+            return getattr(func, "__name__", repr(func))
+    return re.sub(r'\d+', '#', task.name)
+
+
+def quantile(values, q):
+    values = sorted(values)
+    return values[min(len(values)-1, int(q*len(values)))]
+
+
+def speedup(fraction, threads):
+    """Amdahl's law: how many times faster a task whose parallel
+    fraction is `fraction` runs with `threads` threads than with one"""
+    return 1./((1-fraction) + fraction/threads)
+
+
+def busy(cpu_hrs, minutes):
+    """How many CPUs a task kept busy on average"""
+    return cpu_hrs/(minutes/60.) if minutes > 0 else 0.
+
+
+def used_threads(threads, busy):
+    """How many threads a task given `threads` threads ran, judging by
+    it keeping `busy` CPUs busy: more than it was given if it sized
+    itself to the host"""
+    return max(threads, int(ceil(busy)))
+
+
+def parallel_fraction(threads, busy):
+    """The parallel fraction of a task that kept `busy` CPUs busy on
+    average, CPU hours over wall hours, when running `threads` threads.
+    None if one thread says nothing about it."""
+    if threads <= 1:
+        return None
+    busy = min(max(busy, 1.), threads)
+    return (1 - 1./busy) / (1 - 1./threads)
+
+
+def best_threads(fraction, most):
+    """The most threads, up to `most`, that a task with parallel
+    fraction `fraction` keeps at least MIN_EFFICIENCY busy"""
+    best = 1
+    for threads in range(2, most+1):
+        if speedup(fraction, threads)/threads < MIN_EFFICIENCY:
+            break
+        best = threads
+    return best
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+
+def input_size(task):
+    """Total MB of the files `task` depends on that are there"""
+    total = 0
+    for f in task.file_dep:
+        try:
+            total += os.stat(f).st_size
+        except OSError:
+            pass
+    return total/1024./1024
+
+
+def fit(xs, ys, q=UPPER_QUANTILE):
+    """Fit ys = a + b*xs by least squares. Returns a, b and the `q`
+    quantile of the residuals, the margin to add to a prediction for
+    it to cover that share of what's been seen."""
+    xs, ys = numpy.asarray(xs, dtype=float), numpy.asarray(ys, dtype=float)
+    design = numpy.vstack([numpy.ones(len(xs)), xs]).T
+    (a, b), _, _, _ = numpy.linalg.lstsq(design, ys, rcond=-1)
+    return a, b, quantile(ys - (a + b*xs), q)
 
 
 def hash_n_size(files_list):
-    return [
-        (str(hash(basename(f))), os.stat(f).st_size/1024./1024)
-        for f in files_list
-    ]
+    ret = list()
+    for f in files_list:
+        try:
+            ret.append((str(hash(basename(f))), os.stat(f).st_size/1024./1024))
+        except OSError:
+            pass
+    return ret
 
 
 class DummyPerformancePredictor(object):
@@ -44,15 +169,53 @@ class DummyPerformancePredictor(object):
     def __init__(self, url):
         self.url = url
         self.state = dict()
-        if os.path.exists(url):
+        if url and os.path.exists(url):
             with open(url) as f_in:
                 self.state = json.load(f_in)
+        # task kind -> [mem, time, when raised]
+        self.state.setdefault("floors", dict())
 
     def update(self, task, max_rss_mb, cpu_hrs, clock_hrs):
         pass
 
     def predict(self, task):
-        return parse_title_hints(task)
+        return self._floor(task, parse_title_hints(task))
+
+    def forecast(self, task):
+        """Same as :meth:`predict`, but nothing about `task` is
+        remembered. For planning a run."""
+        return self.predict(task)
+
+    def _floor(self, task, prediction):
+        floor = self._floor_of(task_kind(task))
+        if not floor:
+            return prediction
+        return prediction._replace(mem=max(prediction.mem, floor[0]),
+                                   time=max(prediction.time, floor[1]))
+
+    def upper(self, task, field):
+        """The UPPER_QUANTILE of `field`, ``mem`` in MB or ``time`` in
+        minutes, seen for tasks like `task`; None if there's nothing to
+        go on"""
+        return None
+
+    def escalated(self, task, mem, time):
+        """Remember that `task` had to be given `mem` MB and `time`
+        minutes, so tasks like it are predicted to need as much for
+        at most FLOOR_TTL seconds"""
+        self._raise_floor(task_kind(task), mem, time)
+
+    def _floor_of(self, kind):
+        floor = self.state["floors"].get(kind)
+        if not floor or len(floor) < 3 \
+           or time.time() - floor[2] > FLOOR_TTL:
+            return None
+        return floor[:2]
+
+    def _raise_floor(self, kind, mem, minutes):
+        old_mem, old_time = self._floor_of(kind) or (0, 0)
+        self.state["floors"][kind] = [max(old_mem, mem),
+                                      max(old_time, minutes), time.time()]
 
     def save(self):
         with open(self.url, 'w') as f:
@@ -60,48 +223,396 @@ class DummyPerformancePredictor(object):
 
 
 class LocalPerformancePredictor(DummyPerformancePredictor):
-    pass
+    """Learns from the recent performance of each kind of task, kept in
+    a :class:`anadama.perfstore.PerformanceStore` at `url`.
 
+    Memory, CPU hours and run time are each fit against the total size
+    of a task's file_dep by least squares, and predicted high enough to
+    cover UPPER_QUANTILE of what similar tasks have used. Kinds of
+    tasks seen fewer than MIN_OBSERVATIONS times are predicted from
+    title hints and the defaults. Without numpy, the UPPER_QUANTILE of
+    what's been seen is predicted regardless of input size.
 
-class WebPerformancePredictor(DummyPerformancePredictor):
-    def __init__(self, url):
+    How well a kind of task uses its threads, CPU hours over wall
+    hours, gives its parallel fraction by Amdahl's law. Run times are
+    fit as if on one thread, scaled by how many threads each run had,
+    and the task is given the most threads it keeps at least
+    MIN_EFFICIENCY busy, up to the number its title asks for: its
+    commands use as many as they're told to, and a task whose title
+    doesn't say is never told to use more than one.
+
+    Escalation floors only apply until MIN_OBSERVATIONS tasks of the
+    kind have run since, and the fit has what they used to go on.
+    """
+
+    def __init__(self, url, readonly=False):
         self.url = url
-        self.messages = list()
-        
+        self.store = PerformanceStore(url, readonly=readonly)
+        self._rows = dict() # task kind -> latest observations
+        self._columns = dict() # task kind -> {field: values}
+        self._models = dict() # task kind -> {field: (a, b, margin)}
+        self._fractions = dict() # task kind -> parallel fraction
+        self._updated = set()
+        self._given = dict() # task name -> threads predicted
 
     def update(self, task, max_rss_mb, cpu_hrs, clock_hrs):
-        self.messages.append({
-            "name": task.name, "max_rss_mb": max_rss_mb,
+        kind = task_kind(task)
+        threads = self._given.pop(task.name, None) \
+                  or parse_title_hints(task).threads
+        self.store.add(kind, input_size(task), max_rss_mb, cpu_hrs,
+                       clock_hrs*60, threads)
+        for cache in (self._rows, self._columns, self._models,
+                      self._fractions):
+            cache.pop(kind, None)
+        self._updated.add(kind)
+
+    def _observations(self, kind):
+        if kind not in self._rows:
+            self._rows[kind] = self.store.observations(kind, HISTORY_SIZE)
+        return self._rows[kind]
+
+    def _seen(self, task, field):
+        i = OBSERVED.index(field)
+        return [ row[i] for row in self._observations(task_kind(task)) ]
+
+    def _floor_of(self, kind):
+        floor = self.store.floor(kind)
+        if not floor:
+            return None
+        mem, minutes, raised, seen = floor
+        if time.time() - raised > FLOOR_TTL or seen >= MIN_OBSERVATIONS:
+            return None
+        return mem, minutes
+
+    def _raise_floor(self, kind, mem, minutes):
+        self.store.raise_floor(kind, mem, minutes,
+                               keep=self._floor_of(kind) is not None)
+
+    def save(self):
+        for kind in self._updated:
+            fraction = self._observed_fraction(kind)
+            if fraction is not None:
+                self.store.set_parallel_fraction(kind, fraction)
+            self.store.trim(kind, HISTORY_SIZE)
+        self._updated = set()
+
+    def _observed_fraction(self, kind):
+        fractions = list()
+        for _, _, cpu, minutes, threads in self._observations(kind):
+            b = busy(cpu, minutes)
+            fraction = parallel_fraction(used_threads(threads, b), b)
+            if fraction is not None:
+                fractions.append(fraction)
+        return median(fractions) if fractions else None
+
+    def _fraction(self, kind):
+        if kind not in self._fractions:
+            fraction = self._observed_fraction(kind)
+            if fraction is None:
+                fraction = self.store.parallel_fraction(kind)
+            self._fractions[kind] = fraction
+        return self._fractions[kind]
+
+    def fraction(self, task):
+        """The parallel fraction of tasks like `task`, from how busy
+        they kept their CPUs, or None if they've never been seen to use
+        more than one"""
+        return self._fraction(task_kind(task))
+
+    def _observed(self, kind):
+        """Each field's observed values, with run times as if on one
+        thread"""
+        if kind not in self._columns:
+            rows = self._observations(kind)
+            columns = dict( (field, [ row[i] for row in rows ])
+                            for i, field in enumerate(OBSERVED) )
+            fraction = self._fraction(kind)
+            if fraction is not None:
+                columns["time"] = [
+                    minutes*speedup(fraction, used_threads(
+                        threads, busy(cpu, minutes)))
+                    for _, _, cpu, minutes, threads in rows ]
+            self._columns[kind] = columns
+        return self._columns[kind]
+
+    def _model(self, kind):
+        if kind not in self._models:
+            columns = self._observed(kind)
+            self._models[kind] = dict(
+                (field, fit(columns["size"], columns[field]))
+                for field in OBSERVED[1:] )
+        return self._models[kind]
+
+    def estimate(self, task, threads=1):
+        """Return a dict of ``mem`` in MB, ``cpu`` in hours and ``time``
+        in minutes on `threads` threads predicted for `task`, or None if
+        there's too little to go on"""
+        kind = task_kind(task)
+        if len(self._observations(kind)) < MIN_OBSERVATIONS:
+            return None
+        columns = self._observed(kind)
+        if numpy is None:
+            ret = dict( (field, quantile(columns[field], UPPER_QUANTILE))
+                        for field in OBSERVED[1:] )
+        else:
+            size = input_size(task)
+            ret = dict()
+            for field in OBSERVED[1:]:
+                a, b, margin = self._model(kind)[field]
+                # never below what the smallest such task used
+                ret[field] = max(a + b*size + margin, min(columns[field]))
+        fraction = self._fraction(kind)
+        if fraction is not None:
+            ret["time"] /= speedup(fraction, threads)
+        return ret
+
+    def predict(self, task):
+        prediction = self.forecast(task)
+        self._given[task.name] = prediction.threads
+        return prediction
+
+    def forecast(self, task):
+        prediction = parse_title_hints(task)
+        fraction = self.fraction(task)
+        if fraction is not None:
+            # no more threads than the title tells its commands to use
+            threads = best_threads(fraction, prediction.threads)
+            # a hinted time is for the hinted number of threads
+            prediction = prediction._replace(
+                threads=threads,
+                time=int(ceil(prediction.time
+                              * speedup(fraction, prediction.threads)
+                              / speedup(fraction, threads))))
+        estimate = self.estimate(task, prediction.threads)
+        if estimate:
+            prediction = prediction._replace(
+                mem=max(1, int(ceil(estimate["mem"]))),
+                time=max(1, int(ceil(estimate["time"]))))
+        return self._floor(task, prediction)
+
+    def upper(self, task, field):
+        seen = self._seen(task, field)
+        if not seen:
+            return None
+        return quantile(seen, UPPER_QUANTILE)
+
+
+class BackgroundSender(object):
+    """Posts performance records to `url` from a background thread, in
+    batches of `batch_size` or every `interval` seconds, whichever comes
+    first, so that neither the runner nor its exit waits on the network.
+
+    Every batch is written to a file in the `spool` directory before
+    it's sent, and removed once it's been received. Batches that can't
+    be sent in SEND_TRIES tries, or that are still on their way when
+    ``close()`` stops waiting after about FINAL_TIMEOUT seconds, stay
+    there for the next run to send."""
+
+    _stop = object()
+
+    def __init__(self, url, spool=SPOOL_PATH, batch_size=MESSAGE_BUNDLE_SIZE,
+                 interval=SEND_INTERVAL):
+        self.url, self.spool = url, spool
+        self.batch_size, self.interval = batch_size, interval
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.closing = threading.Event()
+        self._down_until = 0
+        self._batches = itertools.count()
+
+
+    def put(self, record):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put(record)
+
+
+    def close(self):
+        """Send what's left, without waiting on the network for much
+        more than FINAL_TIMEOUT seconds"""
+        if self.thread is None:
+            return
+        self.closing.set()
+        self.queue.put(self._stop)
+        self.thread.join(FINAL_TIMEOUT+1)
+        if self.thread.is_alive():
+            # still waiting on the endpoint; spool what it hasn't
+            # gotten to
+            self._spool(self._drain())
+        self.thread = None
+
+
+    def _run(self):
+        batch = self._unspool()
+        deadline = time.time() + self.interval
+        while not self.closing.is_set():
+            try:
+                record = self.queue.get(
+                    timeout=max(0, deadline - time.time()))
+            except Queue.Empty:
+                record = None
+            if record is self._stop:
+                break
+            elif record is not None:
+                batch.append(self._message(*record))
+            due = time.time() >= deadline
+            if batch and (due or len(batch) >= self.batch_size):
+                self._send(batch)
+                batch = list()
+            if due:
+                deadline = time.time() + self.interval
+        batch.extend(self._drain())
+        if batch:
+            self._send(batch, final=True)
+
+
+    def _drain(self):
+        """Take every record still queued"""
+        batch = list()
+        while True:
+            try:
+                record = self.queue.get_nowait()
+            except Queue.Empty:
+                return batch
+            if record is not self._stop:
+                batch.append(self._message(*record))
+
+
+    @staticmethod
+    def _message(name, max_rss_mb, cpu_hrs, clock_hrs, targets, file_dep):
+        return {
+            "name": name, "max_rss_mb": max_rss_mb,
             "cpu_hrs": cpu_hrs, "clock_hrs": clock_hrs,
-            "targets": hash_n_size(task.targets),
-            "file_dep": hash_n_size(task.file_dep)
-        })
-        if len(self.messages) >= MESSAGE_BUNDLE_SIZE:
-            self._flush()
+            "targets": hash_n_size(targets),
+            "file_dep": hash_n_size(file_dep)
+        }
 
 
-    def _flush(self):
-        self._send(self.messages)
-        self.messages = []
+    def _send(self, batch, final=False):
+        path = self._spool(batch)
+        if self._deliver(batch, final) and path:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
 
 
-    def _send(self, perf_dicts):
+    def _deliver(self, batch, final=False):
+        if time.time() < self._down_until:
+            return False
+        tries, timeout = (1, FINAL_TIMEOUT) if final \
+                         else (SEND_TRIES, SEND_TIMEOUT)
+        for i in range(tries):
+            if i and self.closing.wait(2**i):
+                break
+            try:
+                requests.post(self.url, timeout=timeout,
+                              data=json.dumps(batch),
+                              headers={"Content-Type": "application/json"}
+                ).raise_for_status()
+                return True
+            except Exception as e:
+                error = e
+        print >> sys.stderr, "Error posting performance info: "+str(error)
+        self._down_until = time.time() + DOWN_FOR
+        return False
+
+
+    def _spool(self, batch):
+        """Write `batch` to a new file in the spool. Returns its path,
+        or None if it couldn't be written."""
+        if not batch:
+            return None
+        path = os.path.join(self.spool, "%d-%d.json"%(
+            os.getpid(), next(self._batches)))
         try:
-            requests.post(self.url, timeout=.5,
-                          data=json.dumps(perf_dicts),
-                          headers={"Content-Type": "application/json"})
-        except Exception as e:
-            print >> sys.stderr, "Error posting performance info: "+str(e)
+            if not os.path.isdir(self.spool):
+                os.makedirs(self.spool)
+            with open(path+".tmp", 'w') as f:
+                json.dump(batch, f)
+            os.rename(path+".tmp", path)
+        except (IOError, OSError) as e:
+            print >> sys.stderr, "Unable to spool performance info: "+str(e)
+            return None
+        return path
+
+
+    def _unspool(self):
+        """Take the batches earlier runs couldn't send"""
+        batch = list()
+        try:
+            names = os.listdir(self.spool)
+        except OSError:
+            return batch
+        for name in names:
+            path = os.path.join(self.spool, name)
+            if not name.endswith(".json"):
+                continue
+            taken = "%s.%d"%(path, os.getpid())
+            try:
+                # younger batches may still be on their way
+                if time.time() - os.path.getmtime(path) < UNSPOOL_AFTER:
+                    continue
+                # so that only one run sends it
+                os.rename(path, taken)
+            except OSError:
+                continue
+            with open(taken) as f:
+                try:
+                    batch.extend(json.load(f))
+                except ValueError:
+                    pass
+            os.unlink(taken)
+        return batch
+
+
+def spool_path(url):
+    """The default spool for records bound for `url`: one directory per
+    endpoint, under SPOOL_PATH"""
+    return os.path.join(SPOOL_PATH, hashlib.md5(url).hexdigest()[:12])
+
+
+class WebPerformancePredictor(DummyPerformancePredictor):
+    """Sends performance records to `url` in the background; see
+    :class:`BackgroundSender`. Records that can't be sent are kept in
+    the `spool` directory, :func:`spool_path` unless given."""
+
+    def __init__(self, url, spool=None):
+        self.url = url
+        self.state = {"floors": dict()}
+        self.sender = BackgroundSender(url, spool or spool_path(url))
+        
+
+    def update(self, task, max_rss_mb, cpu_hrs, clock_hrs):
+        # the sender looks at the files, off of the runner's thread
+        self.sender.put((task.name, max_rss_mb, cpu_hrs, clock_hrs,
+                         list(task.targets), list(task.file_dep)))
+
 
     def save(self):
-        self._flush()
+        self.sender.close()
 
 
-def new_predictor(url=DEFAULT_URL):
+def new_predictor(url=DEFAULT_URL, spool=None):
     if url.startswith('http://'):
-        return WebPerformancePredictor(url)
+        return WebPerformancePredictor(url, spool)
     elif url == "dummy":
         return DummyPerformancePredictor(url)
     else:
         return LocalPerformancePredictor(url)
 
+
+def reader(url=DEFAULT_URL):
+    """A predictor that only reads what's already saved at `url`, for
+    planning a run without recording any of it. Falls back to title
+    hints when there's nothing local to read."""
+    if url.startswith('http://') or not os.path.isfile(url):
+        return DummyPerformancePredictor(None)
+    if not is_sqlite(url):
+        return DummyPerformancePredictor(url)
+    try:
+        return LocalPerformancePredictor(url, readonly=True)
+    except sqlite3.Error:
+        return DummyPerformancePredictor(None)
@@ -0,0 +1,205 @@
+"""Keep the performance history of grid tasks in a SQLite database.
+
+Each measurement is one row, inserted as it comes in, and looked up by
+kind of task through an index, so neither starting up nor saving gets
+slower as the history grows. The database is in WAL mode, which lets
+several anadama runs read and add to the same history at once; each
+write is its own short transaction, and runs wait on each other's locks
+instead of overwriting each other.
+
+Use it through :class:`anadama.performance.LocalPerformancePredictor`::
+
+    store = PerformanceStore("perf.db")
+    store.add("bowtie2", size_mb, max_rss_mb, cpu_hrs, minutes)
+    rows = store.observations("bowtie2", 500)
+
+Floors, what tasks of a kind had to be given after running out of
+memory or time, remember when they were raised and how many
+measurements have come in since, for the predictor to decide when to
+stop applying them. The parallel fraction of each kind of task is kept
+apart from the measurements it was estimated from, so it outlives them
+being trimmed.
+
+A performance file from before the store, a JSON document with
+nothing worth keeping in it, is moved aside to ``<path>.old``.
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+SQLITE_HEADER = "SQLite format 3\0"
+BUSY_TIMEOUT = 30 # seconds to wait on another run's write lock
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS observations (
+    id INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL,
+    recorded REAL NOT NULL,
+    size REAL NOT NULL,
+    mem REAL NOT NULL,
+    cpu REAL NOT NULL,
+    time REAL NOT NULL,
+    threads INTEGER NOT NULL DEFAULT 1
+);
+CREATE INDEX IF NOT EXISTS observations_kind ON observations (kind, id);
+CREATE TABLE IF NOT EXISTS floors (
+    kind TEXT PRIMARY KEY,
+    mem INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    raised REAL NOT NULL DEFAULT 0,
+    after INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS parallelism (
+    kind TEXT PRIMARY KEY,
+    fraction REAL NOT NULL
+);
+"""
+
+# columns added since the table was first made
+ADDED_COLUMNS = (
+    ("observations", "threads", "INTEGER NOT NULL DEFAULT 1"),
+    ("floors", "raised", "REAL NOT NULL DEFAULT 0"),
+    ("floors", "after", "INTEGER NOT NULL DEFAULT 0"),
+)
+
+
+def is_sqlite(path):
+    with open(path, 'rb') as f:
+        return f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
+class PerformanceStore(object):
+    def __init__(self, path, readonly=False):
+        self.path = path
+        if readonly:
+            self._open_readonly(path)
+            return
+        if os.path.exists(path) and os.path.getsize(path) \
+           and not is_sqlite(path):
+            os.rename(path, path+".old")
+        # runners call in from several threads
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT,
+                                   check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        for table, column, spec in ADDED_COLUMNS:
+            columns = [ row[1] for row in
+                        self._db.execute("PRAGMA table_info(%s)"%(table)) ]
+            if column not in columns:
+                self._db.execute("ALTER TABLE %s ADD COLUMN %s %s"%(
+                    table, column, spec))
+
+
+    def _open_readonly(self, path):
+        """Read an existing, up to date store without changing it"""
+        if not os.path.isfile(path) or not is_sqlite(path):
+            raise sqlite3.OperationalError("%s is not a performance store"%(
+                path))
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT,
+                                   check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA query_only=ON")
+        for table, column, _ in ADDED_COLUMNS:
+            columns = [ row[1] for row in
+                        self._db.execute("PRAGMA table_info(%s)"%(table)) ]
+            if column not in columns:
+                self._db.close()
+                raise sqlite3.OperationalError(
+                    "%s needs migrating; open it for writing first"%(path))
+
+
+    def add(self, kind, size, mem, cpu, minutes, threads=1):
+        """Record one measurement of a task of kind `kind`: MB of input,
+        MB of memory, CPU hours and minutes of wall time, when given
+        `threads` threads"""
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO observations"
+                " (kind, recorded, size, mem, cpu, time, threads)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, time.time(), size, mem, cpu, minutes, threads))
+
+
+    def observations(self, kind, limit):
+        """Return the `limit` latest (size, mem, cpu, time, threads)
+        rows for `kind`, oldest first"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT size, mem, cpu, time, threads FROM observations"
+                " WHERE kind = ? ORDER BY id DESC LIMIT ?",
+                (kind, limit)).fetchall()
+        rows.reverse()
+        return rows
+
+
+    def floor(self, kind):
+        """Return the (mem, time) that tasks of kind `kind` had to be
+        given, when that was last raised, and how many measurements of
+        `kind` have been added since; or None"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT mem, time, raised, (SELECT COUNT(*) FROM observations"
+                "  WHERE kind = floors.kind AND id > floors.after)"
+                " FROM floors WHERE kind = ?", (kind,)).fetchone()
+
+
+    def _raise_floor(self, kind, mem, minutes, keep):
+        self._db.execute(
+            "INSERT OR IGNORE INTO floors (kind, mem, time) VALUES (?, 0, 0)",
+            (kind,))
+        if keep:
+            mem_sql, time_sql = "MAX(mem, ?)", "MAX(time, ?)"
+        else:
+            mem_sql, time_sql = "?", "?"
+        self._db.execute(
+            "UPDATE floors SET mem = %s, time = %s, raised = ?,"
+            " after = (SELECT IFNULL(MAX(id), 0) FROM observations)"
+            " WHERE kind = ?"%(mem_sql, time_sql),
+            (mem, minutes, time.time(), kind))
+
+
+    def raise_floor(self, kind, mem, minutes, keep=True):
+        """Make sure tasks of kind `kind` get at least `mem` MB and
+        `minutes` minutes from now on. Unless `keep` is False, they
+        also keep getting at least what they had to be given before."""
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._raise_floor(kind, mem, minutes, keep)
+            self._db.execute("COMMIT")
+
+
+    def parallel_fraction(self, kind):
+        """Return the saved parallel fraction of `kind`, or None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT fraction FROM parallelism WHERE kind = ?",
+                (kind,)).fetchone()
+        return row[0] if row else None
+
+
+    def set_parallel_fraction(self, kind, fraction):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO parallelism (kind, fraction)"
+                " VALUES (?, ?)", (kind, fraction))
+
+
+    def trim(self, kind, keep):
+        """Forget all but the `keep` latest measurements of `kind`"""
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM observations WHERE kind = ? AND id <"
+                " (SELECT MIN(id) FROM (SELECT id FROM observations"
+                "  WHERE kind = ? ORDER BY id DESC LIMIT ?))",
+                (kind, kind, keep))
+
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,26 +1,58 @@
-"""Save a task to a script for running by other programs"""
+"""Save a task to a script for running by other programs.
+
+A saved task is two files: a short launcher script, the same for every
+task, and next to it the task's pickle, compressed, at the launcher's
+path plus PAYLOAD_SUFFIX. The launcher maps the payload into memory and
+unpickles it, instead of Python compiling the pickle as one huge string
+literal each time a task starts.
+
+Scripts shared between DAG nodes and runs, from :func:`cached`, are
+kept in a directory only their user can write to, and are read back
+before they're reused.
+"""
 
 import os
 import sys
+import zlib
+import stat
+import time
+import errno
+import hashlib
 from tempfile import NamedTemporaryFile
 
 from .pickler import cloudpickle
 
+PAYLOAD_SUFFIX = ".payload"
+COMPRESS_LEVEL = 1 # payloads are read once; writing them is what adds up
+SWEEP_GRACE = 24*3600 # seconds a cached script outlives its last use
+
 template = \
 """#!{python_bin}
 
 import os
 import sys
+import zlib
+import mmap
 import cPickle as pickle
 
-the_pickle = {pickle}
+myself = os.path.abspath(__file__)
+payload = myself+"{payload_suffix}"
+
+def load():
+    with open(payload, 'rb') as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return pickle.loads(zlib.decompress(mapped))
+        finally:
+            mapped.close()
 
-task = pickle.loads(the_pickle)
+task = load()
 task.__init__(task.name, task.some_actions)
 
 def remove_myself():
-    myself = os.path.abspath(__file__)
-    os.remove(myself)
+    for path in (myself, payload):
+        if os.path.exists(path):
+            os.remove(path)
 
 def be_verbose():
     for action in task.actions:
@@ -43,10 +75,24 @@ if __name__ == '__main__':
 
 """
 
+
+def payload_path(script_path):
+    """Where the launcher at `script_path` finds its task"""
+    return script_path+PAYLOAD_SUFFIX
+
+
+def remove(script_path):
+    """Remove a saved script and its payload"""
+    for path in (script_path, payload_path(script_path)):
+        if os.path.exists(path):
+            os.unlink(path)
+
+
 class PickleScript(object):
     def __init__(self, task):
         self.task = task
         self._path = None
+        self._payload = None
 
         self.task.some_actions = self.task._actions
 
@@ -58,24 +104,38 @@ class PickleScript(object):
         else:
             return self._path
 
+    @property
+    def payload(self):
+        """The task, pickled and compressed"""
+        if self._payload is None:
+            self._payload = zlib.compress(cloudpickle.dumps(self.task),
+                                          COMPRESS_LEVEL)
+        return self._payload
+
     def save(self, path=None, to_fp=None):
         if bool(path) == bool(to_fp): # logical not xor
             raise ValueError("Need either path or to_fp")
         if path:
             self._path = path
-            with open(path, 'rb') as out_file:
+            self._save_payload()
+            with open(path, 'w') as out_file:
                 self.render(to_fp=out_file)
         elif to_fp:
             self._path = to_fp.name
+            self._save_payload()
             self.render(to_fp=to_fp)
 
-            
+    def _save_payload(self):
+        with open(payload_path(self._path), 'wb') as f:
+            f.write(self.payload)
+
     def render(self, python_bin=None, to_fp=None):
+        """The launcher script. It's the same for every task."""
         if not python_bin:
             python_bin = os.path.join(sys.prefix, "bin", "python")
         rendered = template.format(
-            python_bin = python_bin,
-            pickle     = repr(cloudpickle.dumps(self.task))
+            python_bin     = python_bin,
+            payload_suffix = PAYLOAD_SUFFIX
         )
         if not to_fp:
             return rendered
@@ -97,3 +157,75 @@ def tmp(task, chmod=0o755, *args, **kwargs):
     return script
 
         
+
+
+def cache_dir(dir="/tmp"):
+    """This user's private directory for :func:`cached` scripts under
+    `dir`, made 0700 if it isn't there. Raises OSError if it's there
+    but anyone else could write to it."""
+    path = os.path.join(dir, "anadama_scripts-%d"%(os.getuid()))
+    try:
+        os.mkdir(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() \
+       or st.st_mode & 0o077:
+        raise OSError(errno.EPERM, "Not a private directory", path)
+    return path
+
+
+def _holds(path, content):
+    try:
+        with open(path, 'rb') as f:
+            return f.read() == content
+    except IOError:
+        return False
+
+
+def cached(task, dir="/tmp", chmod=0o700):
+    """Like :func:`tmp`, but the script is named after the digest of
+    its contents, in this user's :func:`cache_dir` under `dir`.
+    Identical tasks share one script, and a task that hasn't changed
+    since a previous run reuses the script already on disk, once it's
+    been read back and found to match.
+
+    Don't run these scripts with ``-r``; other tasks may be using the
+    same file. :func:`sweep` removes the ones no run has used lately.
+    """
+    dir = cache_dir(dir)
+    script = PickleScript(task)
+    rendered = script.render()
+    digest = hashlib.sha1(rendered+script.payload).hexdigest()
+    path = os.path.join(dir, digest+"_picklerunner.py")
+    # the payload goes first: a launcher on disk always has one
+    for dest, content, mode in (
+            (payload_path(path), script.payload, 0o600),
+            (path, rendered, chmod)):
+        if _holds(dest, content):
+            os.utime(dest, None)
+            continue
+        with NamedTemporaryFile(delete=False, dir=dir,
+                                suffix=".tmp") as tmp_file:
+            tmp_file.write(content)
+        os.chmod(tmp_file.name, mode)
+        os.rename(tmp_file.name, dest)
+    script._path = path
+    return script
+
+
+def sweep(dir="/tmp", keep=(), grace=SWEEP_GRACE):
+    """Remove the :func:`cached` scripts under `dir` that aren't in
+    `keep` and haven't been written or reused in `grace` seconds"""
+    dir = cache_dir(dir)
+    keep = set(keep)
+    keep.update([ payload_path(path) for path in keep ])
+    cutoff = time.time() - grace
+    for name in os.listdir(dir):
+        path = os.path.join(dir, name)
+        try:
+            if path not in keep and os.path.getmtime(path) < cutoff:
+                os.unlink(path)
+        except OSError:
+            pass
@@ -1,35 +1,330 @@
 import os
 import re
+import sys
 import time
+import pipes
+import getpass
 import tempfile
-import operator
 import itertools
+import threading
 import subprocess
-from math import exp
+from collections import deque, Counter
+from multiprocessing.pool import ThreadPool
 
-from doit.exceptions import CatchedException
-from doit.runner import MThreadRunner
+from doit.exceptions import CatchedException, InvalidCommand
+from doit.runner import MThreadRunner, Hold
 
 from .. import picklerunner, performance
 from ..util import dict_to_cmd_opts, partition, intatleast1
+from .journal import GridJournal
+from .visibility import TargetWaiter
+from .visibility import DEFAULT_DEADLINE as DEFAULT_TARGET_WAIT
+from .throttle import SubmitThrottle
+from .probes import ProbeCache, DEFAULT_PATH, DEFAULT_TTL
+
+
+mem_units = {"K": 1/1024., "M": 1, "G": 1024, "T": 1024*1024}
+
+SUBMIT_MODES = ("sync", "async")
+MISSING_POLLS_ALLOWED = 3
+LOST = -1 # exit status for jobs that left the queue without one
+ACCOUNTING_TRIES = 3 # times to look for a job's accounting mid-run
+SLOW_TARGETS = 5 # seconds; report tasks whose targets took this long
+
+# Why the scheduler killed a job
+OOM, TIMEOUT = "out of memory", "out of time"
+MEM_GROWTH = 1.5 # least to multiply memory by after running out
+TIME_GROWTH = 2  # least to multiply time by after running out
+USED_MEM_MARGIN = 1.3 # ask for this much more than a killed job used
+
+
+class GridJob(object):
+    """A task submitted to the grid in async mode. Nobody waits on the
+    submitting process; the job itself writes its exit status to
+    `status_path` when it's done, and its stdout and stderr to
+    `out_path` and `err_path`.
+
+    Pass `base` and `script` to pick up a job an earlier run submitted.
+    """
+
+    def __init__(self, node, tmpdir, mem, time, threads, tries=1,
+                 base=None, script=None):
+        self.node = node
+        self.task = node.task
+        self.mem, self.time, self.threads = mem, time, threads
+        self.tries = tries
+        if base is None:
+            base = tempfile.mktemp(dir=tmpdir, prefix="anadama_job")
+        if script is None:
+            script = picklerunner.tmp(self.task, dir=tmpdir).path
+        self.base = base
+        self.out_path = base+".out"
+        self.err_path = base+".err"
+        self.status_path = base+".status"
+        self.wrapper_path = base+".sh"
+        self.script = script
+        self.launcher = ""
+        self.job_id = None   # what we call the job
+        self.grid_id = None  # what the scheduler's queue listing calls it
+        self.group = None    # GridArray or GridBundle, if any
+        self.cmd = None
+        self.missed_polls = 0
+        self.reattached = False
+        self.done_at = None # when we first saw its status file
+
+    @property
+    def command(self):
+        """Shell command for the grid job to run"""
+        return "%s %s -r; echo $? > %s" %(
+            self.launcher, self.script, pipes.quote(self.status_path))
+
+    def write_wrapper(self, redirect=False):
+        """Save `command` to a shell script, sparing us from quoting it
+        through each scheduler's command line. Returns the script's
+        path. With `redirect`, the script sends its own stdout and
+        stderr to `out_path` and `err_path`."""
+        with open(self.wrapper_path, 'w') as f:
+            f.write("#!/bin/sh\n")
+            if redirect:
+                f.write("exec >%s 2>%s\n"%(pipes.quote(self.out_path),
+                                            pipes.quote(self.err_path)))
+            f.write(self.command+"\n")
+        os.chmod(self.wrapper_path, 0o755)
+        return self.wrapper_path
+
+    def exit_status(self):
+        try:
+            with open(self.status_path) as f:
+                return int(f.read().strip())
+        except (IOError, ValueError):
+            return None
 
-
-sigmoid = lambda t: 1/(1-exp(-t))
-first = operator.itemgetter(0)
+    def collect_output(self):
+        """Read and remove the job's output files. Returns stdout and
+        stderr as strings."""
+        ret = list()
+        for path in (self.out_path, self.err_path):
+            try:
+                with open(path) as f:
+                    ret.append(f.read())
+            except IOError:
+                ret.append(str())
+        for path in (self.out_path, self.err_path, self.status_path,
+                     self.wrapper_path):
+            if os.path.exists(path):
+                os.unlink(path)
+        picklerunner.remove(self.script)
+        return ret
+
+
+class JobGroup(object):
+    """Several GridJobs submitted to the grid as one job. Each member
+    still writes its own status, stdout and stderr files."""
+
+    # whether the scheduler's accounting for the group is also
+    # accounting for each member
+    accountable = True
+    prefix = "anadama_group"
+
+    def __init__(self, jobs, tmpdir):
+        self.jobs = jobs
+        self.base = base = tempfile.mktemp(dir=tmpdir, prefix=self.prefix)
+        self.manifest_path = base+".manifest"
+        self.wrapper_path = base+".sh"
+        self.remaining = len(jobs)
+        for job in jobs:
+            job.group = self
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def member_done(self):
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.cleanup()
+
+    def cleanup(self):
+        for path in (self.manifest_path, self.wrapper_path):
+            if os.path.exists(path):
+                os.unlink(path)
+
+
+class GridArray(JobGroup):
+    """GridJobs with the same resource request, submitted as one job
+    array. Array index i (counting from 1) runs the wrapper script on
+    line i of the manifest.
+    """
+
+    prefix = "anadama_array"
+
+    def __init__(self, jobs, tmpdir):
+        super(GridArray, self).__init__(jobs, tmpdir)
+        self.mem, self.time, self.threads = \
+            jobs[0].mem, jobs[0].time, jobs[0].threads
+
+    def write_wrapper(self, index_var):
+        """Write the manifest and the script every array index runs.
+        `index_var` is the environment variable the scheduler puts the
+        array index in. Returns the script's path."""
+        with open(self.manifest_path, 'w') as f:
+            for job in self.jobs:
+                f.write(job.write_wrapper(redirect=True)+"\n")
+        with open(self.wrapper_path, 'w') as f:
+            f.write('#!/bin/sh\nexec "$(sed -n "${%s}p" %s)"\n'%(
+                index_var, pipes.quote(self.manifest_path)))
+        os.chmod(self.wrapper_path, 0o755)
+        return self.wrapper_path
+
+
+class GridBundle(JobGroup):
+    """Short GridJobs run one after the other in a single grid job,
+    so they pay for one queue wait between them. Quacks enough like a
+    GridJob to go through a runner's ``_grid_submit``.
+    """
+
+    accountable = False
+    prefix = "anadama_bundle"
+
+    def __init__(self, jobs, tmpdir):
+        super(GridBundle, self).__init__(jobs, tmpdir)
+        self.mem = max(job.mem for job in jobs)
+        self.threads = max(job.threads for job in jobs)
+        self.time = sum(job.time for job in jobs)
+        self.out_path = self.err_path = os.devnull
+
+    @property
+    def launcher(self):
+        return self.jobs[0].launcher
+
+    @launcher.setter
+    def launcher(self, value):
+        for job in self.jobs:
+            job.launcher = value
+
+    def write_wrapper(self):
+        with open(self.wrapper_path, 'w') as f:
+            f.write("#!/bin/sh\n")
+            for job in self.jobs:
+                f.write(job.write_wrapper(redirect=True)+"\n")
+        os.chmod(self.wrapper_path, 0o755)
+        return self.wrapper_path
+
+
+class ReattachedGroup(JobGroup):
+    """The members of a job array or bundle that an earlier run left on
+    the grid. Only there to clean up after the group and to say whether
+    it's accountable."""
+
+    def __init__(self, base, remaining, accountable):
+        self.jobs = list()
+        self.base = base
+        self.manifest_path = base+".manifest"
+        self.wrapper_path = base+".sh"
+        self.remaining = remaining
+        self.accountable = accountable
+
+    def add(self, job):
+        self.jobs.append(job)
+        job.group = self
+
+
+def size_mb(size):
+    """Memory sizes as schedulers print them, like 1024K, 1.5G, 1.190GB
+    or 0.000B, in MB. Bare numbers are bytes."""
+    match = re.match(r'^([\d.]+(?:e[-+]?\d+)?)\s*([KMGT]?)(?:i?B)?$',
+                     size.strip(), re.IGNORECASE)
+    if not match:
+        raise ValueError("Unrecognized memory size: "+repr(size))
+    number, unit = match.groups()
+    if unit:
+        return float(number) * mem_units[unit.upper()]
+    return float(number)/1024/1024
+
+
+def seconds(duration):
+    """Durations like 12.5s or 12.5, in seconds"""
+    return float(duration.strip().rstrip("sS") or 0)
+
+
+def pack_bundles(jobs, budget):
+    """Split `jobs` into lists, in order, whose predicted times add up
+    to no more than `budget` minutes each"""
+    bundle, total = list(), 0
+    for job in jobs:
+        if bundle and total+job.time > budget:
+            yield bundle
+            bundle, total = list(), 0
+        bundle.append(job)
+        total += job.time
+    if bundle:
+        yield bundle
 
 
 class GridRunner(MThreadRunner):
+    # Environment variable holding a job array index; runners that
+    # can't do job arrays leave this as None
+    array_index_var = None
+    # How to name array member `index` of array job `id` to the
+    # scheduler's accounting tools
+    array_member_fmt = "{0}.{1}"
+    max_array_size = 1000
+    # Whether the scheduler still knows our job ids after we exit, so
+    # that a journal can reattach to them
+    persistent_ids = True
+    # What the scheduler says when it kills a job for running out of
+    # memory or time, and how many KB of memory it says the job used
+    oom_re = None
+    timeout_re = None
+    used_mem_re = None
+    # How many job ids to ask ``_jobstats`` about at once. Accounting
+    # is collected in the background whenever this many jobs are
+    # waiting for it.
+    jobstats_batch = 100
+
     def __init__(self, partition,
                  performance_url=None,
                  tmpdir="/tmp",
                  extra_grid_args="",
                  *args, **kwargs):
+        self.submit_mode = kwargs.pop("submit_mode", "sync")
+        self.poll_interval = kwargs.pop("poll_interval", 10)
+        self.min_array_size = kwargs.pop("min_array_size", 2)
+        self.bundle_under = kwargs.pop("bundle_under", 0)
+        self.bundle_budget = kwargs.pop("bundle_budget", 60)
+        journal_path = kwargs.pop("journal_path", None)
+        self.accounting_workers = kwargs.pop("accounting_workers", 4)
+        self.max_retries = kwargs.pop("max_retries", 3)
+        spool = kwargs.pop("perf_spool", None)
+        self.target_waiter = TargetWaiter(
+            kwargs.pop("target_wait", DEFAULT_TARGET_WAIT))
+        self.throttle = SubmitThrottle(
+            max_queued=kwargs.pop("max_queued", None),
+            max_pending=kwargs.pop("max_pending", None),
+            per_second=kwargs.pop("submit_rate", None),
+            mem_budget=kwargs.pop("mem_budget", None))
+        self.probes = ProbeCache(kwargs.pop("probe_cache", DEFAULT_PATH),
+                                 kwargs.pop("probe_ttl", DEFAULT_TTL))
         super(GridRunner, self).__init__(*args, **kwargs)
         self.partition = partition
         self.tmpdir = tmpdir
-        self.performance_predictor = performance.new_predictor(performance_url)
+        self.performance_predictor = performance.new_predictor(
+            performance_url, spool)
         self.extra_grid_args = extra_grid_args
-        self.id_task_map = dict()
+        self.id_task_map = dict() # job id -> task, awaiting accounting
+        self._accounting = dict() # job id -> task, being collected
+        self._accounting_tries = dict()
+        self._accounting_batches = list()
+        self._accounting_lock = threading.RLock()
+        self._accounting_pool = None
+        self.journal = None
+        # every job we might want accounting for started after this
+        self.accounting_since = time.time()
+        if journal_path and self.persistent_ids:
+            self.journal = GridJournal(journal_path)
+            self.accounting_since = self.journal.since
+        self._reattached_groups = dict() # group base -> ReattachedGroup
+        self._listing_failed = False
+        self.target_latency = dict() # task name -> seconds
 
 
     def execute_task(self, task):
@@ -40,46 +335,441 @@ class GridRunner(MThreadRunner):
 
         maybe_exc, task_id = self._grid_execute_task(task, perf)
         if task_id:
-            self.id_task_map[task_id] = task
+            if self.journal:
+                self.journal.done(task_id, task.name, 0)
+            self._job_accountable(task_id, task)
 
         return maybe_exc
 
 
     def finish(self):
-        for task, (max_rss_mb, cpu_hrs, clock_hrs) in self._grid_summarize():
-            self.performance_predictor.update(task, max_rss_mb,
-                                              cpu_hrs, clock_hrs)
+        with self._accounting_lock:
+            self._account()
+            self._drain_accounting(wait=True)
+        if self._accounting_pool:
+            self._accounting_pool.close()
+            self._accounting_pool.join()
         self.performance_predictor.save()
+        if self.journal:
+            self.journal.compact()
+        summary = self.target_waiter.summary()
+        if summary:
+            print >> sys.stderr, "Target visibility:\n  "+"\n  ".join(summary)
+        held = self.throttle.summary()
+        if held:
+            print >> sys.stderr, held
         return super(GridRunner, self).finish()
+
+
+    def queue_depth(self):
+        """Return how many of our jobs are on the grid, how many of
+        those are running, and how many MB of memory they ask for"""
+        return self.throttle.depth()
     
 
     def _grid_execute_task(self, task, perf_obj):
         keep_going, maybe_exc, tries = True, None, 1
         mem, time, threads = map(intatleast1, perf_obj)
         task_id = None
-        while keep_going:
-            keep_going, maybe_exc = False, None
-            cmd, (out, err, retcode) = self._grid_communicate(
-                task, self.partition, 
-                mem, time, 
-                threads=threads, 
-                tmpdir=self.tmpdir,
-                extra_grid_args=self.extra_grid_args)
-            if retcode:
-                packed = self._handle_grid_fail(cmd, out, err,
-                                                retcode, tries, mem, time)
-                maybe_exc, keep_going, mem, time = packed
-            else:
-                task_id = self._find_job_id(out, err)
+        # one script for every try; a job killed for running out of
+        # memory or time never gets to remove it itself
+        script = picklerunner.tmp(task, dir=self.tmpdir).path
+        try:
+            while keep_going:
+                keep_going, maybe_exc = False, None
+                self.throttle.acquire(mem)
+                self.throttle.pace()
+                try:
+                    cmd, (out, err, retcode) = self._grid_communicate(
+                        task, script, self.partition,
+                        mem, time,
+                        threads=threads,
+                        tmpdir=self.tmpdir,
+                        extra_grid_args=self.extra_grid_args)
+                finally:
+                    self.throttle.release(mem)
+                if retcode:
+                    packed = self._handle_grid_fail(task, cmd, out, err,
+                                                    retcode, tries, mem, time)
+                    maybe_exc, keep_going, mem, time = packed
+                    tries += 1
+                else:
+                    task_id = self._find_job_id(out, err)
+                    self._wait_for_targets(task)
+        finally:
+            picklerunner.remove(script)
         return maybe_exc, task_id
 
 
+    def run_tasks(self, task_dispatcher):
+        self._check_partition()
+        if self.journal:
+            self._journal_recover(task_dispatcher.tasks)
+        if self.submit_mode == "async":
+            return self._run_tasks_async(task_dispatcher)
+        return super(GridRunner, self).run_tasks(task_dispatcher)
+
+
+    def _probe(self, question, probe):
+        """Return the scheduler's answer to `question`, from the probe
+        cache if it's fresh, or else from calling `probe`"""
+        return self.probes.get(
+            self.probes.key(type(self).__name__, question), probe)
+
+
+    def _check_partition(self):
+        """Make sure the scheduler knows every partition or queue in
+        `partition`. A cached listing that doesn't have one is asked
+        for again before giving up."""
+        names = [ name.split("@")[0]
+                  for name in re.split(r'[,\s]+', self.partition or "")
+                  if name and not re.search(r'[*?\[]', name) ]
+        known = self._probe("partitions", self._grid_partitions)
+        if not known or all(name in known for name in names):
+            return
+        self.probes.invalidate(
+            self.probes.key(type(self).__name__, "partitions"))
+        known = self._probe("partitions", self._grid_partitions)
+        unknown = [ name for name in names if name not in (known or names) ]
+        if unknown:
+            raise InvalidCommand(
+                "The grid has no partition or queue named "
+                +", ".join(unknown)+". It has "+", ".join(known))
+
+
+    def _journal_recover(self, tasks):
+        """Pick up the accounting of jobs that succeeded in a run that
+        died before its ``finish()``, and get ready to reattach to the
+        jobs it left on the grid."""
+        for job_id, name in self.journal.succeeded.iteritems():
+            if name in tasks:
+                self.id_task_map[job_id] = tasks[name]
+        self._reattach_counts = Counter(
+            r["group"] for r in self.journal.live.itervalues() if r["group"])
+
+
+    def _run_tasks_async(self, task_dispatcher):
+        """Submit jobs without waiting on them, then track all of them
+        with one batched scheduler query every `poll_interval`
+        seconds. Runs entirely in this thread."""
+        self._run_tasks_init(task_dispatcher)
+        in_flight = dict() # job id -> GridJob
+        finished = deque() # nodes the dispatcher hasn't heard about yet
+        self._held = list() # jobs waiting for room on the grid
+        exhausted = False
+        while True:
+            ready, self._held = self._held, list()
+            while not exhausted:
+                completed = finished.popleft() if finished else None
+                node = self.get_next_task(completed)
+                if node is None:
+                    exhausted = True
+                elif isinstance(node, Hold):
+                    if not finished:
+                        break
+                else:
+                    job = self._async_start(node, in_flight, finished)
+                    if job:
+                        ready.append(job)
+            taken, held = self.throttle.take(ready)
+            self._held.extend(held)
+            self._async_submit_ready(taken, in_flight, finished)
+
+            if exhausted and not in_flight and not self._held:
+                break
+            if not in_flight and not finished and not self._held:
+                # everything left is waiting on something that will
+                # never finish
+                break
+            if in_flight:
+                time.sleep(self.poll_interval)
+                self._async_poll(in_flight, finished)
+
+
+    def _async_start(self, node, in_flight, finished):
+        """Return a GridJob for `node`, or None if there's nothing to
+        submit. Jobs an earlier run left on the grid go straight into
+        `in_flight`."""
+        task = node.task
+        self.reporter.execute_task(task)
+        if not task.actions:
+            self.process_task_result(node, None)
+            finished.append(node)
+            return None
+        job = self._async_reattach(node) if self.journal else None
+        if job:
+            in_flight[job.job_id] = job
+            self.throttle.add(job.mem)
+            return None
+        perf = self.performance_predictor.predict(task)
+        mem, time, threads = map(intatleast1, perf)
+        return GridJob(node, self.tmpdir, mem, time, threads)
+
+
+    def _async_reattach(self, node):
+        """Return the GridJob that the journal says an earlier run left
+        on the grid for `node`'s task, or None. Whether it's still there
+        is left to the next poll."""
+        record = self.journal.in_flight(node.task.name)
+        if record is None:
+            return None
+        job = GridJob(node, self.tmpdir, record["mem"], record["time"],
+                      record["threads"], record["tries"],
+                      base=record["base"], script=record["script"])
+        job.job_id, job.grid_id = record["job_id"], record["grid_id"]
+        job.cmd = record["cmd"]
+        job.reattached = True
+        base = record["group"]
+        if base:
+            if base not in self._reattached_groups:
+                self._reattached_groups[base] = ReattachedGroup(
+                    base, self._reattach_counts[base], record["accountable"])
+            self._reattached_groups[base].add(job)
+        return job
+
+
+    def _async_submit_ready(self, jobs, in_flight, finished):
+        """Submit `jobs`. Jobs predicted to take less than
+        `bundle_under` minutes are bundled together; of the rest, those
+        with identical resource requests are coalesced into job arrays
+        when the runner supports them"""
+        if self.bundle_under > 0:
+            short = [ job for job in jobs if job.time < self.bundle_under ]
+            if len(short) > 1:
+                jobs = [ job for job in jobs if job.time >= self.bundle_under ]
+                for bundle in pack_bundles(short, self.bundle_budget):
+                    if len(bundle) == 1:
+                        jobs.append(bundle[0])
+                    else:
+                        self._async_submit_bundle(bundle, in_flight, finished)
+
+        if not self.array_index_var or self.min_array_size < 2:
+            for job in jobs:
+                self._async_submit(job, in_flight, finished)
+            return
+
+        groups = dict()
+        for job in jobs:
+            key = (job.mem, job.time, job.threads)
+            groups.setdefault(key, list()).append(job)
+        for job in jobs:
+            group = groups.pop((job.mem, job.time, job.threads), None)
+            if group is None:
+                continue
+            if len(group) < self.min_array_size:
+                for member in group:
+                    self._async_submit(member, in_flight, finished)
+                continue
+            for chunk in partition(group, self.max_array_size):
+                chunk = filter(bool, chunk)
+                if len(chunk) == 1:
+                    self._async_submit(chunk[0], in_flight, finished)
+                else:
+                    self._async_submit_array(chunk, in_flight, finished)
+
+
+    def _async_submit(self, job, in_flight, finished):
+        self.throttle.pace()
+        cmd, (out, err, retcode) = self._grid_submit(
+            job, self.partition, extra_grid_args=self.extra_grid_args)
+        job.cmd = cmd
+        if retcode:
+            self._async_submit_failed(job, out, err, finished)
+        else:
+            job.job_id = job.grid_id = self._find_submitted_id(out, err)
+            self._async_track(job, in_flight)
+
+
+    def _async_submit_array(self, jobs, in_flight, finished):
+        array = GridArray(jobs, self.tmpdir)
+        self.throttle.pace()
+        cmd, (out, err, retcode) = self._grid_submit_array(
+            array, self.partition, extra_grid_args=self.extra_grid_args)
+        for job in jobs:
+            job.cmd = cmd
+        if retcode:
+            array.cleanup()
+            for job in jobs:
+                job.group = None
+                self._async_submit_failed(job, out, err, finished)
+            return
+        array_id = self._find_submitted_id(out, err)
+        for i, job in enumerate(jobs, 1):
+            job.grid_id = array_id
+            job.job_id = self.array_member_fmt.format(array_id, i)
+            self._async_track(job, in_flight)
+
+
+    def _async_submit_bundle(self, jobs, in_flight, finished):
+        bundle = GridBundle(jobs, self.tmpdir)
+        self.throttle.pace()
+        cmd, (out, err, retcode) = self._grid_submit(
+            bundle, self.partition, extra_grid_args=self.extra_grid_args)
+        for job in jobs:
+            job.cmd = cmd
+        if retcode:
+            bundle.cleanup()
+            for job in jobs:
+                job.group = None
+                self._async_submit_failed(job, out, err, finished)
+            return
+        bundle_id = self._find_submitted_id(out, err)
+        for i, job in enumerate(jobs, 1):
+            job.grid_id = bundle_id
+            job.job_id = "%s+%d"%(bundle_id, i)
+            self._async_track(job, in_flight)
+
+
+    def _async_track(self, job, in_flight):
+        in_flight[job.job_id] = job
+        if self.journal:
+            self.journal.submitted(job)
+
+
+    def _async_submit_failed(self, job, out, err, finished):
+        self.throttle.release(job.mem)
+        job.collect_output()
+        exc = CatchedException("Job submission failed: "+job.cmd
+                               +"\n"+out+"\n"+err)
+        self.process_task_result(job.node, exc)
+        finished.append(job.node)
+
+
+    def _async_poll(self, in_flight, finished):
+        active = self._grid_active()
+        if active is None:
+            # the scheduler didn't answer; go by status files alone
+            # until it does, without counting anyone's missed polls
+            if not self._listing_failed:
+                print >> sys.stderr, ("Listing the grid's jobs failed;"
+                                      " retrying every poll")
+            self._listing_failed = True
+        else:
+            self._listing_failed = False
+            # the listing has everyone's jobs; only ours count here
+            ours = set( job.grid_id for job in in_flight.itervalues() )
+            self.throttle.observe(sum( n for grid_id, n in active.iteritems()
+                                       if grid_id in ours ))
+        for job_id, job in in_flight.items():
+            retcode = job.exit_status()
+            if retcode is None:
+                if active is None or job.grid_id in active:
+                    continue
+                # give shared filesystems a few polls to show the
+                # status file before calling the job lost
+                job.missed_polls += 1
+                if job.missed_polls < MISSING_POLLS_ALLOWED:
+                    continue
+                retcode = LOST
+            elif retcode == 0 and not self._targets_arrived(job):
+                continue
+            del in_flight[job_id]
+            self._async_finish(job, retcode, in_flight, finished)
+
+
+    def _async_finish(self, job, retcode, in_flight, finished):
+        task = job.task
+        self.throttle.release(job.mem)
+        out, err = job.collect_output()
+        if self.journal:
+            self.journal.done(job.job_id, task.name, retcode,
+                              job.group is None or job.group.accountable)
+        if job.group:
+            job.group.member_done()
+        if retcode == LOST and (job.reattached
+                                or isinstance(job.group, GridBundle)):
+            # the bundle ran out of time or died before getting to
+            # this job, or the job an earlier run submitted is gone;
+            # try it again on its own
+            retry = GridJob(job.node, self.tmpdir, job.mem, job.time,
+                            job.threads, job.tries)
+            return self._held.append(retry)
+        self._append_output(task, out, err)
+        if retcode == 0:
+            self._job_succeeded(job, out, err)
+            self.process_task_result(job.node, None)
+            finished.append(job.node)
+            return
+
+        maybe_exc, keep_going, mem, time = self._handle_grid_fail(
+            task, job.cmd, out, err, retcode, job.tries, job.mem, job.time,
+            job_id=None if isinstance(job.group, GridBundle) else job.job_id)
+        if keep_going:
+            retry = GridJob(job.node, self.tmpdir, mem, time,
+                            job.threads, job.tries+1)
+            return self._held.append(retry)
+        self.process_task_result(job.node, maybe_exc)
+        finished.append(job.node)
+
+
+    def _job_succeeded(self, job, out, err):
+        if job.group is None or job.group.accountable:
+            self._job_accountable(job.job_id, job.task)
+
+
+    def _job_accountable(self, job_id, task):
+        """Queue `job_id`'s accounting for collection. Every
+        `jobstats_batch` jobs, collection starts in the background."""
+        with self._accounting_lock:
+            self.id_task_map[job_id] = task
+            if len(self.id_task_map) >= self.jobstats_batch:
+                self._account()
+            self._drain_accounting()
+
+
+    def _account(self):
+        """Hand the jobs in `id_task_map` to the accounting pool, at
+        most `jobstats_batch` to a ``_jobstats`` call"""
+        if not self.id_task_map:
+            return
+        if self._accounting_pool is None:
+            self._accounting_pool = ThreadPool(self.accounting_workers)
+        ids = list(self.id_task_map)
+        self._accounting.update(self.id_task_map)
+        self.id_task_map = dict()
+        for chunk in partition(ids, self.jobstats_batch):
+            chunk = [ job_id for job_id in chunk if job_id is not None ]
+            self._accounting_batches.append(
+                self._accounting_pool.apply_async(self._grid_summarize,
+                                                  (chunk,)))
+
+
+    def _drain_accounting(self, wait=False):
+        """Feed finished accounting batches to the performance
+        predictor. Jobs the scheduler had no accounting for are tried
+        again in a later batch, up to ACCOUNTING_TRIES times. With
+        `wait`, wait for all batches and give up on missing jobs."""
+        running, accounted = list(), list()
+        for result in self._accounting_batches:
+            if not wait and not result.ready():
+                running.append(result)
+                continue
+            ids, stats = result.get()
+            by_str = dict( (str(job_id), job_id) for job_id in ids )
+            for job_id, (max_rss_mb, cpu_hrs, clock_hrs) in stats:
+                job_id = by_str.get(str(job_id))
+                task = self._accounting.pop(job_id, None)
+                if task is None:
+                    continue
+                self._accounting_tries.pop(job_id, None)
+                self.performance_predictor.update(task, max_rss_mb,
+                                                  cpu_hrs, clock_hrs)
+                accounted.append(job_id)
+            for job_id in ids:
+                task = self._accounting.pop(job_id, None)
+                if task is None:
+                    continue
+                tries = self._accounting_tries.pop(job_id, 0) + 1
+                if not wait and tries < ACCOUNTING_TRIES:
+                    self._accounting_tries[job_id] = tries
+                    self.id_task_map[job_id] = task
+        self._accounting_batches = running
+        if self.journal:
+            self.journal.accounted(accounted)
+
+
     @staticmethod
-    def _grid_popen(cmd, task):
-        proc = subprocess.Popen([cmd], shell=True,
-                                stdout=subprocess.PIPE,
-                                stderr=subprocess.PIPE)
-        out, err = proc.communicate()
+    def _append_output(task, out, err):
         if not task.actions[0].out:
             task.actions[0].out = str()
         if not task.actions[0].err:
@@ -87,81 +777,273 @@ class GridRunner(MThreadRunner):
         task.actions[0].out += out
         task.actions[0].err += err
 
-        if proc.returncode == 0:
-            for _ in range(3):
-                if all(map(os.path.exists, task.targets)):
-                    break
-                time.sleep(1)
 
+    def _wait_for_targets(self, task):
+        missing, waited = self.target_waiter.wait(task.targets)
+        self._report_targets(task, missing, waited)
+
+
+    def _targets_arrived(self, job):
+        """Whether `job`'s targets are visible here, or have had the
+        target waiter's deadline to show up. Doesn't block; the async
+        loop asks again at the next poll."""
+        now = time.time()
+        if job.done_at is None:
+            job.done_at = now
+        waited = now - job.done_at
+        missing = self.target_waiter.missing(job.task.targets)
+        if missing and waited < self.target_waiter.deadline:
+            return False
+        self._report_targets(job.task, missing, waited)
+        return True
+
+
+    def _report_targets(self, task, missing, waited):
+        self.target_latency[task.name] = waited
+        self.target_waiter.record(task.targets, waited)
+        if missing:
+            print >> sys.stderr, (
+                "Targets of task %s still not visible after %.1fs: %s"%(
+                    task.name, waited, ", ".join(missing)))
+        elif waited >= SLOW_TARGETS:
+            print >> sys.stderr, (
+                "Targets of task %s took %.1fs to become visible"%(
+                    task.name, waited))
+
+
+    @staticmethod
+    def _communicate(cmd):
+        proc = subprocess.Popen([cmd], shell=True,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        out, err = proc.communicate()
         return out, err, proc.returncode
 
 
-    def _grid_summarize(self):
-        for chunk in partition(self.id_task_map.iteritems(), 100):
-            ids, tasks = zip(*sorted(filter(bool, chunk), key=first))
-            stats = sorted(self._jobstats(ids), key=first)
-            for task, stat in zip(tasks, stats):
-                yield task, stat
+    @staticmethod
+    def _grid_popen(cmd, task):
+        out, err, retcode = GridRunner._communicate(cmd)
+        GridRunner._append_output(task, out, err)
+        return out, err, retcode
+
+
+    def _classify_fail(self, out, err, retcode):
+        """Return why the scheduler killed a job, OOM, TIMEOUT or None
+        if it didn't, and the KB of memory it says the job used"""
+        outerr = out+err
+        if self.oom_re and re.search(self.oom_re, outerr):
+            used = self.used_mem_re and re.search(self.used_mem_re, outerr)
+            return OOM, int(used.group(1)) if used else None
+        if self.timeout_re and re.search(self.timeout_re, outerr):
+            return TIMEOUT, None
+        return None, None
+
+
+    def _grid_exit_reason(self, job_id, mem):
+        """Return what the scheduler's accounting says about why job
+        `job_id`, which asked for `mem` MB, ended, as text for `oom_re`
+        and `timeout_re` to match"""
+        return ""
+
+
+    def _handle_grid_fail(self, task, cmd, out, err, retcode,
+                          tries, mem, time, job_id=None):
+        """Decide whether to try a failed job again. Jobs the scheduler
+        killed for running out of memory or time get up to
+        `max_retries` more tries, each with more of what ran out: at
+        least MEM_GROWTH or TIME_GROWTH times as much, and at least the
+        predictor's upper quantile for similar tasks. The predictor is
+        told, so the next similar task starts out with as much.
+        Jobs killed before they could write any output are looked up in
+        the scheduler's accounting by `job_id`, if given.
+
+        Returns the exception to fail with, whether to retry, and the
+        memory and time to retry with."""
+        reason, used_kb = self._classify_fail(out, err, retcode)
+        if reason is None and job_id is not None:
+            err += self._grid_exit_reason(job_id, mem)
+            reason, used_kb = self._classify_fail(out, err, retcode)
+        exc = CatchedException("Command failed with exit status %s: %s"
+                               "\n%s\n%s"%(retcode, cmd, out, err))
+        if reason is None or tries > self.max_retries:
+            return exc, False, mem, time
+        predictor = self.performance_predictor
+        if reason == OOM:
+            mem = max(mem*MEM_GROWTH, (used_kb or 0)/1024.*USED_MEM_MARGIN,
+                      predictor.upper(task, "mem") or 0)
+        else:
+            time = max(time*TIME_GROWTH, predictor.upper(task, "time") or 0)
+        mem, time = intatleast1(mem), intatleast1(time)
+        predictor.escalated(task, mem, time)
+        print >> sys.stderr, (
+            "Task %s ran %s; trying again with %d MB and %d minutes"%(
+                task.name, reason, mem, time))
+        return exc, True, mem, time
+
+
+    def _grid_summarize(self, ids):
+        """Runs on the accounting pool. Returns `ids` and the
+        accounting ``_jobstats`` found for them."""
+        try:
+            return ids, list(self._jobstats(ids))
+        except Exception as e:
+            print >> sys.stderr, "Error collecting job accounting: "+str(e)
+            return ids, list()
 
     # You'll have to implement the below methods yourself to make your
     # own grid runner
 
     @staticmethod
-    def _grid_communicate(task, partition, mem, time, 
+    def _grid_communicate(task, script, partition, mem, time, 
                           tmpdir='/tmp', threads=1, extra_grid_args=""):
+        """Run picklerunner `script` for `task` on the grid and wait for
+        it. Return the command used and its (out, err, retcode)."""
         raise NotImplementedError()
 
 
     def _find_job_id(self, out, err):
         raise NotImplementedError()
 
+    def _grid_partitions(self):
+        """Return the names of the partitions or queues jobs can go to,
+        or None if the scheduler can't say. Answers are kept in the
+        probe cache."""
+        return None
+
     def _jobstats(self, ids):
+        """Yield (job id, (max_rss_mb, cpu_hrs, clock_hrs)) for each of
+        `ids` that finished successfully and has accounting. Called from
+        the accounting pool's threads."""
         raise NotImplementedError()
 
-    @staticmethod
-    def _handle_grid_fail(cmd, out, err, retcode, tries, mem, time):
+    # These are only needed for the async submit mode
+
+    def _grid_submit(self, job, partition, extra_grid_args=""):
+        """Submit `job`, a GridJob or GridBundle, without waiting for it
+        to finish. Return the command used and its (out, err,
+        retcode)"""
+        raise NotImplementedError()
+
+    def _find_submitted_id(self, out, err):
+        raise NotImplementedError()
+
+    def _grid_active(self):
+        """Return a dict of the job ids that are still queued or
+        running to how many jobs under each id are running. Job arrays
+        are listed by the array's id. Return None if the scheduler
+        couldn't be asked."""
+        raise NotImplementedError()
+
+    def _grid_submit_array(self, array, partition, extra_grid_args=""):
+        """Submit GridArray `array` without waiting for it. Return the
+        command used and its (out, err, retcode). Only needed if
+        `array_index_var` is set."""
         raise NotImplementedError()
 
 
 class DummyGridRunner(GridRunner):
+    launcher = "/usr/bin/time -f 'TASK_PERFORMANCE %e %M %S %U'"
+    array_index_var = "ANADAMA_ARRAY_INDEX"
+    array_member_fmt = "{0}_{1}"
+    persistent_ids = False
+
     def __init__(self, *args, **kwargs):
         self.task_id_counter = itertools.count(1)
         self.task_performance_info = dict()
+        self.local_jobs = dict()
         return super(DummyGridRunner, self).__init__(*args, **kwargs)
 
 
     @staticmethod
-    def _grid_communicate(task, partition, mem, time,
+    def _grid_communicate(task, script, partition, mem, time,
                           tmpdir="/tmp", threads=1, extra_grid_args=""):
-        cmd = ( "/usr/bin/time -f 'TASK_PERFORMANCE %e %M %S %U' "
-                +picklerunner.tmp(task, dir=tmpdir).path+" -r" )
+        cmd = DummyGridRunner.launcher+" "+script
         return cmd, DummyGridRunner._grid_popen(cmd, task)
 
 
     def _find_job_id(self, out, err):
         id = next(self.task_id_counter)
+        self._record_performance(id, err)
+        return id
+
+
+    def _record_performance(self, id, err):
         c_sec, mem_k, k_sec, u_sec = map(float, re.search(
             r'TASK_PERFORMANCE ([\d.]+) ([\d.]+) ([\d.]+) ([\d.]+)',
             err).groups())
         cpu_hrs = (k_sec+u_sec)/3600
         self.task_performance_info[id] = (mem_k/1024, cpu_hrs, c_sec/3600)
-        return id
+
+
+    def _grid_submit(self, job, partition, extra_grid_args=""):
+        job.launcher = self.launcher
+        wrapper = job.write_wrapper()
+        with open(job.out_path, 'w') as out_f:
+            with open(job.err_path, 'w') as err_f:
+                proc = subprocess.Popen([wrapper], stdout=out_f,
+                                        stderr=err_f)
+        job_id = next(self.task_id_counter)
+        self.local_jobs[job_id] = [proc]
+        return wrapper, (str(job_id), "", 0)
+
+
+    def _grid_submit_array(self, array, partition, extra_grid_args=""):
+        for job in array.jobs:
+            job.launcher = self.launcher
+        wrapper = array.write_wrapper(self.array_index_var)
+        procs = list()
+        for i in range(1, len(array)+1):
+            env = dict(os.environ)
+            env[self.array_index_var] = str(i)
+            procs.append(subprocess.Popen([wrapper], env=env))
+        job_id = next(self.task_id_counter)
+        self.local_jobs[job_id] = procs
+        return wrapper, (str(job_id), "", 0)
+
+
+    def _find_submitted_id(self, out, err):
+        return int(out)
+
+
+    def _grid_active(self):
+        active = dict()
+        for job_id, procs in self.local_jobs.items():
+            running = sum( proc.poll() is None for proc in procs )
+            if running:
+                active[job_id] = running
+            else:
+                del self.local_jobs[job_id]
+        return active
+
+
+    def _job_succeeded(self, job, out, err):
+        self._record_performance(job.job_id, err)
+        super(DummyGridRunner, self)._job_succeeded(job, out, err)
 
 
     def _jobstats(self, ids):
-        return map(self.task_performance_info.__getitem__, ids)
+        for job_id in ids:
+            if job_id in self.task_performance_info:
+                yield job_id, self.task_performance_info[job_id]
 
 
-    @staticmethod
-    def _handle_grid_fail(cmd, out, err, retcode, tries, mem, time):
-        exc = CatchedException("Command failed: "+cmd+"\n"+out+"\n"+err)
-        keep_going = False
-        return exc, keep_going, int(mem), int(time)
+def slurm_hours(duration):
+    """Slurm durations, like [days-][hours:]minutes:seconds, in hours"""
+    days, _, hms = duration.rpartition("-")
+    seconds = sum( float(part)*60**i
+                   for i, part in enumerate(reversed(hms.split(":"))) )
+    return float(days or 0)*24 + seconds/3600
 
 
 class SlurmRunner(GridRunner):
+    array_index_var = "SLURM_ARRAY_TASK_ID"
+    array_member_fmt = "{0}_{1}"
+    oom_re = r"Exceeded job memory limit|oom-kill|OUT_OF_MEMORY"
+    timeout_re = r"DUE TO TIME LIMIT|\bTIMEOUT\b"
+    used_mem_re = r"memory limit \((\d+) > \d+\)"
+
     @staticmethod
-    def _grid_communicate(task, partition, mem, time,
+    def _grid_communicate(task, script, partition, mem, time,
                           tmpdir="/tmp", threads=1, extra_grid_args=""):
         opts = { "mem": mem,   
                  "time": time,
@@ -172,7 +1054,7 @@ class SlurmRunner(GridRunner):
         cmd = ( "srun -v "
                 +" "+dict_to_cmd_opts(opts)
                 +" "+extra_grid_args+" "
-                +" "+picklerunner.tmp(task, dir=tmpdir).path+" -r" )
+                +" "+script )
 
         return cmd, SlurmRunner._grid_popen(cmd, task)
 
@@ -183,77 +1065,136 @@ class SlurmRunner(GridRunner):
                          err).group(1)
 
 
+    def _grid_submit(self, job, partition, extra_grid_args=""):
+        opts = { "mem": job.mem,
+                 "time": job.time,
+                 "export": "ALL",
+                 "partition": partition,
+                 "cpus-per-task": job.threads,
+                 "output": job.out_path,
+                 "error": job.err_path }
+
+        cmd = ( "sbatch --parsable "
+                +" "+dict_to_cmd_opts(opts)
+                +" "+extra_grid_args+" "
+                +" "+job.write_wrapper() )
+        return cmd, self._communicate(cmd)
+
+
+    def _grid_submit_array(self, array, partition, extra_grid_args=""):
+        opts = { "mem": array.mem,
+                 "time": array.time,
+                 "export": "ALL",
+                 "partition": partition,
+                 "cpus-per-task": array.threads,
+                 "array": "1-%d"%(len(array)),
+                 "output": "/dev/null",
+                 "error": "/dev/null" }
+
+        cmd = ( "sbatch --parsable "
+                +" "+dict_to_cmd_opts(opts)
+                +" "+extra_grid_args+" "
+                +" "+array.write_wrapper(self.array_index_var) )
+        return cmd, self._communicate(cmd)
+
+
     @staticmethod
-    def _jobstats(ids):
-        ids = ",".join(ids)
-        def _fields():
-            proc = subprocess.Popen(
-                ["sacct",
-                 "--format", "MaxRSS,TotalCPU,Elapsed,ExitCode,State",
-                 "-P", "-j", ids],
-                stdout=subprocess.PIPE)
-            for line in proc.stdout:
-                fields = line.strip().split("|")
-                if any((fields[-1] != "COMPLETED", fields[4] != "0:0")):
-                    continue
-                yield fields[:-2]
-            proc.wait()
+    def _find_submitted_id(out, err):
+        # --parsable prints jobid[;cluster]
+        return out.strip().split(";")[0]
 
-        for rss, cputime, clocktime in _fields():
-            rss = float(rss.replace("K", ""))/1024,
-            clockparts = map(float, clocktime.split(":"))
-            clocktime = clockparts[0] + clockparts[1]/60 + clockparts[2]/3600
-            cpuparts = map(float, cputime.split(":"))
-            cputime = cpuparts[0] + cpuparts[1]/60 + cpuparts[2]/3600
-            yield rss, cputime, clocktime
-                    
 
     @staticmethod
-    def _handle_grid_fail(cmd, out, err, retcode, tries, mem, time):
-        exc = CatchedException("srun command failed: "+cmd
-                               +"\n"+out+"\n"+err)
-        keep_going = False
-        outerr = out+err
-        if "Exceeded job memory limit" in outerr:
-            used = re.search(r'memory limit \((\d+) > \d+\)', outerr).group(1)
-            mem = int(used)/1024 * (1.3**tries)
-            keep_going = True
-        if re.search(r"due to time limit", outerr, re.IGNORECASE):
-            time = time * (sigmoid(tries/10.)*2.7)
-            keep_going = True
+    def _grid_active():
+        # array members show up as jobid_index or jobid_[range]
+        out, _, retcode = GridRunner._communicate(
+            "squeue -h -o '%i %T' -u "+getpass.getuser())
+        if retcode:
+            return None
+        active = Counter()
+        for job_id, state in map(str.split, out.splitlines()):
+            active[job_id.split("_")[0]] += state in ("RUNNING",
+                                                      "COMPLETING")
+        return active
+
+
+    @staticmethod
+    def _jobstats(ids):
+        out, _ = subprocess.Popen(
+            ["sacct", "--noheader", "-P",
+             "--format", "JobID,MaxRSS,TotalCPU,Elapsed,ExitCode,State",
+             "-j", ",".join(map(str, ids))],
+            stdout=subprocess.PIPE).communicate()
+        # MaxRSS is reported on a job's steps, the rest on the job
+        rss, done = dict(), dict()
+        for line in out.splitlines():
+            fields = line.strip().split("|")
+            if len(fields) != 6:
+                continue
+            job_id, maxrss, cputime, clocktime, exitcode, state = fields
+            job_id, _, step = job_id.partition(".")
+            try:
+                if maxrss:
+                    rss[job_id] = max(rss.get(job_id, 0), size_mb(maxrss))
+                if not step and state == "COMPLETED" and exitcode == "0:0":
+                    done[job_id] = (slurm_hours(cputime),
+                                    slurm_hours(clocktime))
+            except ValueError as e:
+                print >> sys.stderr, "Skipping accounting for job %s: %s"%(
+                    job_id, e)
+
+        for job_id, (cputime, clocktime) in done.iteritems():
+            yield job_id, (rss.get(job_id, 0), cputime, clocktime)
+
+
+    def _grid_exit_reason(self, job_id, mem):
+        # the job's State, like OUT_OF_MEMORY or TIMEOUT
+        out, _, _ = self._communicate(
+            "sacct --noheader -P --format State -j "+str(job_id))
+        return out
 
-        return exc, keep_going, int(mem), int(time)
+
+    @staticmethod
+    def _grid_partitions():
+        out, _, retcode = GridRunner._communicate("sinfo -h -o %R")
+        return sorted(set(out.split())) if not retcode else None
 
 
 
 class LSFRunner(GridRunner):
-    fmt = ('cpu_used max_mem run_time exit_code'
+    array_index_var = "LSB_JOBINDEX"
+    array_member_fmt = "{0}[{1}]"
+    oom_re = r"TERM_MEMLIMIT"
+    timeout_re = r"TERM_RUNLIMIT"
+    fmt = ('jobid jobindex cpu_used max_mem run_time exit_code'
            ' exit_reason stat delimiter="|"')
     multipliers = {
-        "gbytes": lambda f: f/1024,
+        "gbytes": lambda f: f*1024,
         "mbytes": lambda f: f,
-        "kbytes": lambda f: f*1024
+        "kbytes": lambda f: f/1024
     }
 
 
     @staticmethod
-    def _grid_communicate(task, partition, mem, time, 
+    def _grid_communicate(task, script, partition, mem, time, 
                           tmpdir='/tmp', threads=1, extra_grid_args=""):
         rusage = "span[hosts=1] rusage[mem={}:duration={}]".format(
             mem, int(time))
         tmpout = tempfile.mktemp(dir=tmpdir)
-        opts ={ 'R': rusage, 'o': tmpout,
+        opts ={ 'R': pipes.quote(rusage), 'o': tmpout,
                 'n': threads,'q': partition }
         
         cmd = ( "bsub -K -r "
                 +" "+dict_to_cmd_opts(opts)
                 +" "+extra_grid_args+" "
-                +" "+picklerunner.tmp(task, dir=tmpdir).path+" -r" )
+                +" "+script )
         out, err, retcode = LSFRunner._grid_popen(cmd, task)
 
         try:
             with open(tmpout) as f:
-                task.actions[0].err += f.read()
+                report = f.read()
+            task.actions[0].err += report
+            err += report # says why LSF killed the job, if it did
             os.unlink(tmpout)
         except Exception as e:
             err += "Anadama error: "+str(e)
@@ -265,37 +1206,105 @@ class LSFRunner(GridRunner):
     def _find_job_id(out, err):
         return re.search(r'Job <(\d+)>', out).group(1)
 
+    _find_submitted_id = _find_job_id
+
+
+    def _grid_submit(self, job, partition, extra_grid_args=""):
+        rusage = "span[hosts=1] rusage[mem={}:duration={}]".format(
+            job.mem, int(job.time))
+        opts ={ 'R': pipes.quote(rusage), 'o': job.out_path,
+                'e': job.err_path, 'n': job.threads,'q': partition }
+
+        cmd = ( "bsub "
+                +" "+dict_to_cmd_opts(opts)
+                +" "+extra_grid_args+" "
+                +" "+job.write_wrapper() )
+        return cmd, self._communicate(cmd)
+
+
+    def _grid_submit_array(self, array, partition, extra_grid_args=""):
+        rusage = "span[hosts=1] rusage[mem={}:duration={}]".format(
+            array.mem, int(array.time))
+        opts ={ 'R': pipes.quote(rusage), 'o': "/dev/null",
+                'e': "/dev/null", 'n': array.threads, 'q': partition,
+                'J': pipes.quote("anadama[1-%d]"%(len(array))) }
+
+        cmd = ( "bsub "
+                +" "+dict_to_cmd_opts(opts)
+                +" "+extra_grid_args+" "
+                +" "+array.write_wrapper(self.array_index_var) )
+        return cmd, self._communicate(cmd)
+
+
+    @staticmethod
+    def _grid_active():
+        # array members are listed one per line under the array's jobid
+        out, err, retcode = GridRunner._communicate(
+            "bjobs -noheader -o 'jobid stat'")
+        if retcode and "No unfinished job found" not in err:
+            return None
+        active = Counter()
+        for fields in map(str.split, out.splitlines()):
+            if len(fields) == 2 and fields[1] not in ("DONE", "EXIT"):
+                active[fields[0]] += fields[1] == "RUN"
+        return active
+
 
     @staticmethod
     def _jobstats(ids):
         def _fields():
             proc = subprocess.Popen(['bjobs', '-noheader',
-                                     '-o '+LSFRunner.fmt]+list(ids),
+                                     '-o', LSFRunner.fmt]+map(str, ids),
                                     stdout=subprocess.PIPE)
             for line in proc.stdout:
                 fields = line.strip().split("|")
-                if any((fields[-1] != "DONE", 
-                        fields[-2] != "-", 
-                        fields[-3] != "-")):
+                if len(fields) != 8 or any((fields[-1] != "DONE",
+                                            fields[-2] != "-",
+                                            fields[-3] != "-")):
                     continue
-                yield fields[:3]
+                yield fields[:5]
+            proc.wait()
 
-        for ctime, mem, wtime in _fields():
-            key, mem_str = mem.split()
-            mem = LSFRunner.multipliers[key](float(mem_str))
-            clocktime = int(wtime.split()[0])
-            cputime = int(ctime.split()[0])
-            yield mem, cputime, clocktime
+        for job_id, index, ctime, mem, wtime in _fields():
+            if index not in ("", "0"):
+                job_id = LSFRunner.array_member_fmt.format(job_id, index)
+            # e.g. 12 Mbytes, 0.5 second(s)
+            try:
+                mem_str, key = mem.split()
+                mem = LSFRunner.multipliers[key.lower()](float(mem_str))
+                clocktime = float(wtime.split()[0])/3600
+                cputime = float(ctime.split()[0])/3600
+            except (ValueError, KeyError, IndexError) as e:
+                print >> sys.stderr, "Skipping accounting for job %s: %s"%(
+                    job_id, e)
+                continue
+            yield job_id, (mem, cputime, clocktime)
+
+
+    def _grid_exit_reason(self, job_id, mem):
+        # like TERM_MEMLIMIT or TERM_RUNLIMIT
+        out, _, _ = self._communicate(
+            "bjobs -noheader -o exit_reason '%s'"%(job_id))
+        return out
 
 
     @staticmethod
-    def _handle_grid_fail(cmd, out, err, retcode, tries, mem, time):
-        return None, False, mem, time
+    def _grid_partitions():
+        out, _, retcode = GridRunner._communicate("bqueues -w")
+        if retcode:
+            return None
+        # skip the QUEUE_NAME ... header
+        return sorted( line.split()[0] for line in out.splitlines()[1:]
+                       if line.strip() )
 
 
 
 class SGERunner(GridRunner):
-    useful_qacct_keys = ("mem", "cpu", "wallclock")
+    useful_qacct_keys = ("maxvmem", "cpu", "ru_wallclock")
+    array_index_var = "SGE_TASK_ID"
+    array_member_fmt = "{0}.{1}"
+    oom_re = r"exceeded h_vmem|exceeded m_mem_free"
+    timeout_re = r"exceeded [hs]_rt"
 
     def __init__(self, *args, **kwargs):
         self.task_performance_info = dict()
@@ -303,9 +1312,13 @@ class SGERunner(GridRunner):
         return super(SGERunner, self).__init__(*args, **kwargs)
 
     def find_suitable_pe(self):
-        if self._pe_name:
-            return self._pe_name
+        if not self._pe_name:
+            self._pe_name = self._probe("pe", self._probe_pe)
+        return self._pe_name
+
 
+    @staticmethod
+    def _probe_pe():
         names, _ = subprocess.Popen(['qconf', '-spl'], 
                                     stdout=subprocess.PIPE).communicate()
         if not names:
@@ -331,26 +1344,29 @@ class SGERunner(GridRunner):
                 "Please talk with your systems administrator to enable "
                 "a parallel environment that has an `allocation_rule` "
                 "set to `$pe_slots`.")
-        else:
-            self._pe_name = pe_name
-            return pe_name
+        return pe_name
+
+
+    @staticmethod
+    def _grid_partitions():
+        out, _, retcode = GridRunner._communicate("qconf -sql")
+        return sorted(out.split()) if not retcode else None
             
 
-    def _grid_communicate(self, task, partition, mem, time, 
+    def _grid_communicate(self, task, script, partition, mem, time, 
                           tmpdir='/tmp', threads=1, extra_grid_args=""):
         pe_name = self.find_suitable_pe()
         mem = float(mem)/float(threads) # SGE spreads mem over requested num slots
         tmpout = tempfile.mktemp(dir=tmpdir)
         tmperr = tempfile.mktemp(dir=tmpdir)
-        script = picklerunner.tmp(task, dir=tmpdir)
 
         cmd = ("qsub -R y -b y -sync y -pe {pe_name} {threads} -cwd "
                "-l 'm_mem_free={mem}M' -q {partition} -V "
                "-o {tmpout} -e {tmperr} "
-               "{script} -r").format(pe_name=pe_name, threads=threads, 
+               "{script}").format(pe_name=pe_name, threads=threads, 
                                      mem=max(1, int(mem)), partition=partition,
                                      tmpout=tmpout, tmperr=tmperr,
-                                     script=script.path)
+                                     script=script)
 
         out, err, retcode = SGERunner._grid_popen(cmd, task)
         
@@ -362,6 +1378,7 @@ class SGERunner(GridRunner):
             if os.path.exists(tmperr):
                 with open(tmperr) as f_err:
                     task.actions[0].err = f_err.read()
+                err += task.actions[0].err
                 os.unlink(tmperr)
         except Exception as e:
             err += "Anadama error: "+str(e)
@@ -374,28 +1391,107 @@ class SGERunner(GridRunner):
         return re.search(r'Your job (\d+) ', out).group(1)
 
 
-    def _jobstats(self, ids):
-        for job_id in ids:
-            output = subprocess.Popen(
-                ["qacct", "-j", str(job_id)], 
-                stdout=subprocess.PIPE).communicate()[0]
-            output = output.strip().split("\n")
-            if not output:
-                continue
-            ret = dict([(k, 0) for k in self.useful_qacct_keys])
-            for line in output:
-                kv = line.split()
-                if len(kv) < 2 or kv[0] not in ret:
-                    continue
-                k, v = kv
-                ret[k] = float(v)
+    def _grid_submit(self, job, partition, extra_grid_args=""):
+        pe_name = self.find_suitable_pe()
+        mem = float(job.mem)/float(job.threads)
+        cmd = ("qsub -terse -R y -b y -pe {pe_name} {threads} -cwd "
+               "-l 'm_mem_free={mem}M' -q {partition} -V "
+               "-o {out} -e {err} {extra} "
+               "{script}").format(pe_name=pe_name, threads=job.threads,
+                                  mem=max(1, int(mem)), partition=partition,
+                                  out=job.out_path, err=job.err_path,
+                                  extra=extra_grid_args,
+                                  script=job.write_wrapper())
+        return cmd, self._communicate(cmd)
+
+
+    def _grid_submit_array(self, array, partition, extra_grid_args=""):
+        pe_name = self.find_suitable_pe()
+        mem = float(array.mem)/float(array.threads)
+        cmd = ("qsub -terse -R y -b y -t 1-{n} -pe {pe_name} {threads} -cwd "
+               "-l 'm_mem_free={mem}M' -q {partition} -V "
+               "-o /dev/null -e /dev/null {extra} "
+               "{script}").format(n=len(array), pe_name=pe_name,
+                                  threads=array.threads,
+                                  mem=max(1, int(mem)), partition=partition,
+                                  extra=extra_grid_args,
+                                  script=array.write_wrapper(
+                                      self.array_index_var))
+        return cmd, self._communicate(cmd)
 
-            yield map(ret.get, self.useful_qacct_keys)
-                
 
     @staticmethod
-    def _handle_grid_fail(cmd, out, err, retcode, tries, mem, time):
-        exc = CatchedException("Command failed: "+cmd+"\n"+out+"\n"+err)
-        keep_going = False
-        return exc, keep_going, int(mem), int(time)
+    def _find_submitted_id(out, err):
+        # -terse prints jobid, or jobid.first-last:step for arrays
+        return out.strip().split(".")[0]
+
+
+    @staticmethod
+    def _grid_active():
+        out, _, retcode = GridRunner._communicate(
+            "qstat -u "+getpass.getuser())
+        if retcode:
+            return None
+        active = Counter()
+        for fields in map(str.split, out.splitlines()):
+            if fields and fields[0].isdigit():
+                # states like r, t or Rr; waiting arrays are one line
+                active[fields[0]] += "r" in fields[4].lower()
+        return active
+
+
+    def _jobstats(self, ids):
+        # qacct can't look up a list of job ids, and every call reads
+        # the whole accounting file; instead, ask it once for every job
+        # we've run since the pipeline started
+        since = time.strftime("%Y%m%d%H%M",
+                              time.localtime(self.accounting_since))
+        proc = subprocess.Popen(
+            ["qacct", "-o", getpass.getuser(), "-b", since, "-j"],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = proc.communicate()[0]
+        wanted = set(map(str, ids))
+
+        def _records():
+            record = dict()
+            for line in output.splitlines():
+                if line.startswith("==="):
+                    yield record
+                    record = dict()
+                    continue
+                kv = line.split(None, 1)
+                if len(kv) == 2:
+                    record[kv[0]] = kv[1].strip()
+            yield record
+
+        for record in _records():
+            job_id = record.get("jobnumber")
+            if record.get("taskid", "undefined") != "undefined":
+                job_id = self.array_member_fmt.format(job_id,
+                                                      record["taskid"])
+            if job_id not in wanted \
+               or record.get("exit_status", "").split()[:1] != ["0"]:
+                continue
+            maxvmem, cpu, wallclock = map(record.get, self.useful_qacct_keys)
+            try:
+                stats = (size_mb(maxvmem or "0"), seconds(cpu or "0")/3600,
+                         seconds(wallclock or "0")/3600)
+            except ValueError as e:
+                # one odd record shouldn't cost us the rest
+                print >> sys.stderr, "Skipping accounting for job %s: %s"%(
+                    job_id, e)
+                continue
+            yield job_id, stats
+
+
+    def _grid_exit_reason(self, job_id, mem):
+        # h_vmem kills don't show in qacct's failed field; compare the
+        # job's peak memory with what it asked for instead
+        job, _, index = str(job_id).partition(".")
+        out, _, _ = self._communicate(
+            "qacct -j "+job+(" -t "+index if index else ""))
+        maxvmem = re.search(r'^maxvmem\s+(\S+)', out, re.MULTILINE)
+        if maxvmem and size_mb(maxvmem.group(1)) >= mem:
+            return "exceeded h_vmem: used %s of %dM"%(maxvmem.group(1), mem)
+        return ""
 
@@ -1,75 +1,186 @@
 import os
 import sys
+import copy
+import time
+from multiprocessing.pool import ThreadPool
 
 from doit.dependency import get_file_md5
 from doit.runner import Runner
 
-import networkx
-
 from .. import dag
-from ..util import serialize
+from .. import picklerunner
+from ..dag import iter_topological_sort
+from ..dependency import SAMPLE_KEY
+from ..util import serialize_iter
+
+
+class _SnapshotMiss(KeyError):
+    pass
+
+
+def _snapshot(dep_manager, tasks):
+    """Copy of `dep_manager` that answers reads from a dict filled in
+    up front, so worker threads never touch the DB backend (sqlite
+    connections can't be shared between threads). Reads of anything
+    not prefetched raise _SnapshotMiss. Writes are kept in the copy's
+    `pending` list for the caller to make."""
+    tiered = hasattr(dep_manager, "state_updates")
+    stored = dict()
+    for task in tasks:
+        keys = ('deps:', '_values_:', 'ignore:') + tuple(task.file_dep)
+        if tiered:
+            keys += tuple( SAMPLE_KEY+dep for dep in task.file_dep )
+        for key in keys:
+            stored[(task.name, key)] = dep_manager._get(task.name, key)
+
+    def _get(task_id, key):
+        try:
+            return stored[(task_id, key)]
+        except KeyError:
+            raise _SnapshotMiss(task_id, key)
+
+    ret = copy.copy(dep_manager)
+    ret.pending = list()
+    ret._set = lambda task_id, key, value: \
+               ret.pending.append( (task_id, key, value) )
+    if tiered:
+        # it hides changed file_dep from doit's get_status in its _get
+        ret._stored = _get
+    else:
+        ret._get = _get
+    return ret
 
 
 class JenkinsRunner(Runner):
-    
+    compact_dag = False
+    status_workers = 1
+
     def _cached_tasks(self, nodes, tasks_dict):
-        for node in nodes:
+        """Return the nodes that don't need to run. Status checks fan out
+        over `status_workers` threads; writes to the dependency DB are
+        batched up and done at the end from this thread.
+        """
+        nodes = list(nodes)
+        timings = list()
+        clock = time.time()
+        def phase(name):
+            now = time.time()
+            timings.append("%s %.2fs"%(name, now-clock))
+            return now
+
+        results, recheck, pending = list(), nodes, list()
+        if self.status_workers > 1 and len(nodes) > 1:
+            checker = _snapshot(self.dep_manager,
+                                [ node._orig_task for node in nodes ])
+            clock = phase("snapshot")
+            pool = ThreadPool(self.status_workers)
             try:
-                run_status = self.dep_manager.get_status(node._orig_task, 
-                                                         tasks_dict)
-            except Exception as e:
-                if 'Dependent file' in e.message:
-                    continue
-                else:
-                    raise
-
-            if run_status == 'up-to-date':
-                yield node
-            elif run_status == 'run':
-                if all(os.path.exists(target) for target in node.targets):
-                    # Going beyond the standard doit logic here. If
-                    # all of the task's targets exist, the task is
-                    # up-to-date as far as the JenkinsRunner is
-                    # concerned. This means that you'll have to delete
-                    # any target files from failed tasks yourself.
-                    yield node
-                else:
-                    self._update_dependency_db(node._orig_task)
-                    continue
+                checked = pool.map(
+                    lambda node: self._try_check(node, tasks_dict, checker),
+                    nodes, chunksize=64)
+            finally:
+                pool.close()
+                pool.join()
+            pending = checker.pending
+            results = [ r for r in checked if r is not None ]
+            recheck = [ node for node, r in zip(nodes, checked) if r is None ]
+            clock = phase("status (%d workers)"%(self.status_workers))
 
+        for node in recheck:
+            results.append(self._check(node, tasks_dict, self.dep_manager))
+        if recheck:
+            clock = phase("status (serial, %d tasks)"%(len(recheck)))
+
+        cached = list()
+        for node, is_cached, dep_updates in results:
+            if is_cached:
+                cached.append(node)
+            pending.extend(dep_updates)
+        for task_name, dep, state in pending:
+            self.dep_manager._set(task_name, dep, state)
         self.dep_manager.close()
+        phase("db update")
+
+        if self.verbosity >= 2:
+            print >> sys.stderr, "Checked %d tasks: %s" %(
+                len(nodes), ", ".join(timings))
+        return cached
+
+    def _try_check(self, node, tasks_dict, dep_manager):
+        try:
+            return self._check(node, tasks_dict, dep_manager)
+        except _SnapshotMiss:
+            return None
+
+    def _check(self, node, tasks_dict, dep_manager):
+        """Returns a tuple: the node, whether it's cached, and a list of
+        dependency DB updates to make"""
+        try:
+            run_status = dep_manager.get_status(node._orig_task, tasks_dict)
+        except _SnapshotMiss:
+            raise
+        except Exception as e:
+            if 'Dependent file' in str(e):
+                return node, False, []
+            else:
+                raise
 
-    def _update_dependency_db(self, task):
+        if run_status == 'up-to-date':
+            return node, True, []
+        elif run_status == 'run':
+            if all(os.path.exists(target) for target in node.targets):
+                # Going beyond the standard doit logic here. If
+                # all of the task's targets exist, the task is
+                # up-to-date as far as the JenkinsRunner is
+                # concerned. This means that you'll have to delete
+                # any target files from failed tasks yourself.
+                return node, True, []
+            else:
+                return node, False, self._dependency_updates(
+                    node._orig_task, dep_manager)
+        return node, False, []
+
+    @staticmethod
+    def _dependency_updates(task, dep_manager):
+        updates = list()
         for dep in task.file_dep:
             if not os.path.exists(dep):
                 continue
+            if hasattr(dep_manager, "state_updates"):
+                # tiered dependency manager; see anadama.dependency
+                updates.extend(dep_manager.state_updates(
+                    task.name, dep, dep_manager._stored(task.name, dep)))
+                continue
+            current = dep_manager._get(task.name, dep)
             timestamp = os.path.getmtime(dep)
-            current = self.dep_manager._get(task.name, dep)
             if current and current[0] == timestamp:
                 continue
             size = os.path.getsize(dep)
-            self.dep_manager._set(
-                task.name, 
-                dep, 
-                (timestamp, size, get_file_md5(dep))
-             )
+            updates.append(
+                (task.name, dep, (timestamp, size, get_file_md5(dep))) )
+        return updates
 
     def run_all(self, task_dispatcher):
         task_dict = task_dispatcher.tasks
         the_dag, unordered_nodes = dag.assemble(
             task_dict.itervalues(),
-            root_attrs={"pipeline_name": self.pipeline_name}
+            root_attrs={"pipeline_name": self.pipeline_name},
+            compact=self.compact_dag
         )
         if not self.always_execute:
             cached_tasks = self._cached_tasks(unordered_nodes, task_dict)
             the_dag = dag.prune(the_dag, cached_tasks)
-        return self._print_dag(the_dag)
+        ret = self._print_dag(the_dag)
+        # the printed DAG runs the scripts it names later; clear out
+        # the ones earlier runs left behind
+        picklerunner.sweep(dag.TMP_FILE_DIR, keep=[
+            node._cmd for node in unordered_nodes if node._cmd ])
+        return ret
 
     def _print_dag(self, dag, key="dag"):
-        nodes = [ 
+        nodes = (
             {"node": node,
              "parents": dag.predecessors(node)}
-            for node in networkx.algorithms.dag.topological_sort(dag) 
-        ]
-        return serialize({ key: nodes }, to_fp=sys.stdout)
-
+            for node in iter_topological_sort(dag)
+        )
+        return serialize_iter(key, nodes, to_fp=sys.stdout)
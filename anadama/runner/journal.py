@@ -0,0 +1,132 @@
+"""Keep a record on disk of the jobs a grid runner has out on the grid.
+
+Every async submission and every finished job is appended to the
+journal as one line of JSON, and flushed to disk before the runner
+moves on. If the runner dies, the next run with the same journal can
+find the jobs that were still in flight and wait on them instead of
+submitting them again, and can still feed the accounting of jobs that
+finished successfully to the performance predictor.
+
+A clean ``finish()`` compacts the journal down to the jobs that are
+still in flight, so it doesn't grow from run to run.
+"""
+
+import os
+import json
+import time
+import threading
+
+OPENED, SUBMIT, DONE, ACCOUNTED = "opened", "submit", "done", "accounted"
+
+
+class GridJournal(object):
+    def __init__(self, path):
+        self.path = path
+        self.live = dict()       # job id -> submit record
+        self.live_tasks = dict() # task name -> job id
+        self.succeeded = dict()  # job id -> task name, not accounted for
+        self.since = None # when the earliest run in the journal started
+        self._lock = threading.Lock()
+        torn = self._load()
+        self._f = open(self.path, 'a')
+        if torn:
+            self._f.write("\n")
+        self._write({"event": OPENED, "time": time.time()})
+
+
+    def _load(self):
+        """Replay the journal. Returns whether its last line was cut
+        short by a runner killed mid-write."""
+        if not os.path.exists(self.path):
+            return False
+        line = "\n"
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                self._apply(record)
+        return not line.endswith("\n")
+
+
+    def _apply(self, record):
+        if record["event"] == OPENED:
+            self.since = min(self.since or record["time"], record["time"])
+            return
+        if record["event"] == ACCOUNTED:
+            for job_id in record["job_ids"]:
+                self.succeeded.pop(job_id, None)
+            return
+        job_id = record["job_id"]
+        if record["event"] == SUBMIT:
+            self.live[job_id] = record
+            self.live_tasks[record["task"]] = job_id
+        elif record["event"] == DONE:
+            self.live.pop(job_id, None)
+            if self.live_tasks.get(record["task"]) == job_id:
+                del self.live_tasks[record["task"]]
+            if record["retcode"] == 0 and record["accountable"]:
+                self.succeeded[job_id] = record["task"]
+
+
+    def _write(self, record):
+        with self._lock:
+            self._apply(record)
+            self._f.write(json.dumps(record)+"\n")
+            self._f.flush()
+            os.fsync(self._f.fileno())
+
+
+    def submitted(self, job):
+        """Record that GridJob `job` is on the grid"""
+        group = job.group
+        self._write({
+            "event": SUBMIT, "task": job.task.name,
+            "job_id": job.job_id, "grid_id": job.grid_id,
+            "base": job.base, "script": job.script, "cmd": job.cmd,
+            "mem": job.mem, "time": job.time, "threads": job.threads,
+            "tries": job.tries,
+            "group": group.base if group else None,
+            "accountable": group.accountable if group else True,
+        })
+
+
+    def done(self, job_id, task_name, retcode, accountable=True):
+        """Record that the job `job_id` won't be waited on any more"""
+        self._write({
+            "event": DONE, "task": task_name, "job_id": job_id,
+            "retcode": retcode, "accountable": accountable
+        })
+
+
+    def accounted(self, job_ids):
+        """Record that the accounting of `job_ids` has been collected"""
+        if job_ids:
+            self._write({"event": ACCOUNTED, "job_ids": list(job_ids)})
+
+
+    def in_flight(self, task_name):
+        """Return the submit record of the most recent job for
+        `task_name` still on the grid, or None"""
+        job_id = self.live_tasks.get(task_name)
+        return self.live[job_id] if job_id is not None else None
+
+
+    def compact(self):
+        """Forget finished jobs; their accounting has been collected.
+        Jobs still in flight are kept for the next run."""
+        with self._lock:
+            self._f.close()
+            self.succeeded = dict()
+            if not self.live:
+                self.since = time.time()
+            tmp = self.path+".tmp"
+            with open(tmp, 'w') as f:
+                f.write(json.dumps({"event": OPENED, "time": self.since})+"\n")
+                for record in self.live.itervalues():
+                    f.write(json.dumps(record)+"\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp, self.path)
+            self._f = open(self.path, 'a')
@@ -0,0 +1,114 @@
+"""Remember what the scheduler said about itself between runs.
+
+Before submitting anything, grid runners ask the scheduler what it can
+do: which partitions or queues there are, or which of SGE's parallel
+environments keep a job's slots on one host. The answers hardly ever
+change, but asking takes a round trip to the scheduler's master for
+every launch of every pipeline, several for SGE. So the answers are
+kept in a small JSON file, keyed by scheduler, cluster and question,
+and asked again only once they're older than the cache's TTL or have
+been invalidated, e.g. because a cached queue turned out to be gone.
+
+Probes that fail or come back empty aren't cached.
+"""
+
+import os
+import json
+import time
+import socket
+import tempfile
+import threading
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".anadama_grid_probes")
+DEFAULT_TTL = 24 # hours
+
+
+def cluster_name():
+    """What tells clusters sharing a home directory apart: the
+    scheduler's own cluster or cell name if it's set, or else this
+    host's domain"""
+    for var in ("SLURM_CLUSTER_NAME", "LSF_CLUSTER_NAME", "SGE_CELL"):
+        if os.environ.get(var):
+            return os.environ[var]
+    host = socket.gethostname()
+    return host.partition(".")[2] or host
+
+
+class ProbeCache(object):
+    """
+    :param path: File to keep the answers in between runs. Use None to
+      keep them for this run only.
+    :keyword ttl: Hours before an answer is asked again. Use 0 to always
+      ask again.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, ttl=DEFAULT_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.probes = 0 # answers that had to be asked for
+        self._memory = dict() # key -> entry, for this run
+        self._cluster = cluster_name()
+        self._lock = threading.Lock()
+
+
+    def key(self, scheduler, question):
+        return ":".join((scheduler, self._cluster, question))
+
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path):
+            return dict()
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return dict()
+
+
+    def _save(self, entries):
+        if not self.path:
+            return
+        # write to a temporary file then rename, so concurrent runs
+        # never read a half-written cache
+        try:
+            fd, tmp = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.path)),
+                prefix=".probes")
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entries, f)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            pass
+
+
+    def get(self, key, probe):
+        """Return the answer for `key`, from the cache if it's fresh,
+        or else from calling `probe`"""
+        with self._lock:
+            entry = self._memory.get(key) or self._load().get(key)
+            if entry and time.time() - entry["time"] < self.ttl*3600:
+                self._memory[key] = entry
+                return entry["value"]
+            value = probe()
+            self.probes += 1
+            if value:
+                entry = {"value": value, "time": time.time()}
+                self._memory[key] = entry
+                entries = self._load()
+                entries[key] = entry
+                self._save(entries)
+            return value
+
+
+    def invalidate(self, key=None):
+        """Forget the answer for `key`, or every answer"""
+        with self._lock:
+            entries = self._load()
+            if key is None:
+                self._memory.clear()
+                entries = dict()
+            else:
+                self._memory.pop(key, None)
+                if entries.pop(key, None) is None:
+                    return
+            self._save(entries)
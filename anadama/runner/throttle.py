@@ -0,0 +1,140 @@
+"""Pace grid submissions to stay inside the limits of the cluster.
+
+Schedulers limit how many jobs one user may have in the queue, how many
+of those run at once and how fast new ones may be submitted, and a
+partition only has so much memory to go around. Going past these gets
+submissions rejected, or costs fair-share priority, in bursts that
+large pipelines run into over and over. The throttle holds submissions
+back until they fit, so jobs go out at a steady pace instead.
+
+The sync submit mode's threads wait on the throttle; the async submit
+mode takes as many ready jobs as fit and keeps the rest for later.
+"""
+
+import time
+import threading
+
+
+class SubmitThrottle(object):
+    """
+    :keyword max_queued: Most jobs to have on the grid at once, waiting
+      or running
+    :keyword max_pending: Most jobs to keep waiting in the queue, besides
+      the ones the scheduler says are running. Until it says otherwise,
+      all jobs on the grid count as waiting.
+    :keyword per_second: Most submissions per second. A job array is
+      one submission.
+    :keyword mem_budget: Most MB of memory for the jobs on the grid to
+      ask for all told
+    """
+
+    def __init__(self, max_queued=None, max_pending=None, per_second=None,
+                 mem_budget=None):
+        self.max_queued, self.max_pending = max_queued, max_pending
+        self.per_second, self.mem_budget = per_second, mem_budget
+        self.out = 0       # jobs on the grid
+        self.running = 0   # of those, how many the scheduler says run
+        self.mem = 0       # MB asked for by the jobs on the grid
+        self.held = 0      # submissions that had to wait
+        self.held_seconds = 0.
+        self._next = 0.    # earliest time for the next submission
+        self._cond = threading.Condition()
+        self._pace_lock = threading.Lock()
+
+
+    def _fits(self, mem):
+        if not self.out:
+            # a job that's over the limits all by itself still goes
+            return True
+        if self.max_queued and self.out >= self.max_queued:
+            return False
+        if self.max_pending and self.out - self.running >= self.max_pending:
+            return False
+        if self.mem_budget and self.mem + mem > self.mem_budget:
+            return False
+        return True
+
+
+    def _add(self, mem):
+        self.out += 1
+        self.mem += mem
+
+
+    def take(self, jobs):
+        """Count as many of GridJobs `jobs` as fit on the grid now, in
+        order. Returns those and the rest."""
+        with self._cond:
+            taken, held = list(), list()
+            for job in jobs:
+                if not held and self._fits(job.mem):
+                    self._add(job.mem)
+                    taken.append(job)
+                else:
+                    held.append(job)
+            return taken, held
+
+
+    def acquire(self, mem):
+        """Wait until one more job asking for `mem` MB fits on the grid,
+        then count it as on the grid"""
+        with self._cond:
+            if not self._fits(mem):
+                start = time.time()
+                while not self._fits(mem):
+                    self._cond.wait(1)
+                self.held += 1
+                self.held_seconds += time.time() - start
+            self._add(mem)
+
+
+    def add(self, mem):
+        """Count a job that's already on the grid"""
+        with self._cond:
+            self._add(mem)
+
+
+    def release(self, mem):
+        """Note that a job asking for `mem` MB has left the grid"""
+        with self._cond:
+            self.out -= 1
+            self.mem -= mem
+            self._cond.notify_all()
+
+
+    def observe(self, running):
+        """Note that the scheduler says `running` of our jobs are
+        running"""
+        with self._cond:
+            self.running = running
+            self._cond.notify_all()
+
+
+    def pace(self):
+        """Wait until submitting once more keeps under `per_second`"""
+        if not self.per_second:
+            return
+        with self._pace_lock:
+            now = time.time()
+            when = max(now, self._next)
+            self._next = when + 1./self.per_second
+        if when > now:
+            time.sleep(when - now)
+            with self._cond:
+                self.held += 1
+                self.held_seconds += when - now
+
+
+    def depth(self):
+        """Return how many jobs are on the grid, how many of those are
+        running, and how many MB of memory they ask for"""
+        with self._cond:
+            return self.out, self.running, self.mem
+
+
+    def summary(self):
+        """A line saying how long submissions were held back, or None
+        if they never were"""
+        if not self.held:
+            return None
+        return ("%d submissions were held back %.1fs in all to stay"
+                " inside the grid's limits"%(self.held, self.held_seconds))
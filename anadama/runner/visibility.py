@@ -0,0 +1,190 @@
+"""Wait for the targets of a finished grid job to show up on this node.
+
+Grid jobs write their targets on other hosts. On shared filesystems
+like NFS, this node can go on saying a new file isn't there for a while
+after it is, because ``stat()`` is answered from a stale attribute or
+negative lookup cache. So targets that aren't found right away are
+looked for again by listing their directories, one listing per
+directory per round; reading a directory makes the client revalidate
+it. Between rounds, the waiter backs off exponentially until a
+deadline.
+
+Where inotify can see the files arrive, i.e. on filesystems local to
+this node, the waiter wakes up as soon as something is created in a
+target's directory instead of sleeping out the whole backoff. Network
+filesystems only tell inotify about changes made from this node, so
+there it just sleeps.
+
+How long each task's targets took to show up is kept per mount point,
+so slow mounts can be picked out.
+"""
+
+import os
+import time
+import threading
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+NETWORK_FILESYSTEMS = ("nfs", "nfs4", "cifs", "smbfs", "smb3", "lustre",
+                       "gpfs", "beegfs", "panfs", "afs", "ceph", "glusterfs",
+                       "9p", "pvfs2", "fuse")
+DEFAULT_DEADLINE = 3 # seconds; raise it for mounts slow to show new files
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+
+class TargetWaiter(object):
+    """
+    :keyword deadline: Most seconds to wait for a task's targets
+    :keyword first_delay: Seconds to wait after the first look
+    :keyword max_delay: Most seconds to wait between looks
+    """
+
+    def __init__(self, deadline=DEFAULT_DEADLINE, first_delay=0.05,
+                 max_delay=2.):
+        self.deadline = deadline
+        self.first_delay, self.max_delay = first_delay, max_delay
+        self.latencies = dict() # mount point -> list of seconds waited
+        self._mounts = None
+        self._lock = threading.Lock()
+
+
+    @staticmethod
+    def _split(paths):
+        """Group `paths` by directory"""
+        by_dir = dict()
+        for path in paths:
+            d, name = os.path.split(os.path.normpath(path))
+            by_dir.setdefault(d or os.curdir, set()).add(name)
+        return by_dir
+
+
+    def missing(self, paths):
+        """Return those of `paths` that aren't visible yet. Files that
+        ``stat()`` can't find are looked for again with one directory
+        listing per directory."""
+        paths = [ p for p in paths if not os.path.exists(p) ]
+        if not paths:
+            return paths
+        ret = list()
+        for d, names in self._split(paths).iteritems():
+            try:
+                listing = set(os.listdir(d))
+            except OSError:
+                listing = set()
+            ret.extend( os.path.join(d, name) for name in names
+                        if name not in listing )
+        return ret
+
+
+    def wait(self, paths, deadline=None):
+        """Wait until all of `paths` are visible, or for `deadline`
+        seconds. Returns the paths still missing and the seconds
+        waited."""
+        if deadline is None:
+            deadline = self.deadline
+        start = time.time()
+        missing = self.missing(paths)
+        if not missing:
+            return missing, 0.
+        notifier = self._notifier(missing)
+        delay = self.first_delay
+        try:
+            while missing:
+                left = start + deadline - time.time()
+                if left <= 0:
+                    break
+                pause = min(delay, left)
+                if notifier:
+                    if notifier.check_events(timeout=int(pause*1000)):
+                        notifier.read_events()
+                        notifier.process_events()
+                else:
+                    time.sleep(pause)
+                delay = min(delay*2, self.max_delay)
+                missing = self.missing(missing)
+        finally:
+            if notifier:
+                notifier.stop()
+        return missing, time.time() - start
+
+
+    def _notifier(self, paths):
+        """An inotify notifier watching the directories of `paths`, or
+        None if inotify can't see files arrive in all of them"""
+        if pyinotify is None:
+            return None
+        dirs = list(self._split(paths))
+        if any( self.mount(d)[1].split(".")[0] in NETWORK_FILESYSTEMS
+                for d in dirs ):
+            return None
+        try:
+            wm = pyinotify.WatchManager()
+        except Exception:
+            return None
+        notifier = pyinotify.Notifier(wm, pyinotify.ProcessEvent())
+        mask = pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO
+        watches = wm.add_watch(dirs, mask, quiet=True)
+        if any( wd < 0 for wd in watches.itervalues() ):
+            notifier.stop()
+            return None
+        return notifier
+
+
+    def _read_mounts(self):
+        mounts = list()
+        try:
+            with open("/proc/mounts") as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) >= 3:
+                        # spaces in mount points come escaped as \040
+                        mount = fields[1].replace("\\040", " ")
+                        mounts.append((mount, fields[2]))
+        except IOError:
+            pass
+        # longest mount point first
+        return sorted(mounts, key=lambda m: -len(m[0]))
+
+
+    def mount(self, path):
+        """Return the mount point and filesystem type `path` is on"""
+        if self._mounts is None:
+            self._mounts = self._read_mounts()
+        path = os.path.realpath(path)
+        for mount, fstype in self._mounts:
+            if path == mount or path.startswith(mount.rstrip("/")+"/"):
+                return mount, fstype
+        return "/", "unknown"
+
+
+    def record(self, paths, seconds):
+        """Note that `paths` took `seconds` to show up"""
+        if not paths:
+            return
+        mount = self.mount(os.path.dirname(os.path.abspath(paths[0])))
+        with self._lock:
+            self.latencies.setdefault(mount, list()).append(seconds)
+
+
+    def summary(self):
+        """One line per mount point where targets were waited for, with
+        the number of tasks and the median and longest waits"""
+        lines = list()
+        with self._lock:
+            for (mount, fstype), waits in sorted(self.latencies.items()):
+                waited = [ w for w in waits if w > 0 ]
+                if not waited:
+                    continue
+                lines.append(
+                    "%s (%s): %d of %d tasks waited for targets,"
+                    " median %.2fs, longest %.2fs"%(
+                        mount, fstype, len(waited), len(waits),
+                        _median(waited), max(waited)))
+        return lines
@@ -0,0 +1,100 @@
+"""Dispatch tasks longest-remaining-path first.
+
+Every kind of task is weighted by the run time its performance
+predictor expects. A task's upward rank is its own weight plus the
+largest rank among its children, i.e. the length of the longest chain
+of work that can't start until it finishes. Handing out ready tasks by
+descending rank starts the critical path as early as possible.
+"""
+
+import heapq
+import itertools
+from collections import defaultdict
+
+from doit.control import TaskDispatcher
+
+from .performance import task_kind
+
+
+def upward_ranks(tasks, weight):
+    """Return a dict of task name -> upward rank for `tasks`, a dict of
+    processed doit tasks by name, along the task_dep edges doit has
+    already worked out. `weight` is called with each task and returns
+    its cost."""
+    children = defaultdict(list)
+    for task in tasks.itervalues():
+        for parent in task.task_dep:
+            children[parent].append(task.name)
+
+    ranks = dict()
+    for name in tasks:
+        stack = [(name, False)]
+        while stack:
+            name, expanded = stack.pop()
+            if name in ranks:
+                continue
+            if expanded:
+                below = [ ranks[child] for child in children[name] ]
+                ranks[name] = weight(tasks[name]) + max(below or [0])
+                continue
+            stack.append((name, True))
+            stack.extend( (child, False) for child in children[name]
+                          if child not in ranks )
+    return ranks
+
+
+def rank_tasks(tasks, predictor):
+    """Upward ranks for `tasks`, a dict of processed doit tasks by
+    name. Each kind of task is weighted by the ``time`` that
+    `predictor` forecasts for the first task of that kind."""
+    times = dict()
+    def weight(task):
+        if not task.actions:
+            return 0
+        kind = task_kind(task)
+        if kind not in times:
+            times[kind] = predictor.forecast(task).time
+        return times[kind]
+
+    return upward_ranks(tasks, weight)
+
+
+class RankedQueue(object):
+    """Drop-in for the ``ready`` deque of a TaskDispatcher that always
+    gives out the highest ranked ExecNode first. Ties go first-in,
+    first-out."""
+
+    def __init__(self, ranks):
+        self.ranks = ranks
+        self._heap = list()
+        self._counter = itertools.count()
+
+    def append(self, node):
+        rank = self.ranks.get(node.task.name, 0)
+        heapq.heappush(self._heap, (-rank, next(self._counter), node))
+
+    def popleft(self):
+        return heapq.heappop(self._heap)[-1]
+
+    def __len__(self):
+        return len(self._heap)
+
+    def __iter__(self):
+        return (node for _, _, node in sorted(self._heap))
+
+
+class PriorityTaskDispatcher(TaskDispatcher):
+    def __init__(self, tasks, targets, selected_tasks, ranks):
+        selected_tasks = sorted(selected_tasks,
+                                key=lambda name: -ranks.get(name, 0))
+        super(PriorityTaskDispatcher, self).__init__(
+            tasks, targets, selected_tasks)
+        self.ready = RankedQueue(ranks)
+
+
+def priority_dispatcher(control, predictor):
+    """Make a dispatcher for an already processed doit TaskControl
+    that hands out tasks along the critical path first."""
+    ranks = rank_tasks(control.tasks, predictor)
+    return PriorityTaskDispatcher(control.tasks, control.targets,
+                                  control.selected_tasks, ranks)
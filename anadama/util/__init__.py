@@ -253,6 +253,20 @@ def serialize(obj, to_fp=None):
         return json.dumps(obj, default=_defaultfunc)
 
 
+def serialize_iter(key, items, to_fp):
+    """Write ``{key: [item, item, ...]}`` to `to_fp` as JSON, one item
+    at a time. Output matches ``serialize({key: list(items)}, to_fp)``,
+    but `items` can be a generator and is never held in memory as a
+    whole.
+    """
+    to_fp.write("{"+json.dumps(key)+": [")
+    for i, item in enumerate(items):
+        if i:
+            to_fp.write(", ")
+        json.dump(item, to_fp, default=_defaultfunc)
+    to_fp.write("]}")
+
+
 def deserialize(s=None, from_fp=None):
     if s:
         return json.loads(s)
@@ -0,0 +1,117 @@
+"""Bytes read from disk to decide that nothing changed, for doit's
+stock dependency manager versus the tiered one from
+anadama.dependency.
+
+Three re-runs are measured: one where the inputs weren't touched, one
+right after every input's mtime moved but its contents didn't (e.g.
+after being restored from an archive), and the one after that. Then
+the bytes read to notice that every input's first block was rewritten,
+keeping its size.
+
+Usage::
+
+    python benchmarks/change_detection.py [n_files [mb_per_file]]
+
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+import doit.dependency
+from doit.task import Task
+from doit.dependency import JsonDependency
+
+from anadama import dependency
+
+doit_bytes = [0]
+_doit_md5 = doit.dependency.get_file_md5
+def _counting_md5(path):
+    doit_bytes[0] += os.path.getsize(path)
+    return _doit_md5(path)
+doit.dependency.get_file_md5 = _counting_md5
+
+
+def make_inputs(tmpdir, n_files, mb_per_file):
+    block = os.urandom(1024*1024)
+    paths = list()
+    for i in range(n_files):
+        path = os.path.join(tmpdir, "sample%d.fastq"%(i))
+        with open(path, 'wb') as f:
+            for _ in range(mb_per_file):
+                f.write(block)
+        paths.append(path)
+    target = os.path.join(tmpdir, "out")
+    open(target, 'w').close()
+    return [ Task("t%d"%(i), ["true"], file_dep=[p], targets=[target])
+             for i, p in enumerate(paths) ], paths
+
+
+def bytes_to_check(dep_class, db_file, tasks, expect='up-to-date'):
+    mgr = dep_class(db_file)
+    for task in tasks:
+        status = mgr.get_status(task, {})
+        assert status == expect, (task.name, status)
+    mgr.close()
+
+
+def rewrite_head(paths, data):
+    """Overwrite the start of every file in `paths` with `data`, and
+    return what was there"""
+    old = list()
+    for path in paths:
+        with open(path, 'r+b') as f:
+            old.append(f.read(len(data)))
+            f.seek(0)
+            f.write(data)
+    return old
+
+
+def main(argv):
+    n_files = int(argv[0]) if argv else 20
+    mb_per_file = int(argv[1]) if len(argv) > 1 else 50
+    tmpdir = tempfile.mkdtemp()
+    try:
+        tasks, paths = make_inputs(tmpdir, n_files, mb_per_file)
+        classes = [("doit", JsonDependency)] + [
+            ("tiered-"+policy, dependency.tiered(JsonDependency, policy))
+            for policy in dependency.FULL_HASH_POLICIES ]
+
+        print "manager\tuntouched_mb\ttouched_mb\tnext_run_mb\trewritten_mb"
+        for name, cls in classes:
+            db_file = os.path.join(tmpdir, name+".db")
+            mgr = cls(db_file)
+            for task in tasks:
+                mgr.save_success(task)
+            mgr.close()
+
+            row = [name]
+            for touch in (False, True, False):
+                if touch:
+                    for path in paths:
+                        st = os.stat(path)
+                        os.utime(path, (st.st_atime, st.st_mtime+10))
+                doit_bytes[0] = dependency.bytes_read = 0
+                bytes_to_check(cls, db_file, tasks)
+                used = dependency.bytes_read if name != "doit" \
+                       else doit_bytes[0]
+                row.append("%.1f"%(used/1024./1024))
+
+            # doit's own commands still read the states
+            bytes_to_check(JsonDependency, db_file, tasks)
+
+            old = rewrite_head(paths, "\0"*4096)
+            doit_bytes[0] = dependency.bytes_read = 0
+            bytes_to_check(cls, db_file, tasks, expect='run')
+            used = dependency.bytes_read if name != "doit" else doit_bytes[0]
+            row.append("%.1f"%(used/1024./1024))
+            for path, data in zip(paths, old):
+                rewrite_head([path], data)
+            print "\t".join(row)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
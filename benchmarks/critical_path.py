@@ -0,0 +1,108 @@
+"""Simulated makespan of doit's default dispatch order versus
+critical-path (upward rank) dispatch, on synthetic pipelines where a
+few samples need a long assembly + annotation chain.
+
+Usage::
+
+    python benchmarks/critical_path.py [n_samples [n_slots]]
+
+"""
+
+import sys
+import heapq
+import random
+import itertools
+from collections import defaultdict
+
+from doit.task import Task
+from doit.control import TaskControl, TaskDispatcher, ExecNode
+
+from anadama import scheduler
+from anadama.performance import default_prediction, task_kind
+
+
+class TablePredictor(object):
+    """Forecasts the average run time of each kind of task in
+    `minutes`"""
+
+    def __init__(self, tasks, minutes):
+        by_kind = defaultdict(list)
+        for task in tasks:
+            by_kind[task_kind(task)].append(minutes[task.name])
+        self.minutes = dict( (kind, sum(mins)/len(mins))
+                             for kind, mins in by_kind.iteritems() )
+
+    def forecast(self, task):
+        return default_prediction._replace(
+            time=self.minutes[task_kind(task)])
+
+
+def synthetic_pipeline(n_samples, seed=0):
+    """Quick per-sample QC tasks are defined before the slow assembly
+    chains, the way a pipeline lists its workflows."""
+    rng = random.Random(seed)
+    tasks, minutes = list(), dict()
+    def add(name, deps, target, mins):
+        program = name.rstrip("0123456789")
+        tasks.append(Task(name, [program+" "+" ".join(deps)],
+                          file_dep=deps, targets=[target]))
+        minutes[name] = mins
+
+    for s in range(n_samples):
+        add("qc%d"%s, ["raw%d"%s], "qc%d"%s, rng.randint(5, 30))
+    for s in range(n_samples):
+        add("profile%d"%s, ["qc%d"%s], "profile%d"%s, rng.randint(10, 60))
+    for s in range(0, n_samples, 10):
+        add("assemble%d"%s, ["qc%d"%s], "contigs%d"%s, rng.randint(300, 600))
+        add("annotate%d"%s, ["contigs%d"%s], "annot%d"%s,
+            rng.randint(200, 400))
+    add("merge", ["profile%d"%s for s in range(n_samples)], "merged", 20)
+    return tasks, minutes
+
+
+def simulate(dispatcher, minutes, n_slots):
+    """Drive `dispatcher` like MRunner would, with a simulated clock"""
+    now, seq = 0, itertools.count()
+    running, completed = list(), None
+    while True:
+        if len(running) < n_slots:
+            try:
+                step = dispatcher.generator.send(completed)
+            except StopIteration:
+                break
+            completed = None
+            if isinstance(step, ExecNode):
+                step.run_status = 'run'
+                finish = now + minutes[step.task.name]
+                heapq.heappush(running, (finish, next(seq), step))
+                continue
+        now, _, completed = heapq.heappop(running)
+        completed.run_status = 'successful'
+    return max([now] + [ entry[0] for entry in running ])
+
+
+def main(argv):
+    n_samples = int(argv[0]) if argv else 500
+    n_slots = int(argv[1]) if len(argv) > 1 else 32
+    tasks, minutes = synthetic_pipeline(n_samples)
+    control = TaskControl(tasks)
+    control.process(None)
+
+    fifo = simulate(TaskDispatcher(control.tasks, control.targets,
+                                   control.selected_tasks),
+                    minutes, n_slots)
+
+    tasks = synthetic_pipeline(n_samples)[0]
+    predictor = TablePredictor(tasks, minutes)
+    control = TaskControl(tasks)
+    control.process(None)
+    ranked = simulate(scheduler.priority_dispatcher(control, predictor),
+                      minutes, n_slots)
+
+    print "tasks\tslots\tfifo_min\tranked_min\tgain"
+    print "%d\t%d\t%d\t%d\t%.1f%%" %(len(tasks), n_slots, fifo, ranked,
+                                     100.*(fifo-ranked)/fifo)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
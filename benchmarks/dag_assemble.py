@@ -0,0 +1,87 @@
+"""Time and memory needed by dag.assemble on synthetic pipelines.
+
+Usage::
+
+    python benchmarks/dag_assemble.py [--compact] [n_nodes [n_nodes ...]]
+
+``--compact`` builds a :class:`anadama.compactdag.CompactDag` instead
+of a networkx.DiGraph.
+
+Each size is built in a fresh interpreter so that peak RSS numbers
+don't bleed into each other.
+"""
+
+import sys
+import time
+import resource
+import subprocess
+
+from anadama import dag
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+CHAIN_LENGTH = 5
+
+
+class FakeTask(object):
+    """Just enough of a doit task for DagNode.from_doit_task"""
+
+    def __init__(self, name, file_dep, targets):
+        self.name = name
+        self.file_dep = file_dep
+        self.targets = targets
+
+    def execute(self):
+        pass
+
+
+def synthetic_tasks(n_nodes, chain_length=CHAIN_LENGTH):
+    """Per-sample chains of `chain_length` tasks, with every tenth
+    sample's last product feeding a shared merge task"""
+    n_samples = max(1, int(n_nodes / (chain_length+.1)))
+    merge_deps = list()
+    for sample in xrange(n_samples):
+        prev = ["/data/raw/sample%d.fastq"%(sample)]
+        for step in xrange(chain_length):
+            target = "/data/out/sample%d.step%d"%(sample, step)
+            yield FakeTask("sample%d_step%d"%(sample, step), prev, [target])
+            prev = [target]
+        merge_deps.append(prev[0])
+        if len(merge_deps) == 10:
+            yield FakeTask("merge%d"%(sample), merge_deps,
+                           ["/data/out/merge%d"%(sample)])
+            merge_deps = list()
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.
+
+
+def run_one(n_nodes, compact):
+    tasks = list(synthetic_tasks(n_nodes))
+    before = peak_rss_mb()
+    start = time.time()
+    the_dag, nodes = dag.assemble(tasks, compact=compact)
+    elapsed = time.time() - start
+    print "%d\t%d\t%.3f\t%.1f" %(len(nodes), the_dag.number_of_edges(),
+                                 elapsed, peak_rss_mb()-before)
+
+
+def main(argv):
+    compact = "--compact" in argv
+    argv = [ arg for arg in argv if arg != "--compact" ]
+    if argv and argv[0] == "--one":
+        return run_one(int(argv[1]), compact)
+
+    sizes = map(int, argv) or DEFAULT_SIZES
+    print "nodes\tedges\tseconds\tpeak_mb"
+    sys.stdout.flush()
+    for n_nodes in sizes:
+        cmd = [sys.executable, __file__, "--one", str(n_nodes)]
+        if compact:
+            cmd.append("--compact")
+        subprocess.check_call(cmd)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
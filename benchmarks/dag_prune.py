@@ -0,0 +1,43 @@
+"""Time dag.prune when most of a large DAG is already up to date, as
+when JenkinsRunner.run_all re-plans a pipeline that mostly finished.
+
+Usage::
+
+    python benchmarks/dag_prune.py [--compact] [n_nodes [n_nodes ...]]
+
+"""
+
+import sys
+import time
+import random
+
+from anadama import dag
+
+from dag_assemble import synthetic_tasks
+
+DEFAULT_SIZES = (10000, 100000)
+FRACTION_CACHED = 0.95
+
+
+def run_one(n_nodes, compact):
+    random.seed(n_nodes)
+    the_dag, nodes = dag.assemble(synthetic_tasks(n_nodes), compact=compact)
+    cached = [ node for node in nodes if random.random() < FRACTION_CACHED ]
+    before = the_dag.number_of_nodes()
+    start = time.time()
+    the_dag = dag.prune(the_dag, cached)
+    elapsed = time.time() - start
+    print "%d\t%d\t%d\t%.3f" %(before, len(cached),
+                               before - the_dag.number_of_nodes(), elapsed)
+
+
+def main(argv):
+    compact = "--compact" in argv
+    sizes = [ int(arg) for arg in argv if arg != "--compact" ]
+    print "nodes\tcached\tpruned\tseconds"
+    for n_nodes in sizes or DEFAULT_SIZES:
+        run_one(n_nodes, compact)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,85 @@
+"""Throughput and head-node overhead of the grid runners, measured
+against the fake scheduler in fakegrid.py.
+
+Head-node CPU is what the pipeline process and the scheduler commands
+it runs spend; the jobs themselves run under the fake scheduler and
+aren't counted.
+
+Usage::
+
+    python benchmarks/fake_grid.py [n_tasks [slots [latency_s]]]
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import resource
+import tempfile
+
+from doit.task import Task
+from doit.control import TaskControl
+from doit.dependency import Dependency
+from doit.reporter import ZeroReporter
+
+from anadama.runner import SlurmRunner, LSFRunner, SGERunner
+from fakegrid import FakeGrid
+
+RUNNERS = (("slurm", SlurmRunner), ("lsf", LSFRunner), ("sge", SGERunner))
+MODES = ("sync", "async")
+
+
+def cpu_seconds():
+    total = 0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def fanout_tasks(tmpdir, n_tasks):
+    return [ Task("sample%d"%(i),
+                  ["echo %d > %s"%(i, os.path.join(tmpdir, "out%d"%(i)))],
+                  targets=[os.path.join(tmpdir, "out%d"%(i))],
+                  title=lambda task: "time=5 mem=100")
+             for i in range(n_tasks) ]
+
+
+def run_one(runner_cls, mode, n_tasks, slots):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        control = TaskControl(fanout_tasks(tmpdir, n_tasks))
+        control.process(None)
+        runner = runner_cls(
+            "fake", os.path.join(tmpdir, "perf.json"), tmpdir, "",
+            Dependency, os.path.join(tmpdir, "doit.db"),
+            ZeroReporter(None, {}), num_process=slots,
+            probe_cache=os.path.join(tmpdir, "probes"),
+            submit_mode=mode, poll_interval=0.25)
+        start_cpu, start = cpu_seconds(), time.time()
+        failed = runner.run_all(control.task_dispatcher())
+        elapsed = time.time() - start
+        assert not failed, "%s %s run failed"%(runner_cls.__name__, mode)
+        return elapsed, cpu_seconds() - start_cpu
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(argv):
+    n_tasks = int(argv[0]) if argv else 50
+    slots = int(argv[1]) if len(argv) > 1 else 8
+    latency = float(argv[2]) if len(argv) > 2 else 0.5
+
+    print "runner\tmode\ttasks\twall_s\ttasks_per_s\thead_cpu_s"
+    for name, runner_cls in RUNNERS:
+        for mode in MODES:
+            with FakeGrid(slots=slots, latency=latency) as grid:
+                grid.activate()
+                elapsed, cpu = run_one(runner_cls, mode, n_tasks, slots)
+            print "%s\t%s\t%d\t%.1f\t%.1f\t%.2f" %(
+                name, mode, n_tasks, elapsed, n_tasks/elapsed, cpu)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
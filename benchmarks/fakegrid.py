@@ -0,0 +1,1011 @@
+"""A pretend cluster for trying out grid runners on one machine.
+
+A daemon plays the part of the scheduler: it queues jobs, makes each
+wait a configurable latency, starts them only while enough slots and
+memory are free, enforces time limits, keeps accounting records and
+can inject failures. Stand-ins for ``srun``, ``sbatch``, ``squeue``,
+``sacct``, ``sinfo``, ``bsub``, ``bjobs``, ``bqueues``, ``qsub``,
+``qstat``, ``qacct`` and ``qconf`` talk to the daemon over a unix socket and print what the
+grid runners expect from the real thing. Only the options the grid
+runners use are understood; anything else is ignored.
+
+From python::
+
+    with FakeGrid(slots=8, latency=0.5) as grid:
+        grid.activate()
+        runner = SlurmRunner(...)
+
+From the shell::
+
+    python fakegrid.py serve --socket /tmp/fg.sock --slots 8 &
+    python fakegrid.py install /tmp/fg_bin
+    export ANADAMA_FAKEGRID=/tmp/fg.sock PATH=/tmp/fg_bin:$PATH
+
+This module only uses the standard library so that its commands can
+run it as a plain script without importing the rest of anadama.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import errno
+import random
+import shutil
+import socket
+import getpass
+import argparse
+import tempfile
+import itertools
+import threading
+import subprocess
+import SocketServer
+from collections import OrderedDict
+
+SOCKET_VAR = "ANADAMA_FAKEGRID"
+HOSTNAME = "fakehost"
+TICK = 0.02
+
+PENDING, RUNNING = "PENDING", "RUNNING"
+COMPLETED, FAILED = "COMPLETED", "FAILED"
+TIMEOUT, OUT_OF_MEMORY = "TIMEOUT", "OUT_OF_MEMORY"
+ACTIVE_STATES = (PENDING, RUNNING)
+
+
+class FakeGridError(Exception):
+    pass
+
+
+class FakeJob(object):
+    def __init__(self, job_id, index, argv, dialect, name="job",
+                 queue="fake", cwd=None, env=None, out=os.devnull,
+                 err=os.devnull, mem=1024, cpus=1, time_limit=None):
+        self.job_id = job_id
+        self.index = index # array index, or None
+        self.argv = argv
+        self.dialect = dialect
+        self.name, self.queue = name, queue
+        self.cwd = cwd or os.getcwd()
+        self.env = env or dict()
+        self.out, self.err = out, err
+        self.mem, self.cpus = int(mem), int(cpus)
+        self.time_limit = time_limit # minutes
+        self.state = PENDING
+        self.submitted, self.started, self.ended = time.time(), None, None
+        self.exit_code = None
+        self.message = ""
+        self.maxrss_kb, self.cpu_s = 0, 0.
+        self.proc = None
+
+    def info(self):
+        return {
+            "job_id": self.job_id, "index": self.index, "name": self.name,
+            "queue": self.queue, "state": self.state, "mem": self.mem,
+            "cpus": self.cpus, "submitted": self.submitted,
+            "started": self.started, "ended": self.ended,
+            "exit_code": self.exit_code, "message": self.message,
+            "maxrss_kb": self.maxrss_kb, "cpu_s": self.cpu_s,
+        }
+
+
+def _oom_message(job):
+    used, limit = job.maxrss_kb, job.mem*1024
+    return {
+        "slurm": ("slurmstepd: error: Exceeded job memory limit"
+                  " (%d > %d), being killed"%(used, limit)),
+        "lsf": ("TERM_MEMLIMIT: job killed after reaching LSF memory"
+                " usage limit."),
+    }.get(job.dialect, "error: job %s exceeded h_vmem"%(job.job_id))
+
+
+def _timeout_message(job):
+    return {
+        "slurm": ("slurmstepd: error: *** JOB %s ON %s CANCELLED AT %s DUE"
+                  " TO TIME LIMIT ***"%(job.job_id, HOSTNAME,
+                                        time.strftime("%Y-%m-%dT%H:%M:%S"))),
+        "lsf": ("TERM_RUNLIMIT: job killed after reaching LSF run time"
+                " limit."),
+    }.get(job.dialect, "error: job %s exceeded h_rt"%(job.job_id))
+
+
+def _interpreted(argv, cwd=None):
+    """`argv` with the interpreter of a #! script in front, the way the
+    kernel would run it. Exec'ing the script itself fails with ETXTBSY
+    while any process still has it open for writing, such as a submit
+    command that inherited the descriptor from a runner thread writing
+    another job's script."""
+    try:
+        with open(os.path.join(cwd or "", argv[0])) as f:
+            first = f.readline(256)
+    except (IOError, IndexError):
+        return argv
+    if not first.startswith("#!"):
+        return argv
+    return first[2:].split() + list(argv)
+
+
+class FakeScheduler(object):
+    """The scheduler behind the fake grid commands.
+
+    :keyword slots: CPUs shared by all jobs
+    :keyword mem: MB of memory shared by all jobs
+    :keyword latency: Seconds every job waits in the queue
+    :keyword fail_rate: Chance that a job fails without running
+    :keyword oom_rate: Chance that a job is killed for exceeding its
+      memory request. Jobs that really do exceed it always are.
+    :keyword acct_delay: Seconds after a job ends before accounting
+      tools know about it
+    :keyword minute: Seconds in one minute of requested run time
+    :keyword seed: Seed for failure injection
+    :keyword queues: Comma-separated names of the partitions or queues
+      the grid lists. Jobs may be submitted to any queue.
+    """
+
+    def __init__(self, slots=4, mem=16*1024, latency=0.5, fail_rate=0.,
+                 oom_rate=0., acct_delay=0., minute=60., seed=None,
+                 queues="fake,normal"):
+        self.slots, self.mem = slots, mem
+        self.queues = queues.split(",")
+        self.latency = latency
+        self.fail_rate, self.oom_rate = fail_rate, oom_rate
+        self.acct_delay = acct_delay
+        self.minute = minute
+        self.rng = random.Random(seed)
+        self.jobs = OrderedDict() # (job_id, index) -> FakeJob
+        self.ids = itertools.count(1000)
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+
+
+    def submit(self, argv, dialect, n_tasks=None, array_var=None,
+               env=None, **attrs):
+        """Queue a job, or a job array of `n_tasks` tasks, and return
+        its id"""
+        cpus, mem = int(attrs.get("cpus", 1)), int(attrs.get("mem", 1024))
+        if cpus > self.slots or mem > self.mem:
+            raise FakeGridError(
+                "Requested %d cpus and %dMB; the grid only has %d and %dMB"%(
+                    cpus, mem, self.slots, self.mem))
+        with self.cond:
+            job_id = str(next(self.ids))
+            indexes = range(1, n_tasks+1) if n_tasks else [None]
+            for index in indexes:
+                job_env = dict(env or {})
+                if index is not None:
+                    job_env[array_var] = str(index)
+                job = FakeJob(job_id, index, argv, dialect, env=job_env,
+                              **attrs)
+                self.jobs[(job_id, index)] = job
+            return job_id
+
+
+    def members(self, job_id, index=None):
+        if index is not None:
+            job = self.jobs.get((job_id, int(index)))
+            return [job] if job else []
+        return [ member for (member_id, _), member in self.jobs.iteritems()
+                 if member_id == job_id ]
+
+
+    def wait(self, job_id):
+        with self.cond:
+            while True:
+                members = self.members(job_id)
+                if not members:
+                    raise FakeGridError("No such job "+job_id)
+                if all(job.state not in ACTIVE_STATES for job in members):
+                    return [ job.info() for job in members ]
+                self.cond.wait(1)
+
+
+    def listing(self):
+        with self.cond:
+            return [ job.info() for job in self.jobs.itervalues() ]
+
+
+    def accounting(self, ids):
+        """Info on jobs in `ids`, (job id, array index or None) pairs,
+        or on every job if `ids` is None. Jobs that ended too recently
+        for accounting look like they're still running."""
+        now = time.time()
+        ret = list()
+        with self.cond:
+            if ids is None:
+                jobs = list(self.jobs.itervalues())
+            else:
+                jobs = [ job for job_id, index in ids
+                         for job in self.members(job_id, index) ]
+            for job in jobs:
+                info = job.info()
+                if job.ended and now - job.ended < self.acct_delay:
+                    info["state"] = RUNNING
+                    info["exit_code"] = info["ended"] = None
+                ret.append(info)
+        return ret
+
+
+    def _free(self):
+        running = [ job for job in self.jobs.itervalues()
+                    if job.state == RUNNING ]
+        return (self.slots - sum(job.cpus for job in running),
+                self.mem - sum(job.mem for job in running))
+
+
+    def _finish(self, job, state, exit_code, message=""):
+        job.state, job.exit_code = state, exit_code
+        job.ended = time.time()
+        job.message = message
+        job.proc = None
+        if message and job.err != os.devnull:
+            with open(job.err, 'a') as f:
+                print >> f, message
+
+
+    def _start(self, job):
+        job.started = time.time()
+        roll = self.rng.random()
+        if roll < self.fail_rate:
+            return self._finish(job, FAILED, 1, "fakegrid: injected failure")
+        if roll < self.fail_rate+self.oom_rate:
+            job.maxrss_kb = job.mem*1024+1
+            return self._finish(job, OUT_OF_MEMORY, 137, _oom_message(job))
+
+        env = dict(os.environ)
+        env.update(job.env)
+        out = open(job.out, 'w')
+        err = subprocess.STDOUT if job.err == job.out else open(job.err, 'w')
+        try:
+            job.proc = subprocess.Popen(_interpreted(job.argv, job.cwd),
+                                        cwd=job.cwd, env=env,
+                                        stdout=out, stderr=err)
+        except OSError as e:
+            return self._finish(job, FAILED, 127, "fakegrid: "+str(e))
+        finally:
+            out.close()
+            if err is not subprocess.STDOUT:
+                err.close()
+        job.state = RUNNING
+
+
+    def _reap(self, job):
+        try:
+            pid, status, rusage = os.wait4(job.proc.pid, os.WNOHANG)
+        except OSError as e:
+            if e.errno != errno.ECHILD:
+                raise
+            pid, status, rusage = job.proc.pid, 0, None
+        if not pid:
+            if job.time_limit and \
+               time.time()-job.started > job.time_limit*self.minute:
+                job.proc.kill()
+                job.message = _timeout_message(job)
+            return
+        if rusage:
+            job.maxrss_kb = rusage.ru_maxrss
+            job.cpu_s = rusage.ru_utime+rusage.ru_stime
+        if os.WIFSIGNALED(status):
+            code = 128+os.WTERMSIG(status)
+        else:
+            code = os.WEXITSTATUS(status)
+        if job.message:
+            self._finish(job, TIMEOUT, code, job.message)
+        elif job.maxrss_kb > job.mem*1024:
+            self._finish(job, OUT_OF_MEMORY, 137, _oom_message(job))
+        else:
+            self._finish(job, COMPLETED if code == 0 else FAILED, code)
+
+
+    def step(self):
+        with self.cond:
+            for job in self.jobs.values():
+                if job.state == RUNNING:
+                    self._reap(job)
+            now = time.time()
+            free_slots, free_mem = self._free()
+            for job in self.jobs.values():
+                if free_slots <= 0:
+                    break
+                if job.state != PENDING or now-job.submitted < self.latency:
+                    continue
+                if job.cpus <= free_slots and job.mem <= free_mem:
+                    self._start(job)
+                    free_slots -= job.cpus
+                    free_mem -= job.mem
+            self.cond.notify_all()
+
+
+    def loop(self):
+        while not self.stopped.is_set():
+            self.step()
+            time.sleep(TICK)
+        with self.cond:
+            for job in self.jobs.itervalues():
+                if job.proc:
+                    job.proc.kill()
+
+
+def _native(obj):
+    """json gives back unicode; subprocess wants str"""
+    if isinstance(obj, unicode):
+        return obj.encode("utf-8")
+    elif isinstance(obj, list):
+        return map(_native, obj)
+    elif isinstance(obj, dict):
+        return dict( (_native(k), _native(v)) for k, v in obj.iteritems() )
+    return obj
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    def handle(self):
+        request = _native(json.loads(self.rfile.readline()))
+        sched = self.server.scheduler
+        op = request.pop("op")
+        try:
+            if op == "submit":
+                ret = sched.submit(**request)
+            elif op == "wait":
+                ret = sched.wait(request["job_id"])
+            elif op == "list":
+                ret = sched.listing()
+            elif op == "queues":
+                ret = sched.queues
+            elif op == "acct":
+                ret = sched.accounting(request["ids"])
+            elif op == "shutdown":
+                sched.stopped.set()
+                ret = None
+            else:
+                raise FakeGridError("Unknown operation "+op)
+            response = {"result": ret}
+        except FakeGridError as e:
+            response = {"error": str(e)}
+        self.wfile.write(json.dumps(response)+"\n")
+        self.wfile.flush()
+        if op == "shutdown":
+            # only after answering, or the server may exit first
+            threading.Thread(target=self.server.shutdown).start()
+
+
+class _Server(SocketServer.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+
+def serve(socket_path, scheduler):
+    """Run `scheduler` and answer requests on `socket_path` until told
+    to shut down"""
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = _Server(socket_path, _Handler)
+    server.scheduler = scheduler
+    loop = threading.Thread(target=scheduler.loop)
+    loop.daemon = True
+    loop.start()
+    try:
+        server.serve_forever()
+    finally:
+        scheduler.stopped.set()
+        loop.join()
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def request(op, **kwargs):
+    """Send one request to the fake scheduler named by the
+    ANADAMA_FAKEGRID environment variable"""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(os.environ[SOCKET_VAR])
+    except KeyError:
+        raise FakeGridError(SOCKET_VAR+" is not set")
+    f = sock.makefile('rw')
+    kwargs["op"] = op
+    f.write(json.dumps(kwargs)+"\n")
+    f.flush()
+    response = _native(json.loads(f.readline()))
+    sock.close()
+    if "error" in response:
+        raise FakeGridError(response["error"])
+    return response["result"]
+
+
+##################
+# Command helpers
+##################
+
+
+def parse_args(argv, spec):
+    """Split `argv` into options and the command that follows them.
+    `spec` maps options to how many values they take; options not in
+    `spec` are taken to be flags. ``--long=value`` options need no
+    entry."""
+    opts, i = dict(), 0
+    while i < len(argv):
+        arg = argv[i]
+        if not arg.startswith("-") or arg == "-":
+            break
+        if arg.startswith("--") and "=" in arg:
+            key, val = arg.split("=", 1)
+            opts[key] = val
+            i += 1
+            continue
+        n = spec.get(arg, 0)
+        vals = argv[i+1:i+1+n]
+        opts[arg] = vals[0] if n == 1 else (tuple(vals) if n else True)
+        i += 1+n
+    return opts, argv[i:]
+
+
+def _opt(opts, *names, **kwargs):
+    for name in names:
+        if name in opts:
+            return opts[name]
+    return kwargs.get("default")
+
+
+def _array_size(spec):
+    """Number of tasks in an array spec like 1-10, 1-10%2 or 1-10:1"""
+    if not spec:
+        return None
+    match = re.match(r'(\d+)(?:-(\d+))?', spec)
+    first, last = int(match.group(1)), int(match.group(2) or match.group(1))
+    return last-first+1
+
+
+def _split_id(job_id):
+    """Turn 123, 123_4, 123[4] or 123.4 into (job id, index or None)"""
+    match = re.match(r'(\d+)(?:[_.\[](\d+)\]?)?$', job_id)
+    if not match:
+        raise FakeGridError("Bad job id "+job_id)
+    index = match.group(2)
+    return match.group(1), int(index) if index else None
+
+
+def _display_id(info, sep="_", close=""):
+    if info["index"] is None:
+        return info["job_id"]
+    return "%s%s%d%s"%(info["job_id"], sep, info["index"], close)
+
+
+def _hms(seconds):
+    seconds = int(round(seconds or 0))
+    return "%02d:%02d:%02d"%(seconds//3600, seconds//60%60, seconds%60)
+
+
+def _elapsed(info):
+    if not info["started"]:
+        return 0
+    return (info["ended"] or time.time()) - info["started"]
+
+
+def _submit_and_maybe_wait(argv, dialect, wait, **attrs):
+    """Submit a job. If `wait`, also block for it and return its info
+    along with its stdout and stderr, when the caller didn't redirect
+    them."""
+    tmp = list()
+    if wait:
+        for key in ("out", "err"):
+            if attrs.get(key) in (None, os.devnull):
+                fd, attrs[key] = tempfile.mkstemp(prefix="fakegrid_")
+                os.close(fd)
+                tmp.append(attrs[key])
+    attrs.setdefault("out", os.devnull)
+    attrs.setdefault("err", attrs["out"])
+    attrs["env"] = dict(os.environ)
+    job_id = request("submit", argv=argv, dialect=dialect, **attrs)
+    if not wait:
+        return job_id, None, "", ""
+    info = request("wait", job_id=job_id)[0]
+    outputs = list()
+    for path in (attrs["out"], attrs["err"]):
+        if path in tmp:
+            with open(path) as f:
+                outputs.append(f.read())
+        else:
+            outputs.append("")
+    for path in tmp:
+        os.unlink(path)
+    return job_id, info, outputs[0], outputs[1]
+
+
+def _exit_code(info):
+    code = info["exit_code"]
+    return code if code is not None else 1
+
+
+##################
+# Slurm
+##################
+
+SLURM_SPEC = {"-o": 1, "-e": 1, "-p": 1, "-c": 1, "-a": 1, "-J": 1,
+              "-t": 1, "-n": 1, "-u": 1, "-j": 1, "-M": 1}
+
+
+def _slurm_attrs(opts):
+    return dict(mem=_opt(opts, "--mem", default=1024),
+                cpus=_opt(opts, "--cpus-per-task", "-c", default=1),
+                time_limit=int(_opt(opts, "--time", "-t", default=0)) or None,
+                queue=_opt(opts, "--partition", "-p", default="fake"),
+                name=_opt(opts, "--job-name", "-J", default="job"),
+                cwd=os.getcwd())
+
+
+def srun(argv):
+    opts, command = parse_args(argv, SLURM_SPEC)
+    if not command:
+        print >> sys.stderr, "srun: fatal: No command given to execute."
+        return 1
+    job_id, info, out, err = _submit_and_maybe_wait(
+        command, "slurm", True, **_slurm_attrs(opts))
+    if "-v" in opts:
+        print >> sys.stderr, ("srun: launching %s.0 on host %s, 1 tasks: 0"
+                              %(job_id, HOSTNAME))
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    if info["message"]:
+        print >> sys.stderr, info["message"]
+    if info["exit_code"]:
+        print >> sys.stderr, ("srun: error: %s: task 0: Exited with exit"
+                              " code %d"%(HOSTNAME, info["exit_code"]))
+    return _exit_code(info)
+
+
+def sbatch(argv):
+    opts, command = parse_args(argv, SLURM_SPEC)
+    if "--wrap" in opts:
+        command = ["/bin/sh", "-c", opts["--wrap"]]
+    if not command:
+        print >> sys.stderr, "sbatch: error: No batch script given"
+        return 1
+    attrs = _slurm_attrs(opts)
+    attrs["out"] = _opt(opts, "--output", "-o", default=os.devnull)
+    attrs["err"] = _opt(opts, "--error", "-e", default=attrs["out"])
+    n_tasks = _array_size(_opt(opts, "--array", "-a"))
+    job_id, _, _, _ = _submit_and_maybe_wait(
+        command, "slurm", False, n_tasks=n_tasks,
+        array_var="SLURM_ARRAY_TASK_ID", **attrs)
+    if "--parsable" in opts:
+        print job_id
+    else:
+        print "Submitted batch job "+job_id
+    return 0
+
+
+def _collapse(indexes):
+    """Format array indexes like squeue: 1-3,5"""
+    ranges = list()
+    for i in sorted(indexes):
+        if ranges and ranges[-1][1] == i-1:
+            ranges[-1][1] = i
+        else:
+            ranges.append([i, i])
+    return ",".join( str(a) if a == b else "%d-%d"%(a, b)
+                     for a, b in ranges )
+
+
+def squeue(argv):
+    opts, _ = parse_args(argv, SLURM_SPEC)
+    fmt = _opt(opts, "-o", "--format", default="%i %T %j")
+    rows, pending = list(), OrderedDict()
+    for info in request("list"):
+        if info["state"] not in ACTIVE_STATES:
+            continue
+        if info["state"] == PENDING and info["index"] is not None:
+            pending.setdefault(info["job_id"], (info, list()))[1].append(
+                info["index"])
+            continue
+        rows.append((_display_id(info), info))
+    for job_id, (info, indexes) in pending.iteritems():
+        rows.append(("%s_[%s]"%(job_id, _collapse(indexes)), info))
+
+    if "-h" not in opts and "--noheader" not in opts:
+        print fmt.replace("%i", "JOBID").replace("%T", "STATE")\
+                 .replace("%j", "NAME")
+    for display_id, info in rows:
+        print fmt.replace("%i", display_id).replace("%T", info["state"])\
+                 .replace("%j", info["name"])
+    return 0
+
+
+def sinfo(argv):
+    # only ever asked for partition names, with -h -o %R
+    for queue in request("queues"):
+        print queue
+    return 0
+
+
+SACCT_FIELDS = {
+    "jobid":    lambda info: _display_id(info),
+    "jobname":  lambda info: info["name"],
+    "maxrss":   lambda info: ("%dK"%(info["maxrss_kb"])
+                              if info["ended"] else ""),
+    "totalcpu": lambda info: _hms(info["cpu_s"]) if info["ended"] else "",
+    "elapsed":  lambda info: _hms(_elapsed(info)),
+    "exitcode": lambda info: "%d:0"%(info["exit_code"] or 0),
+    "state":    lambda info: info["state"],
+}
+
+
+def sacct(argv):
+    opts, _ = parse_args(argv, dict(SLURM_SPEC, **{"--format": 1}))
+    fields = _opt(opts, "--format", "-o",
+                  default="JobID,JobName,State,ExitCode").split(",")
+    ids = [ _split_id(i) for i in _opt(opts, "-j", "--jobs",
+                                       default="").split(",") if i ]
+    parsable = "-P" in opts or "--parsable2" in opts
+    sep = "|" if parsable else " "
+    fmt = (lambda v: v) if parsable else (lambda v: "%-10s"%(v))
+    if "-n" not in opts and "--noheader" not in opts:
+        print sep.join( fmt(f) for f in fields )
+    for info in request("acct", ids=ids):
+        print sep.join( fmt(SACCT_FIELDS[f.lower()](info)) for f in fields )
+    return 0
+
+
+##################
+# LSF
+##################
+
+LSF_SPEC = {"-o": 1, "-e": 1, "-R": 1, "-n": 1, "-q": 1, "-J": 1, "-M": 1,
+            "-W": 1, "-u": 1}
+
+
+def _lsf_state(info):
+    return {PENDING: "PEND", RUNNING: "RUN",
+            COMPLETED: "DONE"}.get(info["state"], "EXIT")
+
+
+def bsub(argv):
+    opts, command = parse_args(argv, LSF_SPEC)
+    if not command:
+        print >> sys.stderr, "No command is specified. Job not submitted."
+        return 255
+    name = _opt(opts, "-J", default=os.path.basename(command[0]))
+    match = re.match(r'(.*)\[(.+)\]$', name)
+    n_tasks = None
+    if match:
+        name, n_tasks = match.group(1), _array_size(match.group(2))
+    mem = re.search(r'mem=(\d+)', _opt(opts, "-R", default=""))
+    attrs = dict(mem=mem.group(1) if mem else _opt(opts, "-M", default=1024),
+                 cpus=_opt(opts, "-n", default=1),
+                 time_limit=int(_opt(opts, "-W", default=0)) or None,
+                 queue=_opt(opts, "-q", default="normal"), name=name,
+                 cwd=os.getcwd())
+    attrs["out"] = _opt(opts, "-o", default=os.devnull)
+    attrs["err"] = _opt(opts, "-e", default=attrs["out"])
+    wait = "-K" in opts
+    if wait:
+        # like LSF, print the submission message before the job runs
+        job_id = request("submit", argv=command, dialect="lsf",
+                         env=dict(os.environ), **attrs)
+        print "Job <%s> is submitted to queue <%s>."%(job_id, attrs["queue"])
+        print "<<Waiting for dispatch ...>>"
+        sys.stdout.flush()
+        info = request("wait", job_id=job_id)[0]
+        print "<<Job is finished>>" if info["exit_code"] == 0 \
+            else "Job <%s> exited with exit code %s"%(job_id,
+                                                     info["exit_code"])
+        if info["message"]:
+            print >> sys.stderr, info["message"]
+        return _exit_code(info)
+
+    job_id, _, _, _ = _submit_and_maybe_wait(
+        command, "lsf", False, n_tasks=n_tasks, array_var="LSB_JOBINDEX",
+        **attrs)
+    print "Job <%s> is submitted to queue <%s>."%(job_id, attrs["queue"])
+    return 0
+
+
+BJOBS_FIELDS = {
+    "jobid":       lambda info: info["job_id"],
+    "jobindex":    lambda info: str(info["index"] or 0),
+    "job_name":    lambda info: info["name"],
+    "queue":       lambda info: info["queue"],
+    "stat":        _lsf_state,
+    "cpu_used":    lambda info: ("%.1f second(s)"%(info["cpu_s"])
+                                 if info["ended"] else "-"),
+    "max_mem":     lambda info: ("%d Mbytes"%(info["maxrss_kb"]//1024)
+                                 if info["ended"] else "-"),
+    "run_time":    lambda info: "%d second(s)"%(_elapsed(info)),
+    "exit_code":   lambda info: str(info["exit_code"] or "-"),
+    "exit_reason": lambda info: ({OUT_OF_MEMORY: "TERM_MEMLIMIT",
+                                  TIMEOUT: "TERM_RUNLIMIT"}
+                                 .get(info["state"], "-")),
+}
+
+
+def bqueues(argv):
+    print "QUEUE_NAME      PRIO STATUS          MAX JL/U JL/P JL/H NJOBS"
+    for queue in request("queues"):
+        print "%-15s 30   Open:Active       -    -    -    -     0"%(queue)
+    return 0
+
+
+def _bjobs_format(fmt):
+    delim = re.search(r'delimiter=["\'](.*?)["\']', fmt)
+    fmt = re.sub(r'delimiter=["\'].*?["\']', "", fmt)
+    return fmt.split(), delim.group(1) if delim else " "
+
+
+def bjobs(argv):
+    opts, ids = parse_args(argv, LSF_SPEC)
+    fields, delim = _bjobs_format(_opt(opts, "-o", default="jobid stat "
+                                       "queue job_name"))
+    if ids:
+        infos = request("acct", ids=[ _split_id(i) for i in ids ])
+    else:
+        infos = request("list")
+    if "-noheader" not in opts:
+        print delim.join( f.upper() for f in fields )
+    for info in infos:
+        print delim.join( BJOBS_FIELDS[f](info) for f in fields )
+    return 0
+
+
+##################
+# SGE
+##################
+
+SGE_SPEC = {"-R": 1, "-b": 1, "-sync": 1, "-pe": 2, "-l": 1, "-q": 1,
+            "-o": 1, "-e": 1, "-t": 1, "-N": 1, "-S": 1, "-u": 1, "-j": 1,
+            "-sp": 1}
+SGE_PE = "smp"
+
+
+def _sge_resources(spec):
+    return dict( kv.split("=", 1) for kv in spec.split(",") if "=" in kv )
+
+
+def _sge_mem(val):
+    match = re.match(r'([\d.]+)([KMGkmg]?)', val)
+    num, unit = float(match.group(1)), match.group(2).upper()
+    return num * {"K": 1/1024., "M": 1, "G": 1024, "": 1/1024./1024}[unit]
+
+
+def qsub(argv):
+    opts, command = parse_args(argv, SGE_SPEC)
+    if not command:
+        print >> sys.stderr, "Unable to read script file"
+        return 1
+    resources = _sge_resources(_opt(opts, "-l", default=""))
+    cpus = int(_opt(opts, "-pe", default=(None, 1))[1])
+    mem = resources.get("m_mem_free", resources.get("h_vmem"))
+    mem = _sge_mem(mem)*cpus if mem else 1024
+    h_rt = resources.get("h_rt")
+    time_limit = None
+    if h_rt:
+        parts = map(int, h_rt.split(":"))
+        time_limit = (sum( p*60**i for i, p in enumerate(reversed(parts)) )
+                      / 60. or None)
+    name = _opt(opts, "-N", default=os.path.basename(command[0]))
+    task_spec = _opt(opts, "-t")
+    n_tasks = _array_size(task_spec)
+    attrs = dict(mem=int(mem), cpus=cpus, time_limit=time_limit,
+                 queue=_opt(opts, "-q", default="all.q"), name=name,
+                 cwd=os.getcwd())
+    attrs["out"] = _opt(opts, "-o", default=os.devnull)
+    attrs["err"] = _opt(opts, "-e", default=os.devnull)
+    wait = _opt(opts, "-sync") == "y"
+    job_id, info, out, err = _submit_and_maybe_wait(
+        command, "sge", wait, n_tasks=n_tasks, array_var="SGE_TASK_ID",
+        **attrs)
+    if "-terse" in opts:
+        print job_id+(".1-%d:1"%(n_tasks) if n_tasks else "")
+    elif n_tasks:
+        print ('Your job-array %s.1-%d:1 ("%s") has been submitted'
+               %(job_id, n_tasks, name))
+    else:
+        print 'Your job %s ("%s") has been submitted'%(job_id, name)
+    if not wait:
+        return 0
+    sys.stdout.write(out)
+    sys.stderr.write(err)
+    print "Job %s exited with exit code %s."%(job_id, info["exit_code"])
+    return _exit_code(info)
+
+
+def qstat(argv):
+    opts, _ = parse_args(argv, SGE_SPEC)
+    user = _opt(opts, "-u", default=getpass.getuser())
+    infos = [ info for info in request("list")
+              if info["state"] in ACTIVE_STATES ]
+    if not infos:
+        return 0
+    print ("job-ID  prior   name       user         state submit/start at"
+           "     queue                          slots ja-task-ID")
+    print "-"*100
+    for info in infos:
+        print "%7s 0.50000 %-10s %-12s %-5s %s %-30s %5d %s"%(
+            info["job_id"], info["name"][:10], user[:12],
+            "r" if info["state"] == RUNNING else "qw",
+            time.strftime("%m/%d/%Y %H:%M:%S",
+                          time.localtime(info["started"]
+                                         or info["submitted"])),
+            info["queue"]+"@"+HOSTNAME, info["cpus"],
+            info["index"] or "")
+    return 0
+
+
+def _qacct_time(spec):
+    """Seconds since the epoch for a qacct time like [CC]YYMMDDhhmm"""
+    fmt = "%Y%m%d%H%M" if len(spec) == 12 else "%y%m%d%H%M"
+    return time.mktime(time.strptime(spec, fmt))
+
+
+def qacct(argv):
+    argv = list(argv)
+    if "-j" in argv:
+        # -j with no job id lists every job
+        i = argv.index("-j")
+        if i+1 == len(argv) or argv[i+1].startswith("-"):
+            del argv[i]
+            argv.append("-jall")
+    opts, _ = parse_args(argv, SGE_SPEC)
+    job_id, index = _opt(opts, "-j"), _opt(opts, "-t")
+    ids = None if "-jall" in opts else [(job_id, index)]
+    begin = _qacct_time(opts["-b"]) if "-b" in opts else 0
+    infos = [ info for info in request("acct", ids=ids)
+              if info["ended"] and info["started"] >= begin ]
+    if not infos:
+        print >> sys.stderr, "error: job id %s not found"%(job_id)
+        return 1
+    for info in infos:
+        wallclock = _elapsed(info)
+        print "="*62
+        for key, val in (
+                ("qname", info["queue"]), ("hostname", HOSTNAME),
+                ("jobname", info["name"]), ("jobnumber", info["job_id"]),
+                ("taskid", info["index"] or "undefined"),
+                ("exit_status", info["exit_code"]),
+                ("ru_wallclock", "%.3fs"%(wallclock)),
+                ("wallclock", "%.3f"%(wallclock)),
+                ("cpu", "%.3f"%(info["cpu_s"])),
+                ("mem", "%.3f"%(info["maxrss_kb"]/1024./1024*wallclock)),
+                ("maxvmem", "%.3fM"%(info["maxrss_kb"]/1024.))):
+            print "%-13s%s"%(key, val)
+    return 0
+
+
+def qconf(argv):
+    opts, _ = parse_args(argv, SGE_SPEC)
+    if "-spl" in opts:
+        print SGE_PE
+    elif "-sql" in opts:
+        print "\n".join(request("queues"))
+    elif _opt(opts, "-sp") == SGE_PE:
+        print "pe_name            "+SGE_PE
+        print "slots              999"
+        print "allocation_rule    $pe_slots"
+    else:
+        print >> sys.stderr, "fakegrid: qconf only knows -spl, -sp and -sql"
+        return 1
+    return 0
+
+
+COMMANDS = {
+    "srun": srun, "sbatch": sbatch, "squeue": squeue, "sacct": sacct,
+    "sinfo": sinfo, "bsub": bsub, "bjobs": bjobs, "bqueues": bqueues,
+    "qsub": qsub, "qstat": qstat, "qacct": qacct, "qconf": qconf,
+}
+
+
+def _script_path():
+    path = os.path.abspath(__file__)
+    return path[:-1] if path.endswith(".pyc") else path
+
+
+def install(bindir):
+    """Write the fake grid commands to `bindir`"""
+    if not os.path.isdir(bindir):
+        os.makedirs(bindir)
+    me = _script_path()
+    for name in COMMANDS:
+        path = os.path.join(bindir, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n'%(
+                sys.executable, me, name))
+        os.chmod(path, 0o755)
+
+
+class FakeGrid(object):
+    """Run a fake scheduler daemon with its commands installed in a
+    temporary directory. Keyword arguments go to
+    :class:`FakeScheduler`."""
+
+    def __init__(self, **settings):
+        self.settings = settings
+        self.workdir = None
+        self.proc = None
+        self._old_environ = None
+
+    @property
+    def socket_path(self):
+        return os.path.join(self.workdir, "sock")
+
+    @property
+    def bindir(self):
+        return os.path.join(self.workdir, "bin")
+
+    @property
+    def env(self):
+        """Environment for running the fake grid commands"""
+        env = dict(os.environ)
+        env["PATH"] = self.bindir+os.pathsep+env.get("PATH", "")
+        env[SOCKET_VAR] = self.socket_path
+        return env
+
+    def start(self):
+        self.workdir = tempfile.mkdtemp(prefix="fakegrid")
+        install(self.bindir)
+        cmd = [sys.executable, _script_path(), "serve",
+               "--socket", self.socket_path]
+        for key, val in self.settings.iteritems():
+            cmd += ["--"+key.replace("_", "-"), str(val)]
+        self.proc = subprocess.Popen(cmd)
+        while not os.path.exists(self.socket_path):
+            if self.proc.poll() is not None:
+                raise FakeGridError("fake scheduler didn't start")
+            time.sleep(TICK)
+        return self
+
+    def activate(self):
+        """Put the fake grid commands on this process' PATH"""
+        self._old_environ = dict(os.environ)
+        os.environ.update(self.env)
+
+    def stop(self):
+        if self._old_environ is not None:
+            os.environ.clear()
+            os.environ.update(self._old_environ)
+            self._old_environ = None
+        if self.proc and self.proc.poll() is None:
+            os.environ[SOCKET_VAR] = self.socket_path
+            try:
+                request("shutdown")
+            finally:
+                del os.environ[SOCKET_VAR]
+            self.proc.wait()
+        if self.workdir:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main(argv=sys.argv):
+    name = argv[1] if len(argv) > 1 else None
+    if name in COMMANDS:
+        try:
+            return COMMANDS[name](argv[2:])
+        except (FakeGridError, socket.error) as e:
+            print >> sys.stderr, "%s: %s"%(name, e)
+            return 1
+    elif name == "install" and len(argv) > 2:
+        install(argv[2])
+        return 0
+    elif name == "serve":
+        parser = argparse.ArgumentParser(prog="fakegrid serve")
+        parser.add_argument("--socket", required=True)
+        parser.add_argument("--slots", type=int, default=4)
+        parser.add_argument("--mem", type=int, default=16*1024)
+        parser.add_argument("--latency", type=float, default=0.5)
+        parser.add_argument("--fail-rate", type=float, default=0.)
+        parser.add_argument("--oom-rate", type=float, default=0.)
+        parser.add_argument("--acct-delay", type=float, default=0.)
+        parser.add_argument("--minute", type=float, default=60.)
+        parser.add_argument("--seed", type=int, default=None)
+        parser.add_argument("--queues", default="fake,normal")
+        args = vars(parser.parse_args(argv[2:]))
+        serve(args.pop("socket"), FakeScheduler(**args))
+        return 0
+    print >> sys.stderr, ("usage: fakegrid.py serve|install BINDIR|"
+                          +"|".join(sorted(COMMANDS))+" [args]")
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""Time the grid runners spend in ``finish()``, collecting accounting
+for the performance predictor, against the fake scheduler in
+fakegrid.py. Accounting is collected in the background
+while the pipeline runs, so most of it should be done by the time the
+run is.
+
+Usage::
+
+    python benchmarks/grid_accounting.py [n_tasks [slots [latency_s]]]
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+from doit.control import TaskControl
+from doit.dependency import Dependency
+from doit.reporter import ZeroReporter
+
+from anadama.runner import SlurmRunner, LSFRunner, SGERunner
+from fakegrid import FakeGrid
+
+from fake_grid import fanout_tasks
+
+RUNNERS = (("slurm", SlurmRunner), ("lsf", LSFRunner), ("sge", SGERunner))
+
+
+def run_one(runner_cls, n_tasks, slots):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        control = TaskControl(fanout_tasks(tmpdir, n_tasks))
+        control.process(None)
+        runner = runner_cls(
+            "fake", os.path.join(tmpdir, "perf.json"), tmpdir, "",
+            Dependency, os.path.join(tmpdir, "doit.db"),
+            ZeroReporter(None, {}), num_process=slots,
+            probe_cache=os.path.join(tmpdir, "probes"),
+            submit_mode="async", poll_interval=0.25)
+        accounted = list()
+        runner.performance_predictor.update = \
+            lambda task, *stats: accounted.append(task.name)
+        timings = dict()
+        finish = runner.finish
+        def timed_finish():
+            start = time.time()
+            try:
+                return finish()
+            finally:
+                timings["finish"] = time.time() - start
+        runner.finish = timed_finish
+
+        start = time.time()
+        failed = runner.run_all(control.task_dispatcher())
+        elapsed = time.time() - start
+        assert not failed, "%s run failed"%(runner_cls.__name__)
+        return elapsed, timings["finish"], len(accounted)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(argv):
+    n_tasks = int(argv[0]) if argv else 300
+    slots = int(argv[1]) if len(argv) > 1 else 16
+    latency = float(argv[2]) if len(argv) > 2 else 0.1
+
+    print "runner\ttasks\twall_s\tfinish_s\taccounted"
+    for name, runner_cls in RUNNERS:
+        with FakeGrid(slots=slots, latency=latency) as grid:
+            grid.activate()
+            elapsed, finish, accounted = run_one(runner_cls, n_tasks, slots)
+        print "%s\t%d\t%.1f\t%.2f\t%d" %(name, n_tasks, elapsed,
+                                         finish, accounted)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,111 @@
+"""Wall-clock time to push many tiny tasks through an async grid
+runner, one grid job per task versus bundles of short tasks.
+
+The grid is faked locally: a fixed number of slots, and a queue wait
+paid by every grid job before it starts.
+
+Usage::
+
+    python benchmarks/grid_bundling.py [n_tasks [slots [queue_wait_s]]]
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+from collections import deque
+
+from doit.task import Task
+from doit.control import TaskControl
+from doit.dependency import Dependency
+from doit.reporter import ZeroReporter
+
+from anadama.runner.grid import DummyGridRunner
+
+
+class FakeQueueRunner(DummyGridRunner):
+    """DummyGridRunner that only runs `slots` grid jobs at a time, each
+    after waiting `queue_wait` seconds"""
+    launcher = ""
+    slots = 4
+    queue_wait = 1
+
+    def __init__(self, *args, **kwargs):
+        self.queued = deque()
+        super(FakeQueueRunner, self).__init__(*args, **kwargs)
+
+    def _grid_submit(self, job, partition, extra_grid_args=""):
+        wrapper = job.write_wrapper()
+        job_id = next(self.task_id_counter)
+        self.queued.append((job_id, wrapper))
+        self.local_jobs[job_id] = list()
+        return wrapper, (str(job_id), "", 0)
+
+    def _grid_active(self):
+        running = sum( 1 for procs in self.local_jobs.itervalues()
+                       if any(p.poll() is None for p in procs) )
+        while self.queued and running < self.slots:
+            job_id, wrapper = self.queued.popleft()
+            self.local_jobs[job_id].append(subprocess.Popen(
+                ["/bin/sh", "-c", "sleep %s; exec %s"%(self.queue_wait,
+                                                        wrapper)]))
+            running += 1
+        active = dict()
+        for job_id, procs in self.local_jobs.iteritems():
+            running = sum( p.poll() is None for p in procs )
+            if running or not procs:
+                active[job_id] = running
+        return active
+
+    def _record_performance(self, id, err):
+        self.task_performance_info[id] = (0, 0, 0)
+
+
+def tiny_tasks(tmpdir, n_tasks):
+    return [ Task("convert%d"%(i),
+                  ["echo %d > %s"%(i, os.path.join(tmpdir, "out%d"%(i)))],
+                  targets=[os.path.join(tmpdir, "out%d"%(i))],
+                  title=lambda task: "time=1")
+             for i in range(n_tasks) ]
+
+
+def run_one(n_tasks, bundle_under=0, bundle_budget=60):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        control = TaskControl(tiny_tasks(tmpdir, n_tasks))
+        control.process(None)
+        runner = FakeQueueRunner(
+            "fake", os.path.join(tmpdir, "perf.json"), tmpdir, "",
+            Dependency, os.path.join(tmpdir, "doit.db"),
+            ZeroReporter(None, {}), num_process=1,
+            probe_cache=os.path.join(tmpdir, "probes"),
+            submit_mode="async", poll_interval=0.1, min_array_size=0,
+            bundle_under=bundle_under, bundle_budget=bundle_budget)
+        start = time.time()
+        failed = runner.run_all(control.task_dispatcher())
+        elapsed = time.time() - start
+        assert not failed
+        return elapsed
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def main(argv):
+    n_tasks = int(argv[0]) if argv else 40
+    FakeQueueRunner.slots = int(argv[1]) if len(argv) > 1 else 4
+    FakeQueueRunner.queue_wait = float(argv[2]) if len(argv) > 2 else 1
+    # spread the tasks' predicted minutes evenly over the slots
+    budget = -(-n_tasks // FakeQueueRunner.slots)
+
+    single = run_one(n_tasks)
+    bundled = run_one(n_tasks, bundle_under=5, bundle_budget=budget)
+    print "tasks\tslots\tsingle_s\tbundled_s\tspeedup"
+    print "%d\t%d\t%.1f\t%.1f\t%.1fx" %(n_tasks, FakeQueueRunner.slots,
+                                        single, bundled, single/bundled)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
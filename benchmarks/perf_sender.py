@@ -0,0 +1,130 @@
+"""Time how long WebPerformancePredictor holds up a runner, against a
+local HTTP stand-in for the performance endpoint that answers slowly,
+or not at all. ``update()`` and ``save()`` should take about as long
+either way. Records not yet received when ``save()`` returns are
+spooled for the next run to send.
+
+With the defaults, 100 records and a 2s delay::
+
+    endpoint  records  update_s  save_s  received  spooled
+    fast      100      0.009     0.008   100       0
+    slow      100      0.011     2.003   20        80
+    down      100      0.009     0.005   0         100
+
+The slow endpoint gets the first full batch. How many of the rest it
+also gets varies from run to run: a batch stays spooled until the
+sender hears back, so one the sender gave up waiting on can be both
+received and spooled, and be sent again by the next run.
+
+Usage::
+
+    python benchmarks/perf_sender.py [n_records [delay_s]]
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import threading
+import BaseHTTPServer
+
+from doit.task import Task
+
+from anadama import performance
+
+
+class SlowEndpoint(BaseHTTPServer.HTTPServer):
+    def __init__(self, delay):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), _Handler)
+        self.delay = delay
+        self.received = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # the sender stopped waiting for the answer
+        pass
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/"%(self.server_address[1])
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.server.delay)
+        self.server.received += len(json.loads(body))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def tasks(tmpdir, n):
+    for i in range(n):
+        dep = os.path.join(tmpdir, "in%d"%(i))
+        with open(dep, 'w') as f:
+            f.write("x"*1024)
+        yield Task("task%d"%(i), ["echo"], file_dep=[dep],
+                   targets=[os.path.join(tmpdir, "out%d"%(i))])
+
+
+def run_one(url, tmpdir, n):
+    predictor = performance.WebPerformancePredictor(url)
+    predictor.sender.spool = os.path.join(tmpdir, "spool")
+    start = time.time()
+    for task in tasks(tmpdir, n):
+        predictor.update(task, 100, 0.01, 0.02)
+    updated = time.time()
+    sender = predictor.sender.thread
+    predictor.save()
+    return updated - start, time.time() - updated, sender
+
+
+def spooled(tmpdir):
+    spool = os.path.join(tmpdir, "spool")
+    if not os.path.isdir(spool):
+        return 0
+    total = 0
+    for name in os.listdir(spool):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(spool, name)) as f:
+            total += len(json.load(f))
+    return total
+
+
+def main(argv):
+    n = int(argv[0]) if argv else 100
+    delay = float(argv[1]) if len(argv) > 1 else 2.
+
+    print "endpoint\trecords\tupdate_s\tsave_s\treceived\tspooled"
+    for name, server in (("fast", SlowEndpoint(0)),
+                         ("slow", SlowEndpoint(delay)),
+                         ("down", None)):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # nothing listens on port 1
+            url = server.url if server else "http://127.0.0.1:1/"
+            update_s, save_s, sender = run_one(url, tmpdir, n)
+            # count once a sender still waiting on the endpoint, and
+            # the endpoint, are done: a batch is spooled before it's
+            # sent and only removed once the sender hears back
+            sender.join()
+            if server:
+                server.shutdown()
+            print "%s\t%d\t%.3f\t%.3f\t%d\t%d"%(
+                name, n, update_s, save_s,
+                server.received if server else 0, spooled(tmpdir))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,101 @@
+"""Disk footprint and start-up time of picklerunner scripts: the
+current launcher and compressed payload, against the old format that
+put ``repr()`` of the pickle in the script itself.
+
+Start-up is timed from launching the script until it exits, with the
+task running ``true``; interpreter start-up and running the task are
+the same in both columns, the rest is loading the task.
+
+Usage::
+
+    python benchmarks/picklerunner_format.py [n_file_dep [n_file_dep ...]]
+
+Each task depends on ``n_file_dep`` files, to vary how big its pickle is.
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+
+from doit.task import Task
+
+from anadama import picklerunner
+from anadama.pickler import cloudpickle
+
+DEFAULT_SIZES = (10, 1000, 100000)
+REPEATS = 5
+
+# anadama's picklerunner template before the payload moved out of it
+LEGACY_TEMPLATE = \
+"""#!{python_bin}
+
+import os
+import sys
+import cPickle as pickle
+
+the_pickle = {pickle}
+
+task = pickle.loads(the_pickle)
+task.__init__(task.name, task.some_actions)
+
+def main():
+    return task.execute(out=sys.stdout, err=sys.stderr)
+
+if __name__ == '__main__':
+    sys.exit(main())
+"""
+
+
+def task(n_file_dep):
+    deps = [ "/data/raw/sample%d.fastq"%(i) for i in xrange(n_file_dep) ]
+    return Task("bench", ["true"], file_dep=deps, targets=["/data/out"])
+
+
+def legacy(tmpdir, t):
+    script = picklerunner.PickleScript(t)
+    path = os.path.join(tmpdir, "legacy_picklerunner.py")
+    with open(path, 'w') as f:
+        f.write(LEGACY_TEMPLATE.format(
+            python_bin=sys.executable,
+            pickle=repr(cloudpickle.dumps(script.task))))
+    return [sys.executable, path], [path]
+
+
+def current(tmpdir, t):
+    path = os.path.join(tmpdir, "current_picklerunner.py")
+    picklerunner.PickleScript(t).save(path=path)
+    return [sys.executable, path], [path, picklerunner.payload_path(path)]
+
+
+def startup_s(argv):
+    best = None
+    for _ in range(REPEATS):
+        start = time.time()
+        subprocess.check_call(argv)
+        took = time.time() - start
+        best = took if best is None else min(best, took)
+    return best
+
+
+def main(argv):
+    sizes = [ int(a) for a in argv ] or DEFAULT_SIZES
+    print "file_dep\tformat\tpickle_kb\tdisk_kb\tstartup_s"
+    for n in sizes:
+        t = task(n)
+        pickle_kb = len(cloudpickle.dumps(t))/1024.
+        for name, save in (("legacy", legacy), ("current", current)):
+            tmpdir = tempfile.mkdtemp()
+            try:
+                argv, paths = save(tmpdir, task(n))
+                disk_kb = sum(os.path.getsize(p) for p in paths)/1024.
+                print "%d\t%s\t%.1f\t%.1f\t%.3f"%(
+                    n, name, pickle_kb, disk_kb, startup_s(argv))
+            finally:
+                shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,117 @@
+"""WebPerformancePredictor shouldn't hold up a runner's shutdown, however
+slow or unreachable the performance endpoint is."""
+
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+import threading
+import BaseHTTPServer
+
+from doit.task import Task
+
+from anadama import performance
+
+N_RECORDS = 50
+SLOW = performance.FINAL_TIMEOUT + 2 # seconds the slow endpoint takes
+
+
+class Endpoint(BaseHTTPServer.HTTPServer):
+    def __init__(self, delay):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), _Handler)
+        self.delay = delay
+        self.received = 0
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def handle_error(self, request, client_address):
+        # the sender stopped waiting for the answer
+        pass
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/"%(self.server_address[1])
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(self.server.delay)
+        self.server.received += len(json.loads(body))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestBackgroundSender(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.spool = os.path.join(self.tmpdir, "spool")
+        self.server = None
+
+    def tearDown(self):
+        if self.server:
+            self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def _tasks(self):
+        for i in range(N_RECORDS):
+            dep = os.path.join(self.tmpdir, "in%d"%(i))
+            with open(dep, 'w') as f:
+                f.write("x")
+            yield Task("task%d"%(i), ["echo"], file_dep=[dep])
+
+    def _run(self, url):
+        """Returns seconds spent in update() and in save()"""
+        predictor = performance.WebPerformancePredictor(url, self.spool)
+        tasks = list(self._tasks())
+        start = time.time()
+        for task in tasks:
+            predictor.update(task, 100, 0.01, 0.02)
+        updated = time.time()
+        sender = predictor.sender.thread
+        predictor.save()
+        saved = time.time()
+        sender.join()
+        if self.server:
+            self.server.shutdown()
+        return updated - start, saved - updated
+
+    def _spooled(self):
+        total = 0
+        for name in os.listdir(self.spool):
+            if name.endswith(".json"):
+                with open(os.path.join(self.spool, name)) as f:
+                    total += len(json.load(f))
+        return total
+
+    def test_fast_endpoint_gets_everything(self):
+        self.server = Endpoint(0)
+        self._run(self.server.url)
+        self.assertEqual(self.server.received, N_RECORDS)
+        self.assertEqual(self._spooled(), 0)
+
+    def test_slow_endpoint_doesnt_hold_up_save(self):
+        self.server = Endpoint(SLOW)
+        update_s, save_s = self._run(self.server.url)
+        self.assertLess(update_s, 1)
+        self.assertLess(save_s, SLOW)
+        # what the endpoint may not have gotten is kept for next time
+        self.assertGreaterEqual(self.server.received + self._spooled(),
+                                N_RECORDS)
+
+    def test_down_endpoint_spools_everything(self):
+        # nothing listens on port 1
+        update_s, save_s = self._run("http://127.0.0.1:1/")
+        self.assertLess(update_s, 1)
+        self.assertLess(save_s, SLOW)
+        self.assertEqual(self._spooled(), N_RECORDS)
+
+
+if __name__ == '__main__':
+    unittest.main()